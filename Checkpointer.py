@@ -0,0 +1,100 @@
+import os
+import shutil
+import time
+import tensorflow as tf
+
+
+class Checkpointer:
+    """
+    Class Checkpointer
+    Saves and restores the VAE, the optimizer state and the epoch counter with a tf.train.CheckpointManager.
+    Saves are triggered every every_steps optimizer steps and/or every every_minutes minutes and keep
+    at most max_to_keep checkpoints. With async_save the variables are copied to host memory and written
+    to disk on a background thread, so the train loop only waits for the copy.
+    In a multi-worker run every worker has to take part in the save, only the chief writes to checkpoint_dir.
+    Args:
+        checkpoint_dir: Directory of the checkpoints
+        model: VAE to be saved
+        optimizer: Optimizer to be saved, may be None for load-only use
+        every_steps: Save every every_steps optimizer steps, None to disable
+        every_minutes: Save every every_minutes minutes, None to disable
+        max_to_keep: Number of checkpoints kept. Default 3
+        async_save: If True write checkpoints on a background thread. Default True
+        chief: False for non-chief workers, which write to a temporary directory that is removed again
+    Attributes:
+        epoch: tf.Variable counting the completed epochs, saved with the checkpoint
+        manager: The tf.train.CheckpointManager
+    """
+    def __init__(self, checkpoint_dir, model, optimizer=None, every_steps=None, every_minutes=None,
+                 max_to_keep=3, async_save=True, chief=True):
+        self.every_steps = every_steps
+        self.every_minutes = every_minutes
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        objects = {"model": model, "epoch": self.epoch}
+        if optimizer is not None:
+            objects["optimizer"] = optimizer
+        self._checkpoint = tf.train.Checkpoint(**objects)
+        self._chief = chief
+        self._directory = checkpoint_dir if chief else os.path.join(checkpoint_dir, f"tmp_worker_{os.getpid()}")
+        self.manager = tf.train.CheckpointManager(self._checkpoint, self._directory, max_to_keep=max_to_keep)
+        self._options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=async_save)
+        self._last_step = None
+        self._last_time = time.monotonic()
+
+    @property
+    def latest(self):
+        """
+        Property for the path of the latest checkpoint, None if there is none
+        """
+        return self.manager.latest_checkpoint
+
+    def restore(self, required=False):
+        """
+        Public method
+        Restores the latest checkpoint, if any
+        Args:
+            required: If True raise FileNotFoundError when there is no checkpoint
+        Returns:
+            The path of the restored checkpoint, None if there was none
+        """
+        path = self.latest
+        if path is None:
+            if required:
+                raise FileNotFoundError(f"No checkpoint found in {self._directory}")
+            return None
+        # Slots of an optimizer that was not created (load-only) are simply left out
+        self._checkpoint.restore(path).expect_partial()
+        print(f"Restored {path} (epoch {int(self.epoch.numpy())})")
+        return path
+
+    def save(self, step):
+        """
+        Public method
+        Saves a checkpoint numbered by step
+        """
+        path = self.manager.save(checkpoint_number=step, options=self._options)
+        self._last_step = step
+        self._last_time = time.monotonic()
+        return path
+
+    def maybe_save(self, step):
+        """
+        Public method
+        Saves a checkpoint if every_steps steps or every_minutes minutes have passed since the last save
+        """
+        if self._last_step is None:
+            self._last_step = step
+        due_steps = self.every_steps is not None and step - self._last_step >= self.every_steps
+        due_time = self.every_minutes is not None and time.monotonic() - self._last_time >= 60 * self.every_minutes
+        if due_steps or due_time:
+            return self.save(step)
+        return None
+
+    def close(self):
+        """
+        Public method
+        Waits for pending background saves and removes the temporary directory of non-chief workers
+        """
+        self._checkpoint.sync()
+        if not self._chief:
+            shutil.rmtree(self._directory, ignore_errors=True)
@@ -1,5 +1,7 @@
 import os
-import subprocess
+
+from DownloadManager import DownloadManager
+from data_utils import check_data_file
 
 
 class DataLoader:
@@ -18,6 +20,8 @@ class DataLoader:
         _ext: Determined dynamically in subclasses
         _url: The url source for the data
         _file_name: The specific filename of the data
+        _sha256: Expected SHA-256 of the file at _url, None if unknown
+        _downloader: DownloadManager used to fetch the data
 
 
     """
@@ -28,6 +32,8 @@ class DataLoader:
         self._data = None
         self._url =""
         self._file_name = ""
+        self._sha256 = None
+        self._downloader = DownloadManager(validate=check_data_file)
 
 
     @property
@@ -58,20 +64,19 @@ class DataLoader:
     def _download_data(self):
         """
         Private method
-        Checks if the file_path exists first, if not it downloads the data from the url using wget
+        Downloads the data from the url unless file_path holds a verified copy
+        The DownloadManager writes to a temporary file and renames it when complete,
+        so an interrupted download is resumed instead of being mistaken for the data.
+        An existing file is checked against its pinned or recorded SHA-256 first and downloaded again on a mismatch,
+        this runs before the file is preprocessed, so a corrupt file is never turned into a cache
         """
         self._make_dir()
-       
-
         if not os.path.exists(self._file_path):
             print(f"Downloading {self.dset} from {self._url}")
-            try: 
-                subprocess.run(["wget", self._url, "-O", self._file_path], check=True)
-
-            except Exception as error:
-                raise ValueError(f"Download failed: {error}")
-        else: 
-            print(f"{self._file_path} already downloaded")
+        try:
+            self._downloader.download(self._url, self._file_path, self._sha256)
+        except Exception as error:
+            raise ValueError(f"Download failed: {error}")
 
     def _load_data(self):
         """
@@ -0,0 +1,143 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class DataRegistry:
+    """
+    Class DataRegistry
+    In-process cache of loaded data, keyed by e.g. (dset, version, split).
+    Used by MnistDataLoader so that repeated requests for the same split are served from memory
+    and different splits can coexist. Entries are evicted least recently used first once
+    max_items or max_bytes is exceeded. Access is thread safe, and a slow load of one key does not block
+    requests for other keys: concurrent misses of the same key wait for a single load instead.
+    Args:
+        max_items: Maximum number of entries, None for no limit
+        max_bytes: Maximum total size of the entries in bytes, None for no limit. Memory-mapped arrays
+            (np.memmap) count as 0 bytes: their pages live in the page cache, which the OS reclaims on its own
+    Attributes:
+        max_items: Maximum number of entries
+        max_bytes: Maximum total size of the entries in bytes
+        nbytes: Current total size of the entries in bytes
+    """
+    def __init__(self, max_items=None, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _sizeof(value):
+        """
+        Private method
+        Size in bytes of a NumPy array or tf.Tensor, 0 for memory-mapped arrays and other values
+        """
+        if isinstance(value, np.memmap):
+            return 0
+        if hasattr(value, "nbytes"):
+            return int(value.nbytes)
+        if hasattr(value, "shape") and hasattr(value, "dtype"):
+            return int(value.shape.num_elements()) * value.dtype.size
+        return 0
+
+    def _evict(self):
+        """
+        Private method
+        Drops least recently used entries until both limits hold
+        """
+        while self._entries and (
+            (self.max_items is not None and len(self._entries) > self.max_items)
+            or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+        ):
+            _, (_, size) = self._entries.popitem(last=False)
+            self.nbytes -= size
+
+    def get(self, key, default=None):
+        """
+        Public method
+        Returns the value stored under key and marks it as recently used, default if missing
+        """
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        """
+        Public method
+        Stores value under key, evicting older entries if needed
+        Values larger than max_bytes on their own are not stored
+        """
+        size = self._sizeof(value)
+        with self._lock:
+            self.pop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            self._evict()
+
+    def pop(self, key):
+        """
+        Public method
+        Removes key and returns its value, None if missing
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            value, size = self._entries.pop(key)
+            self.nbytes -= size
+            return value
+
+    def get_or_load(self, key, load):
+        """
+        Public method
+        Returns the value under key, calling load() and storing its result on a miss
+        load() runs without holding the registry lock. Other threads missing the same key meanwhile
+        wait for its result (or exception) rather than loading it again
+        """
+        with self._lock:
+            if key in self._entries:
+                return self.get(key)
+            pending = self._loading.get(key)
+            if pending is None:
+                pending = self._loading[key] = Future()
+                loading = True
+            else:
+                loading = False
+        if not loading:
+            return pending.result()
+        try:
+            value = load()
+        except BaseException as error:
+            with self._lock:
+                del self._loading[key]
+            pending.set_exception(error)
+            raise
+        with self._lock:
+            self.put(key, value)
+            del self._loading[key]
+        pending.set_result(value)
+        return value
+
+    def clear(self):
+        """
+        Public method
+        Removes every entry
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
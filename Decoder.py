@@ -29,13 +29,19 @@ class Decoder(BiCoder):
         call() method 
         Respects the contract and implements the call() method
         Returns tuple of the noisy reconstruction xhat, the mean mu_x and logsigma_x
+        mu_x is cast to float32, so the reconstruction term is computed in float32 under mixed precision
 
         """
-        mu_x = self.neural_net(z)
+        mu_x = tf.cast(self.neural_net(z), tf.float32)
         eps = tf.random.normal(tf.shape(mu_x))
 
         xhat = mu_x+eps*self.sigma_x
         
         return xhat, mu_x,self.logsigma_x
-    
 
+    def mean(self,z):
+        """
+        Returns only mu_x, skipping the noise that call() draws for xhat
+        Used for the ELBO and mean reconstructions, where xhat is not needed
+        """
+        return tf.cast(self.neural_net(z), tf.float32)
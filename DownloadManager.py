@@ -0,0 +1,201 @@
+import contextlib
+import fcntl
+import http.client
+import os
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from data_utils import sha256_file
+
+SIDECAR = ".sha256"
+
+
+class IncompleteDownload(ConnectionError):
+    """
+    Raised when a response ends before the length announced by the server, the download is resumed
+    """
+
+
+class DownloadManager:
+    """
+    Class DownloadManager
+    Downloads files over HTTP(S) for the DataLoader classes.
+    Every download is streamed into a <path>.part file and only renamed to path once it is
+    complete (and its SHA-256 matches, when one is given), so a file at path is always whole.
+    Completeness is checked against the Content-Length/Content-Range of the server, and the SHA-256 of
+    every finished download is stored next to it in <path>.sha256. Files without a pinned digest are
+    verified against that sidecar later on.
+    An interrupted download is resumed from the .part file with a Range request.
+    Processes (and threads) downloading the same path take an flock on <path>.lock, so only one of them
+    writes the .part file and the others find the finished file. The lock file is removed again when the
+    download is done.
+    HTTP 4xx errors (other than 416) are not retried.
+    A download without a pinned digest is checked with validate before it is accepted, so a truncated file
+    or an error page is never recorded in the sidecar as the trusted copy.
+    Several files are fetched concurrently on a thread pool, so the total time is bounded by
+    the slowest file rather than the sum of all files.
+    Args:
+        max_workers: Number of concurrent downloads. Default 8
+        retries: Number of attempts per file before giving up. Default 3
+        timeout: Socket timeout in seconds. Default 60
+        chunk_size: Bytes read per chunk. Default 1 MiB
+        validate: Function (part_path, path) raising ValueError if the downloaded file is malformed,
+            e.g. data_utils.check_data_file. Default None, no check
+    """
+    def __init__(self, max_workers=8, retries=3, timeout=60, chunk_size=1 << 20, validate=None):
+        self.max_workers = max_workers
+        self.retries = retries
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.validate = validate
+
+    def _fetch(self, url, part_path):
+        """
+        Private method
+        Appends the missing bytes of url to part_path, restarting from zero when the server ignores the Range header
+        Raises IncompleteDownload if the response is shorter than announced
+        """
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header("Range", f"bytes={offset}-")
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as error:
+            # 416: the .part file already holds the whole resource
+            if error.code == 416 and offset:
+                return
+            raise
+        with response:
+            resumed = offset and response.status == 206
+            if resumed:
+                total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            else:
+                total = response.headers.get("Content-Length", "")
+            with open(part_path, "ab" if resumed else "wb") as file:
+                for chunk in iter(lambda: response.read(self.chunk_size), b""):
+                    file.write(chunk)
+        if total.isdigit() and os.path.getsize(part_path) != int(total):
+            raise IncompleteDownload(f"got {os.path.getsize(part_path)} of {total} bytes")
+
+    @staticmethod
+    def expected_sha256(path, sha256=None):
+        """
+        Public method
+        Digest path must have: sha256 if given, else the one recorded in the sidecar, else None
+        """
+        if sha256 is not None:
+            return sha256
+        if os.path.exists(path + SIDECAR):
+            with open(path + SIDECAR) as file:
+                return file.read().split()[0]
+        return None
+
+    def verify(self, path, sha256=None):
+        """
+        Public method
+        Checks path against its pinned or recorded digest
+        Returns:
+            False on a mismatch, True if it matches or there is no digest to check against
+        """
+        expected = self.expected_sha256(path, sha256)
+        return expected is None or sha256_file(path) == expected
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _locked(path):
+        """
+        Private method
+        Holds an exclusive flock on <path>.lock and removes the lock file before releasing it
+        A process that locked a lock file which was removed meanwhile retries on the new one,
+        so two processes never hold locks on different files for the same path
+        """
+        lock_path = f"{path}.lock"
+        while True:
+            lock = open(lock_path, "a")
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.stat(lock_path).st_ino == os.fstat(lock.fileno()).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            lock.close()
+        try:
+            yield
+        finally:
+            os.remove(lock_path)
+            lock.close()
+
+    def download(self, url, path, sha256=None):
+        """
+        Public method
+        Downloads url to path unless a complete copy already exists
+        Args:
+            url: Source url
+            path: Destination path
+            sha256: Optional pinned hex digest. Existing and downloaded files are verified against it,
+                existing files without one against their .sha256 sidecar
+        Returns:
+            path
+        """
+        with self._locked(path):
+            # Checked under the lock, another process may have finished the file meanwhile
+            if os.path.exists(path):
+                if self.verify(path, sha256):
+                    return path
+                print(f"Checksum mismatch for {path}, downloading again")
+                os.remove(path)
+
+            part_path = f"{path}.part"
+            for attempt in range(1, self.retries + 1):
+                try:
+                    self._fetch(url, part_path)
+                    break
+                except urllib.error.HTTPError as error:
+                    if 400 <= error.code < 500 or attempt == self.retries:
+                        raise
+                    print(f"Download of {url} failed ({error}), retrying (attempt {attempt+1}/{self.retries})")
+                except (urllib.error.URLError, http.client.IncompleteRead, ConnectionError, TimeoutError) as error:
+                    if attempt == self.retries:
+                        raise
+                    print(f"Download of {url} interrupted ({error}), resuming (attempt {attempt+1}/{self.retries})")
+
+            digest = sha256_file(part_path)
+            if sha256 is not None and digest != sha256:
+                os.remove(part_path)
+                raise ValueError(f"Checksum mismatch for {url}")
+            if sha256 is None and self.validate is not None:
+                try:
+                    self.validate(part_path, path)
+                except ValueError as error:
+                    os.remove(part_path)
+                    raise ValueError(f"Download of {url} is not a valid file: {error}")
+            with open(f"{path}{SIDECAR}.tmp", "w") as file:
+                file.write(f"{digest}  {os.path.basename(path)}\n")
+            os.replace(f"{path}{SIDECAR}.tmp", path + SIDECAR)
+            os.replace(part_path, path)
+        return path
+
+    def download_all(self, jobs):
+        """
+        Public method
+        Downloads several files concurrently
+        Args:
+            jobs: Iterable of (url, path, sha256) tuples, sha256 may be None
+        Returns:
+            List of the downloaded paths
+        Raises:
+            ValueError listing every failed download once all downloads have finished
+        """
+        jobs = list(jobs)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.download, *job) for job in jobs]
+
+        errors = []
+        for (url, path, _), future in zip(jobs, futures):
+            if future.exception() is not None:
+                errors.append(f"{path}: {future.exception()}")
+        if errors:
+            raise ValueError("Download failed: " + "; ".join(errors))
+        return [future.result() for future in futures]
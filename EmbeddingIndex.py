@@ -0,0 +1,268 @@
+import os
+import time
+import numpy as np
+
+from InferenceEngine import InferenceEngine
+
+
+class EmbeddingIndex:
+    """
+    Class EmbeddingIndex
+    Exact k-nearest-neighbour search over VAE embeddings (mu_z) with squared Euclidean distance.
+    The embeddings are kept in one contiguous float32 or float16 array. Queries are answered in batches
+    with one matrix product per query batch and database chunk, using ||q||^2 - 2 q.x + ||x||^2,
+    and the k best candidates are kept with argpartition. float16 storage halves the memory,
+    distances are always computed in float32.
+    Args:
+        embeddings: Array of shape (n, latent_dim)
+        dtype: Storage dtype, float32 (default) or float16
+        chunk_size: Number of database rows compared per matrix product. Default 65536
+    Attributes:
+        embeddings: The stored embeddings
+    """
+    def __init__(self, embeddings, dtype=np.float32, chunk_size=65536):
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=dtype)
+        self.chunk_size = chunk_size
+        # The norms are computed per chunk, like the distances, so float16 storage is never copied to float32 whole
+        self._sq_norms = np.empty(len(self.embeddings), np.float32)
+        for start in range(0, len(self.embeddings), chunk_size):
+            block = self.embeddings[start:start + chunk_size].astype(np.float32)
+            self._sq_norms[start:start + chunk_size] = np.einsum("ij,ij->i", block, block)
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    @classmethod
+    def from_loader(cls, model, loader, split="test", batch_size=1024, **kwargs):
+        """
+        Class method
+        Encodes a split of a MnistDataLoader with model.sample_zmean once and indexes the result
+        Args:
+            model: Trained VAE
+            loader: MnistDataLoader
+            split: train or test
+            batch_size: Micro-batch size of the InferenceEngine
+        """
+        if split == "train":
+            inputs = loader.get_training_data(batch_size=batch_size, shuffle_buffer=1)
+        elif split == "test":
+            inputs = loader.get_testing_data()
+        else:
+            raise ValueError(f"Unknown split '{split}', expected 'train' or 'test'")
+        embeddings = InferenceEngine(model, batch_size=batch_size).predict("encode_mean", inputs)
+        return cls(embeddings, **kwargs)
+
+    @staticmethod
+    def _merge(best_d, best_i, d, ids, k):
+        """
+        Private method
+        Merges candidate distances d with ids into the running top-k per query
+        """
+        all_d = np.concatenate([best_d, d], axis=1)
+        all_i = np.concatenate([best_i, np.broadcast_to(ids, d.shape)], axis=1)
+        if all_d.shape[1] > k:
+            part = np.argpartition(all_d, k - 1, axis=1)[:, :k]
+            all_d = np.take_along_axis(all_d, part, axis=1)
+            all_i = np.take_along_axis(all_i, part, axis=1)
+        return all_d, all_i
+
+    def _distances(self, queries, rows):
+        """
+        Private method
+        Squared distances between queries and the database rows selected by rows (a slice or index array)
+        """
+        block = self.embeddings[rows].astype(np.float32)
+        d = self._sq_norms[rows][None, :] - 2.0 * queries @ block.T
+        d += np.einsum("ij,ij->i", queries, queries)[:, None]
+        return np.maximum(d, 0.0, out=d)
+
+    @staticmethod
+    def _sorted(best_d, best_i):
+        """
+        Private method
+        Sorts the top-k of every query by distance
+        """
+        order = np.argsort(best_d, axis=1)
+        return np.take_along_axis(best_d, order, axis=1), np.take_along_axis(best_i, order, axis=1)
+
+    def _search_batch(self, queries, k):
+        """
+        Private method
+        Exact top-k for one batch of queries
+        """
+        best_d = np.empty((len(queries), 0), np.float32)
+        best_i = np.empty((len(queries), 0), np.int64)
+        for start in range(0, len(self), self.chunk_size):
+            rows = slice(start, start + self.chunk_size)
+            ids = np.arange(start, min(start + self.chunk_size, len(self)))
+            best_d, best_i = self._merge(best_d, best_i, self._distances(queries, rows), ids, k)
+        return self._sorted(best_d, best_i)
+
+    def search(self, queries, k=10, batch_size=1024):
+        """
+        Public method
+        Finds the k nearest embeddings of every query
+        Args:
+            queries: Array of shape (m, latent_dim)
+            k: Number of neighbours. Default 10
+            batch_size: Number of queries per batch. Default 1024
+        Returns:
+            Tuple of squared distances and indices, both of shape (m, k) and sorted by distance
+        """
+        k = min(k, len(self))
+        queries = np.asarray(queries, dtype=np.float32)
+        results = [self._search_batch(queries[start:start + batch_size], k)
+                   for start in range(0, len(queries), batch_size)]
+        return np.concatenate([d for d, _ in results]), np.concatenate([i for _, i in results])
+
+    def save(self, directory):
+        """
+        Public method
+        Saves the index as .npy files in directory
+        """
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "embeddings.npy"), self.embeddings)
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """
+        Class method
+        Loads an index saved with save(), memory-mapping the embeddings by default
+        """
+        embeddings = np.load(os.path.join(directory, "embeddings.npy"), mmap_mode=mmap_mode)
+        return cls(embeddings, dtype=embeddings.dtype)
+
+
+class IVFIndex(EmbeddingIndex):
+    """
+    Class IVFIndex
+    Approximate k-nearest-neighbour search with an inverted file index.
+    Inherits from EmbeddingIndex
+    The embeddings are clustered with k-means into n_lists lists and stored contiguously list by list.
+    A query only scans the n_probe lists with the closest centroids, trading recall for latency.
+    The search loops over lists instead of queries, so every list is scanned once per query batch
+    with a single matrix product.
+    Args:
+        embeddings: Array of shape (n, latent_dim)
+        n_lists: Number of k-means clusters. Default 64
+        n_probe: Number of lists scanned per query. Default 8
+        iterations: Number of k-means iterations. Default 20
+        seed: Seed of the k-means initialization. Default 0
+        dtype: Storage dtype, float32 (default) or float16
+        centroids, ids, offsets: Precomputed lists, used by load() to skip k-means
+    Attributes:
+        centroids: Array of shape (n_lists, latent_dim)
+        n_probe: Number of lists scanned per query
+    """
+    def __init__(self, embeddings, n_lists=64, n_probe=8, iterations=20, seed=0, dtype=np.float32,
+                 centroids=None, ids=None, offsets=None):
+        self.n_probe = n_probe
+        if centroids is None:
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            centroids, assignment = self._kmeans(embeddings, min(n_lists, len(embeddings)), iterations, seed)
+            ids = np.argsort(assignment, kind="stable")
+            offsets = np.searchsorted(assignment[ids], np.arange(len(centroids) + 1))
+            embeddings = embeddings[ids]
+        super().__init__(embeddings, dtype=dtype)
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self._ids = np.asarray(ids, dtype=np.int64)
+        self._offsets = np.asarray(offsets, dtype=np.int64)
+
+    @staticmethod
+    def _kmeans(x, n_clusters, iterations, seed):
+        """
+        Private method
+        Lloyd's k-means. Returns the centroids and the cluster of every row of x
+        """
+        rng = np.random.default_rng(seed)
+        centroids = x[rng.choice(len(x), n_clusters, replace=False)].copy()
+        x_sq = np.einsum("ij,ij->i", x, x)
+        for _ in range(iterations):
+            d = x_sq[:, None] - 2.0 * x @ centroids.T + np.einsum("ij,ij->i", centroids, centroids)[None, :]
+            assignment = np.argmin(d, axis=1)
+            counts = np.bincount(assignment, minlength=n_clusters)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, x)
+            # Empty clusters keep their old centroid
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+        d = x_sq[:, None] - 2.0 * x @ centroids.T + np.einsum("ij,ij->i", centroids, centroids)[None, :]
+        return centroids, np.argmin(d, axis=1)
+
+    def _search_batch(self, queries, k):
+        """
+        Private method
+        Approximate top-k for one batch of queries, scanning the n_probe closest lists of every query
+        """
+        n_probe = min(self.n_probe, len(self.centroids))
+        centroid_d = -2.0 * queries @ self.centroids.T + np.einsum("ij,ij->i", self.centroids, self.centroids)[None, :]
+        probes = np.argpartition(centroid_d, n_probe - 1, axis=1)[:, :n_probe]
+
+        best_d = np.full((len(queries), k), np.inf, np.float32)
+        best_i = np.full((len(queries), k), -1, np.int64)
+        for list_id in np.unique(probes):
+            start, end = self._offsets[list_id], self._offsets[list_id + 1]
+            if start == end:
+                continue
+            query_ids = np.nonzero((probes == list_id).any(axis=1))[0]
+            d = self._distances(queries[query_ids], slice(start, end))
+            merged_d, merged_i = self._merge(best_d[query_ids], best_i[query_ids], d, self._ids[start:end], k)
+            best_d[query_ids], best_i[query_ids] = merged_d, merged_i
+        return self._sorted(best_d, best_i)
+
+    def save(self, directory):
+        """
+        Public method
+        Saves the index as .npy files in directory
+        """
+        super().save(directory)
+        for name, array in (("centroids", self.centroids), ("ids", self._ids), ("offsets", self._offsets)):
+            np.save(os.path.join(directory, f"{name}.npy"), array)
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r", n_probe=8):
+        """
+        Class method
+        Loads an index saved with save(), memory-mapping the embeddings by default
+        """
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+                  for name in ("embeddings", "centroids", "ids", "offsets")}
+        return cls(arrays["embeddings"], n_probe=n_probe, dtype=arrays["embeddings"].dtype,
+                   centroids=arrays["centroids"], ids=arrays["ids"], offsets=arrays["offsets"])
+
+
+def recall_benchmark(index, queries, k=10, n_probes=(1, 2, 4, 8, 16, 32), batch_size=1024):
+    """
+    recall_benchmark function
+    Measures recall@k and latency of an IVFIndex for several n_probe values against exact search
+    over the same embeddings
+    Args:
+        index: IVFIndex
+        queries: Array of query embeddings, held out from the index (a query in the index finds itself)
+        k: Number of neighbours. Default 10
+        n_probes: n_probe values to be measured
+        batch_size: Number of queries per batch
+    Returns:
+        List of dictionaries with n_probe, recall, ms_per_query and queries_per_sec, the first entry being exact search
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    exact = EmbeddingIndex(index.embeddings, dtype=index.embeddings.dtype)
+
+    def timed(search_index):
+        start = time.perf_counter()
+        _, ids = search_index.search(queries, k, batch_size)
+        return ids, time.perf_counter() - start
+
+    exact_ids, seconds = timed(exact)
+    exact_ids = index._ids[exact_ids]
+    results = [{"n_probe": "exact", "recall": 1.0, "ms_per_query": 1e3 * seconds / len(queries),
+                "queries_per_sec": len(queries) / seconds}]
+    n_probe = index.n_probe
+    for probe in n_probes:
+        index.n_probe = probe
+        ids, seconds = timed(index)
+        hits = sum(len(np.intersect1d(a, b)) for a, b in zip(ids, exact_ids))
+        results.append({"n_probe": probe, "recall": hits / exact_ids.size,
+                        "ms_per_query": 1e3 * seconds / len(queries), "queries_per_sec": len(queries) / seconds})
+    index.n_probe = n_probe
+    return results
@@ -16,29 +16,38 @@ class Encoder(BiCoder):
 
     Attributes:
         neural_net: The underlying neural network used to encode inputs.
-        latent_dim: Integer representing the size of the latent representation. Determine on the first call.
+        latent_dim: Integer representing the size of the latent representation.
+            Taken from the output shape of neural_net when it is built, otherwise determined on the first call.
     """   
     def __init__(self,neural_net): 
         super().__init__(neural_net) #referal to parent class
         #instance variables
         self.latent_dim = None
+        if getattr(neural_net, "built", False):
+            self.latent_dim = neural_net.output_shape[-1] // 2
 
 
-    def call(self,x):
+    def moments(self,x):
         """
-        call() method 
-        Respects the contract and implements the call() method
-        Perfoms the reparmeterization and returns a tuple of z, mu_z and log_var z
+        Returns mu_z and logvar_z without drawing a sample
         Sets the latent_dim attribute once upon the first call
+        The network output is cast to float32, so the reparameterization is done in float32 under mixed precision
         """
-
-        out = self.neural_net(x)
+        out = tf.cast(self.neural_net(x), tf.float32)
         if self.latent_dim is None:
             
             self.latent_dim = out.shape[1] // 2
         
-        mu_z = out[:,:self.latent_dim]
-        logvar_z = out[:,self.latent_dim:]
+        return out[:,:self.latent_dim], out[:,self.latent_dim:]
+
+    def call(self,x):
+        """
+        call() method 
+        Respects the contract and implements the call() method
+        Perfoms the reparmeterization and returns a tuple of z, mu_z and log_var z
+        """
+
+        mu_z, logvar_z = self.moments(x)
         sigma_z = tf.math.exp(0.5*logvar_z)
 
         eps = tf.random.normal(tf.shape(mu_z))
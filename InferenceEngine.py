@@ -0,0 +1,142 @@
+import time
+import numpy as np
+import tensorflow as tf
+
+
+class InferenceEngine:
+    """
+    Class InferenceEngine
+    Runs the encoder and decoder of a trained VAE over inputs of any size in fixed micro-batches.
+    Inputs can be a NumPy array (also memory-mapped), a tf.Tensor, a tf.data.Dataset of batches
+    or any iterable of arrays. The VAE helpers are wrapped in tf.functions with a [None, ...] input
+    signature, so each method is traced once and reused for every micro-batch.
+    Only one micro-batch is in flight at a time, so memory does not grow with the number of inputs
+    when the results are consumed from run() or written to a memory-mapped .npy by predict().
+    Args:
+        model: Trained VAE
+        batch_size: Number of inputs per micro-batch. Default 1024
+    Attributes:
+        model: The VAE
+        batch_size: Number of inputs per micro-batch
+    """
+    METHODS = ("encode_mean", "encode_sample", "decode_mean", "decode_noisy")
+
+    def __init__(self, model, batch_size=1024):
+        self.model = model
+        self.batch_size = batch_size
+        self._functions = {}
+
+    def _function(self, method, element_shape):
+        """
+        Private method
+        Compiled function of method for inputs with element_shape, created on first use
+        """
+        key = (method, tuple(element_shape))
+        if key not in self._functions:
+            fn = {
+                "encode_mean": self.model.sample_zmean,
+                "encode_sample": self.model.sample_z,
+                "decode_mean": self.model.reconstruct_mean,
+                "decode_noisy": self.model.reconstruct_noisy,
+            }[method]
+            signature = [tf.TensorSpec([None] + list(element_shape), tf.float32)]
+            self._functions[key] = tf.function(fn, input_signature=signature)
+        return self._functions[key]
+
+    def _batches(self, inputs):
+        """
+        Private method
+        Splits inputs into micro-batches of batch_size (the last one may be smaller)
+        """
+        if isinstance(inputs, (np.ndarray, tf.Tensor)):
+            for start in range(0, len(inputs), self.batch_size):
+                yield inputs[start:start + self.batch_size]
+        elif isinstance(inputs, tf.data.Dataset):
+            yield from inputs.unbatch().batch(self.batch_size).prefetch(tf.data.AUTOTUNE)
+        else:
+            # Arbitrary chunks from an iterable are re-chunked to batch_size
+            buffer, buffered = [], 0
+            for chunk in inputs:
+                chunk = np.asarray(chunk)
+                buffer.append(chunk)
+                buffered += len(chunk)
+                while buffered >= self.batch_size:
+                    data = np.concatenate(buffer)
+                    yield data[:self.batch_size]
+                    buffer, buffered = [data[self.batch_size:]], buffered - self.batch_size
+            if buffered:
+                yield np.concatenate(buffer)
+
+    def run(self, method, inputs):
+        """
+        Public method
+        Generator yielding the output of method for every micro-batch of inputs as a NumPy array
+        Args:
+            method: encode_mean, encode_sample, decode_mean or decode_noisy
+            inputs: Array, tensor, dataset of batches or iterable of arrays
+        """
+        if method not in self.METHODS:
+            raise ValueError(f"Unknown method '{method}', expected one of {self.METHODS}")
+        for batch in self._batches(inputs):
+            batch = tf.cast(batch, tf.float32)
+            yield self._function(method, batch.shape[1:])(batch).numpy()
+
+    def predict(self, method, inputs, out_path=None, num_examples=None):
+        """
+        Public method
+        Runs method over all of inputs
+        Args:
+            method: encode_mean, encode_sample, decode_mean or decode_noisy
+            inputs: Array, tensor, dataset of batches or iterable of arrays
+            out_path: Optional .npy path. The outputs are written into a memory-mapped file there
+                instead of being collected in memory
+            num_examples: Number of inputs, required with out_path for datasets and iterables
+        Returns:
+            The outputs as an array, memory-mapped when out_path is given
+        """
+        if out_path is None:
+            return np.concatenate(list(self.run(method, inputs)))
+
+        if num_examples is None:
+            if not isinstance(inputs, (np.ndarray, tf.Tensor)):
+                raise ValueError("num_examples is required to write the outputs of a dataset or iterable")
+            num_examples = len(inputs)
+        out, written = None, 0
+        for outputs in self.run(method, inputs):
+            if out is None:
+                out = np.lib.format.open_memmap(out_path, mode="w+", dtype=outputs.dtype,
+                                                shape=(num_examples,) + outputs.shape[1:])
+            out[written:written + len(outputs)] = outputs
+            written += len(outputs)
+        if written != num_examples:
+            raise ValueError(f"Expected {num_examples} inputs, got {written}")
+        out.flush()
+        return out
+
+    def log_likelihood(self, inputs, k=100, chunk_size=None):
+        """
+        Public method
+        Estimates the test log-likelihood with the importance-weighted bound of VAE.iwae_terms
+        Args:
+            inputs: Array, tensor, dataset of batches or iterable of arrays, e.g. get_testing_data()
+            k: Number of importance samples per input. Default 100
+            chunk_size: Samples decoded at once, None for all k. Bounds memory at batch_size*chunk_size decodes
+        Returns:
+            Dictionary with the mean iwae bound and k-sample elbo, the number of examples, seconds and examples_per_sec
+        """
+        iwae_sum, elbo_sum, examples = 0.0, 0.0, 0
+        start = time.perf_counter()
+        for batch in self._batches(inputs):
+            batch = tf.cast(batch, tf.float32)
+            key = ("iwae", k, chunk_size, tuple(batch.shape[1:]))
+            if key not in self._functions:
+                signature = [tf.TensorSpec([None] + list(batch.shape[1:]), tf.float32)]
+                self._functions[key] = tf.function(lambda x: self.model.iwae_terms(x, k, chunk_size),
+                                                   input_signature=signature)
+            iwae, elbo = self._functions[key](batch)
+            iwae_sum += float(tf.reduce_sum(iwae))
+            elbo_sum += float(tf.reduce_sum(elbo))
+            examples += len(batch)
+        seconds = time.perf_counter() - start
+        return {"iwae": iwae_sum / examples, "elbo": elbo_sum / examples, "k": k, "examples": examples,
+                "seconds": seconds, "examples_per_sec": examples / seconds}
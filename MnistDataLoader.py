@@ -1,4 +1,8 @@
 from DataLoader import DataLoader
+from DataRegistry import DataRegistry
+from SharedDataServer import SharedDataClient
+from data_utils import save_npy_atomic, shard_dir, write_shards
+import os
 import numpy as np
 import pickle
 import tensorflow as tf
@@ -11,6 +15,10 @@ class MnistDataLoader(DataLoader):
     Args:
         dset: Name of dataset being loaded. (mnist_bw,mnist_color)
         version: Version of mnist_color. (m0,m1,m2,m3,m4)
+        registry: DataRegistry holding the loaded splits. Pass one registry to several loaders to share it.
+            Defaults to a private registry bounded to 2 GiB of resident arrays (memory-mapped splits are not counted)
+        shared_data: Address of a SharedDataServer (or a SharedDataClient). If given, the splits are attached
+            read-only from the server's shared memory, so all processes on the node share one copy
     Attributes:
         dset: Name of dataset being loaded. (mnist_bw,mnist_color)
         version: Version of mnist_color. (m0,m1,m2,m3,m4)
@@ -18,6 +26,12 @@ class MnistDataLoader(DataLoader):
         _url_map_tr: Dictionary of urls to retrieve training data
         _url_map_te: Dictionary of urls to retrieve testing data 
         _url_map_labels: Dictionary of urls to retrive labels for testing data
+        _checksums: Dictionary of pinned SHA-256 digests per key, checked first. A key without one is
+            checked for a well-formed .npy/.pkl on its first download (data_utils.check_data_file) and then
+            verified against the <file>.sha256 sidecar the DownloadManager records
+        _cache_dir: Directory of the preprocessed float32 .npy files, one per dset/version/split
+        _registry: DataRegistry mapping (dset, version, split, dtype) to the loaded array
+        _shared_data: SharedDataClient the splits are attached from, None to load them in this process
         
         Attributes Inherited from DataLoader:
         _data: The actual loaded data 
@@ -32,7 +46,7 @@ class MnistDataLoader(DataLoader):
        
 
     """
-    def __init__(self,dset,version =None):
+    def __init__(self,dset,version =None,registry =None,shared_data =None):
         super().__init__(dset)
         
         self._url_map_tr = {"mnist_bw": "https://www.dropbox.com/scl/fi/fjye8km5530t9981ulrll/mnist_bw.npy?rlkey=ou7nt8t88wx1z38nodjjx6lch&st=5swdpnbr&dl=1",
@@ -45,7 +59,13 @@ class MnistDataLoader(DataLoader):
         self._url_map_labels = {"mnist_bw_y_te":'https://www.dropbox.com/scl/fi/8kmcsy9otcxg8dbi5cqd4/mnist_bw_y_te.npy?rlkey=atou1x07fnna5sgu6vrrgt9j1&st=m05mfkwb&dl=1',
          
                             "mnist_color_y_te":'https://www.dropbox.com/scl/fi/fkf20sjci5ojhuftc0ro0/mnist_color_y_te.npy?rlkey=fshs83hd5pvo81ag3z209tf6v&st=99z1o18q&dl=1'}
+        # key -> SHA-256 of a trusted copy of the file, takes precedence over the recorded sidecar
+        self._checksums = {}
         self.version = version
+        self._registry = registry if registry is not None else DataRegistry(max_bytes=2*1024**3)
+        self._owns_client = isinstance(shared_data, str)
+        self._shared_data = SharedDataClient(shared_data) if self._owns_client else shared_data
+        self._shared_keys = []
     def _get_ext(self,key):
         """
         Private method
@@ -67,89 +87,179 @@ class MnistDataLoader(DataLoader):
         else:
             return ".npy"
     
+    @property
+    def _cache_dir(self):
+        """
+        Property to dynamically compute the directory of the preprocessed .npy cache inside _data_dir
+        """
+        return os.path.join(self._data_dir, "cache")
+
+    def _cache_path(self, key, version=None, dtype=np.float32):
+        """
+        Private method
+        Path of the preprocessed cache file for key, versioned for mnist_color
+        uint8 caches get a _uint8 suffix so both storage formats can coexist
+        """
+        name = f"{key}_{version}" if version else key
+        if np.dtype(dtype) == np.uint8:
+            name = f"{name}_uint8"
+        return os.path.join(self._cache_dir, f"{name}.npy")
+
     def _load_file(self):
         """
         Private method
         Loads the file depending on the file extension
+        .npy files are memory-mapped, so no copy is made until the data is transformed
         """
         if self._ext == ".npy":
-            return np.load(self._file_path).astype(np.float32)
+            return np.load(self._file_path, mmap_mode="r")
         if self._ext == ".pkl":
             with open(self._file_path,"rb") as file:
                 return pickle.load(file)
             
         raise ValueError(f"Unknown extension {self._ext}")
-            
-    
-            
-    def _load_data(self):
+
+    def _build_cache(self, key, transform=True, dtype=np.float32):
         """
         Private method
-        Loads the data depending on the extension and the file version if its for mnist_color
+        Preprocesses the downloaded file once and stores the result as .npy in _cache_dir
+        For .pkl files every version is written in the same pass, so the pickle is only read once
+        dtype float32 stores the transformed data, uint8 stores the quantized data (see _quantize_data)
         """
         raw_file = self._load_file()
         if self._ext == ".pkl":
             if self.version not in raw_file:
                 raise KeyError(f"Version '{self.version}' not found \n, Please specify a version: 'm0', 'm1', 'm2', 'm3', or 'm4'")
-            self._data =raw_file[self.version].astype(np.float32)
-    
+            versions = raw_file
         else:
-            
-            self._data = raw_file
+            versions = {None: raw_file}
+
+        os.makedirs(self._cache_dir, exist_ok=True)
+        for version, raw_data in versions.items():
+            self._data = raw_data
+            if np.dtype(dtype) == np.uint8:
+                self._quantize_data()
+            elif transform:
+                self._transform_data()
+            save_npy_atomic(self._cache_path(key, version, dtype), np.asarray(self._data, dtype=dtype))
+        self._data = None
+
+    def _load_data(self, key, transform=True, dtype=np.float32):
+        """
+        Private method
+        Loads the preprocessed data for key as a read-only memory-mapped array
+        The raw file is only downloaded and preprocessed when the cache file is missing.
+        Repeated runs and parallel processes map the same cache file and share the page cache
+        """
+        version = self.version if self._ext == ".pkl" else None
+        cache_path = self._cache_path(key, version, dtype)
+        if not os.path.exists(cache_path):
+            self._download_data()
+            self._build_cache(key, transform, dtype)
+        self._data = np.load(cache_path, mmap_mode="r")
 
     def _transform_data(self):
         """
         Private method
         Transforms mnist_bw only 
+        Scales to [0,1] in place after the single float32 copy
         """
         if self.dset == "mnist_bw":
-            self._data = self._data / 255.0
-            self._data = self._data.reshape(len(self._data), -1)
+            data = self._data.reshape(len(self._data), -1).astype(np.float32)
+            data /= 255.0
+            self._data = data
         else:
             print(f"No transformation performed, {self.dset} does not require transformation")
-        
-    def get_training_data(self,batch_size =256):
+
+    def _quantize_data(self):
+        """
+        Private method
+        Converts the raw data to the uint8 storage used by the streaming pipeline
+        mnist_bw is flattened and kept at [0,255], mnist_color is rescaled from [0,1] to [0,255].
+        _normalize undoes the scaling on the fly
+        """
+        if self.dset == "mnist_bw":
+            self._data = self._data.reshape(len(self._data), -1).astype(np.uint8)
+        else:
+            data = np.rint(np.multiply(self._data, 255.0, dtype=np.float32))
+            self._data = np.clip(data, 0, 255, out=data).astype(np.uint8)
+
+    @staticmethod
+    def _normalize(x):
+        """
+        Private method
+        Maps a batch of uint8 storage back to float32 in [0,1]
+        """
+        return tf.cast(x, tf.float32) / 255.0
+
+    def _streaming_dataset(self, data, batch_size, shuffle_buffer, cache, drop_remainder=False, block_size=1024):
+        """
+        Private method
+        Builds a tf.data pipeline that streams blocks from the memory-mapped cache or a shared memory view
+        Blocks are read in random order and shuffled further within a window of shuffle_buffer
+        elements, normalization of uint8 data runs in a parallel map and batches are prefetched.
+        With shuffle_buffer 1 the rows keep their order, like from_tensor_slices without shuffling.
+        With cache the uint8 elements are kept in memory after the first epoch, so the block
+        order is fixed from then on and only the shuffle window changes between epochs
+        """
+        n_blocks = -(-len(data) // block_size)
+        ordered = shuffle_buffer == 1
+
+        def read_blocks():
+            for block in range(n_blocks) if ordered else np.random.permutation(n_blocks):
+                yield data[block*block_size:(block+1)*block_size]
+
+        spec = tf.TensorSpec(shape=(None,) + data.shape[1:], dtype=tf.as_dtype(data.dtype))
+        tr_data = tf.data.Dataset.from_generator(read_blocks, output_signature=spec).unbatch()
+        if cache:
+            tr_data = tr_data.cache()
+        if not ordered:
+            tr_data = tr_data.shuffle(buffer_size=shuffle_buffer)
+        tr_data = tr_data.batch(batch_size, drop_remainder=drop_remainder)
+        if data.dtype == np.uint8:
+            tr_data = tr_data.map(self._normalize, num_parallel_calls=tf.data.AUTOTUNE)
+        return tr_data.prefetch(tf.data.AUTOTUNE)
+
+    def get_training_data(self,batch_size =256,streaming=False,shuffle_buffer=None,cache=False,drop_remainder=False):
             """
             Public method
             Implements the abstract method from DataLoader superclass
             Retrieves training_data in batches in tensorflow applicable format
             Args:
                 batch_size: Default value 256 
+                streaming: If True stream uint8 blocks from the memory-mapped cache and normalize
+                    in a parallel map instead of holding the whole float32 dataset in memory
+                shuffle_buffer: Number of elements in the shuffle window, 1 keeps the rows in order.
+                    Defaults to the whole dataset, or 8192 when streaming
+                cache: If True cache the elements in memory after the first epoch
+                drop_remainder: If True drop the last incomplete batch, so every batch has a static shape
+            With shared_data the float32 split is streamed from the shared view in blocks as well
+            (shuffle window 8192), from_tensor_slices or a full shuffle buffer would copy it into this process
             """
-            key = self.dset
-            self._ext = self._get_ext(key)
-            self._file_name = f"{self.dset}{self._ext}"
-            self._url = self._url_map_tr[self.dset]
-        
-            self._download_data()
-            self._load_data()
-            self._transform_data()
-            if self._data is not None:
-                data_length = len(self._data)
+            data = self._get_split("train", dtype=np.uint8 if streaming else np.float32)
+            if data is not None:
+                data_length = len(data)
             else:
                 raise ValueError("There is no data to get")
-            tr_data = tf.data.Dataset.from_tensor_slices(self._data)
-            tr_data = tr_data.shuffle(buffer_size=data_length).batch(batch_size)            
-            return tr_data
+            if streaming or self._shared_data is not None:
+                return self._streaming_dataset(data, batch_size, shuffle_buffer or 8192, cache, drop_remainder)
+
+            tr_data = tf.data.Dataset.from_tensor_slices(data)
+            if cache:
+                tr_data = tr_data.cache()
+            tr_data = tr_data.shuffle(buffer_size=shuffle_buffer or data_length).batch(batch_size, drop_remainder=drop_remainder)
+            return tr_data.prefetch(tf.data.AUTOTUNE)
     
     def get_testing_data(self):
             """
             Public method
             Implements the abstract method from DataLoader superclass
-            Retrieves the testing data in a tensor.
+            Retrieves the testing data as a read-only float32 NumPy array.
+            The memory-mapped cache file, or with shared_data the shared memory view, is returned in both modes,
+            so there is never a private copy. It is kept in the registry, so later calls return it without reloading
 
             """
-            
-            key = f"{self.dset}_te"
-            self._url = self._url_map_te[key]
-            self._ext = self._get_ext(key)
-            self._file_name = f"{key}{self._ext}"
-            
-            self._download_data()
-            self._load_data()
-            self._transform_data()
-            test_data = tf.convert_to_tensor(self._data)
-            return test_data
+            return self._get_split("test")
     
     
     def get_labels(self): 
@@ -157,17 +267,84 @@ class MnistDataLoader(DataLoader):
             Public method 
             Retrieves the label for mnist_color and mnist_bw, useful for plotting the latent space
             """
-            key = f"{self.dset}_y_te"
-            self._ext = self._get_ext(key)
-            self._file_name = f"{key}{self._ext}"
-            self._url = self._url_map_labels[key]
-            
-            self._download_data()
-            self._load_data()
-            labels = self._data
-            return labels
-        
+            return self._get_split("labels", transform=False)
 
-        
+    def _get_split(self, split, transform=True, dtype=np.float32):
+            """
+            Private method
+            Returns the memory-mapped array of split (train, test or labels) through the registry
+            Only the first request per split and dtype touches the disk, later requests are dictionary lookups
+            """
+            registry_key = (self.dset, self.version, split, np.dtype(dtype).name)
+
+            def load():
+                if self._shared_data is not None:
+                    self._shared_keys.append(registry_key)
+                    return self._shared_data.attach(*registry_key)
+                key, url_map = {
+                    "train": (self.dset, self._url_map_tr),
+                    "test": (f"{self.dset}_te", self._url_map_te),
+                    "labels": (f"{self.dset}_y_te", self._url_map_labels),
+                }[split]
+                self._ext = self._get_ext(key)
+                self._file_name = f"{key}{self._ext}"
+                self._url = url_map[key]
+                self._sha256 = self._checksums.get(key)
+                self._load_data(key, transform, dtype)
+                return self._data
+
+            return self._registry.get_or_load(registry_key, load)
+
+    def export_shards(self, split="train", shard_size=10000, dtype=np.uint8):
+            """
+            Public method
+            Writes split as fixed-size .npy shards plus a manifest, readable by ShardedDataLoader
+            Args:
+                split: train or test
+                shard_size: Number of examples per shard. Default 10000
+                dtype: Storage dtype of the shards, uint8 (default) or float32
+            Returns:
+                The directory of the shards
+            """
+            if split not in ("train", "test"):
+                raise ValueError(f"Unknown split '{split}', expected 'train' or 'test'")
+            data = self._get_split(split, dtype=dtype)
+            out_dir = shard_dir(self._data_dir, self.dset, self.version, split)
+            write_shards(data, out_dir, shard_size)
+            print(f"Wrote {split} shards of {self.dset} to {out_dir}")
+            return out_dir
 
-        
\ No newline at end of file
+    def close(self):
+            """
+            Public method
+            Drops the shared memory splits of this loader from the registry and, if the loader connected
+            to the server itself, releases them. A no-op without shared_data
+            """
+            if self._shared_data is None:
+                return
+            for key in self._shared_keys:
+                self._registry.pop(key)
+            if self._owns_client:
+                self._shared_data.close()
+            self._shared_keys = []
+
+    def download_all(self, splits=("train", "test", "labels")):
+            """
+            Public method
+            Downloads the training data, testing data and labels of dset concurrently
+            Files that are already downloaded are skipped
+            Args:
+                splits: Splits to download, a subset of train, test and labels. Default all three
+            """
+            self._make_dir()
+            jobs = []
+            keys = {"train": (self.dset, self._url_map_tr),
+                    "test": (f"{self.dset}_te", self._url_map_te),
+                    "labels": (f"{self.dset}_y_te", self._url_map_labels)}
+            for key, url_map in (keys[split] for split in splits):
+                path = os.path.join(self._data_dir, f"{key}{self._get_ext(key)}")
+                if not os.path.exists(path):
+                    jobs.append((url_map[key], path, self._checksums.get(key)))
+            if jobs:
+                print(f"Downloading {len(jobs)} files for {self.dset}")
+                self._downloader.download_all(jobs)
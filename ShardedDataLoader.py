@@ -0,0 +1,166 @@
+from DataLoader import DataLoader
+from data_utils import read_manifest, sha256_file, shard_dir
+import os
+import numpy as np
+import tensorflow as tf
+
+
+class ShardedDataLoader(DataLoader):
+
+    """
+    ShardedDataLoader subclass
+    Inherits from DataLoader superclass
+    Streams a dataset stored as fixed-size .npy shards plus a manifest.json (see data_utils.write_shards)
+    Shards are memory-mapped and read with interleaving, so the dataset never has to fit in memory.
+    Workers with different worker_index read disjoint subsets of the shards.
+    Args:
+        dset: Name of dataset being loaded. (mnist_bw,mnist_color)
+        version: Version of mnist_color. (m0,m1,m2,m3,m4)
+        num_workers: Number of workers sharing the shards. Default 1
+        worker_index: Index of this worker in [0,num_workers). Default 0
+        verify: If True the SHA-256 of every shard is checked against the manifest when loading
+    Attributes:
+        dset: Name of dataset being loaded. (mnist_bw,mnist_color)
+        version: Version of mnist_color. (m0,m1,m2,m3,m4)
+        num_workers: Number of workers sharing the shards
+        worker_index: Index of this worker
+        verify: Whether checksums are verified
+        _manifest: The manifest of the split that was loaded last
+
+        Attributes Inherited from DataLoader:
+        _data: Paths of the shards assigned to this worker
+        _data_dir: Directory where the data is stored
+        _ext: Extension of the shards (.npy)
+        _file_name: Path of the manifest relative to _data_dir
+        _file_path: The path of the manifest
+    """
+    def __init__(self, dset, version=None, num_workers=1, worker_index=0, verify=False):
+        super().__init__(dset)
+        if not 0 <= worker_index < num_workers:
+            raise ValueError(f"worker_index must be in [0,{num_workers}), got {worker_index}")
+        self.version = version
+        self.num_workers = num_workers
+        self.worker_index = worker_index
+        self.verify = verify
+        self._ext = self._get_ext()
+        self._manifest = None
+
+    def _get_ext(self):
+        """
+        Private method
+        Shards are always stored as .npy
+        """
+        return ".npy"
+
+    def shard_dir(self, split):
+        """
+        Public method
+        Directory holding the shards and manifest of split
+        """
+        return shard_dir(self._data_dir, self.dset, self.version, split)
+
+    def has_manifest(self, split):
+        """
+        Public method
+        True if the shards of split have been written, i.e. its manifest exists
+        """
+        return os.path.exists(os.path.join(self.shard_dir(split), "manifest.json"))
+
+    def _download_data(self):
+        """
+        Private method
+        Shards are produced locally by MnistDataLoader.export_shards, so only check that the manifest exists
+        """
+        if not os.path.exists(self._file_path):
+            raise FileNotFoundError(
+                f"No manifest at {self._file_path}, create the shards with MnistDataLoader.export_shards"
+            )
+
+    def _load_data(self, split):
+        """
+        Private method
+        Reads the manifest of split and selects the shards of this worker
+        Checks that every shard exists and, if verify is set, that its checksum matches
+        """
+        directory = self.shard_dir(split)
+        self._file_name = os.path.relpath(os.path.join(directory, "manifest.json"), self._data_dir)
+        self._download_data()
+        self._manifest = read_manifest(self._file_path)
+
+        paths = []
+        for shard in self._manifest["shards"][self.worker_index::self.num_workers]:
+            path = os.path.join(directory, shard["file"])
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Shard {path} listed in the manifest is missing")
+            if self.verify and sha256_file(path) != shard["sha256"]:
+                raise ValueError(f"Checksum mismatch for shard {path}")
+            paths.append(path)
+        if not paths:
+            raise ValueError(f"Worker {self.worker_index} of {self.num_workers} has no shards in {directory}")
+        self._data = paths
+
+    def _transform_data(self, x):
+        """
+        Private method
+        Maps uint8 shards back to float32 in [0,1], float32 shards are passed through
+        """
+        if x.dtype == tf.uint8:
+            return tf.cast(x, tf.float32) / 255.0
+        return x
+
+    @tf.autograph.experimental.do_not_convert
+    def _read_shard(self, path, block_size=1024):
+        """
+        Private method
+        Dataset of the examples in one memory-mapped shard, read in blocks of block_size
+        """
+        def read_blocks(path):
+            shard = np.load(path.decode(), mmap_mode="r")
+            for start in range(0, len(shard), block_size):
+                yield shard[start:start + block_size]
+
+        spec = tf.TensorSpec(shape=[None] + self._manifest["element_shape"],
+                             dtype=tf.as_dtype(self._manifest["dtype"]))
+        return tf.data.Dataset.from_generator(read_blocks, output_signature=spec, args=(path,)).unbatch()
+
+    def _stream(self, batch_size, shuffle, shuffle_buffer, cycle_length, drop_remainder=False):
+        """
+        Private method
+        Interleaves the shards of this worker into batches of normalized examples
+        """
+        paths = tf.data.Dataset.from_tensor_slices(self._data)
+        if shuffle:
+            paths = paths.shuffle(len(self._data))
+        data = paths.interleave(self._read_shard, cycle_length=cycle_length,
+                                num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle)
+        if shuffle:
+            data = data.shuffle(buffer_size=shuffle_buffer)
+        data = data.batch(batch_size, drop_remainder=drop_remainder).map(self._transform_data, num_parallel_calls=tf.data.AUTOTUNE)
+        return data.prefetch(tf.data.AUTOTUNE)
+
+    def get_training_data(self, batch_size=256, shuffle_buffer=8192, cycle_length=4, drop_remainder=False):
+        """
+        Public method
+        Implements the abstract method from DataLoader superclass
+        Streams the training shards of this worker in shuffled batches
+        Args:
+            batch_size: Default value 256
+            shuffle_buffer: Number of elements in the shuffle window. Default 8192
+            cycle_length: Number of shards read concurrently. Default 4
+            drop_remainder: If True drop the last incomplete batch, so every batch has a static shape
+        """
+        self._load_data("train")
+        return self._stream(batch_size, True, shuffle_buffer, cycle_length, drop_remainder)
+
+    def get_testing_data(self, batch_size=None):
+        """
+        Public method
+        Implements the abstract method from DataLoader superclass
+        Retrieves the testing data in order. As a single float32 NumPy array when batch_size is None,
+        like MnistDataLoader, otherwise as a streamed dataset of batches
+        """
+        self._load_data("test")
+        if batch_size is None:
+            x = np.concatenate([np.load(path, mmap_mode="r") for path in self._data])
+            return x.astype(np.float32) / 255.0 if x.dtype == np.uint8 else x
+        return self._stream(batch_size, False, None, cycle_length=1)
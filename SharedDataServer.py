@@ -0,0 +1,325 @@
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.managers import BaseManager
+
+import numpy as np
+
+DEFAULT_ADDRESS = "127.0.0.1:50055"
+# Environment variable holding the hex authkey of the server. The manager unpickles what clients send,
+# so the key is random per server and only handed to the processes that should connect
+AUTHKEY_ENV = "SHARED_DATA_AUTHKEY"
+
+
+def authkey_from_env():
+    """
+    authkey_from_env function
+    Returns the authkey in SHARED_DATA_AUTHKEY, or None if it is not set
+    """
+    key = os.environ.get(AUTHKEY_ENV)
+    return bytes.fromhex(key) if key else None
+
+
+def parse_address(address):
+    """
+    parse_address function
+    "host:port" becomes a (host, port) TCP address, anything else is used as a Unix socket path
+    """
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def _alive(pid):
+    """
+    Private function
+    True if a process with pid exists on this node
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _ServerManager(BaseManager):
+    pass
+
+
+class _ClientManager(BaseManager):
+    pass
+
+
+_EXPOSED = ("acquire", "release", "stats")
+_ClientManager.register("SharedData")
+
+
+class SharedDataServer:
+    """
+    Class SharedDataServer
+    Node-local dataset service: every (dset, version, split, dtype) is loaded once by MnistDataLoader into a
+    multiprocessing.shared_memory segment, and processes on the node attach to it by name with SharedDataClient.
+    The service keeps a reference count per segment, by client pid. Segments of clients that exited without
+    releasing are reclaimed, and with evict_unused a segment is unlinked once no client holds it.
+    All segments are unlinked when the server stops.
+    Args:
+        address: "host:port" or a Unix socket path the service listens on. Default 127.0.0.1:50055
+        authkey: Key clients have to present. Defaults to SHARED_DATA_AUTHKEY, or a new random key
+        data_dir: Data directory of the loaders. Default ./data
+        evict_unused: If True unlink a segment when its last client releases it, otherwise keep it
+            until the server stops (useful when clients come and go, e.g. sweep trials). Default True
+        reap_seconds: Interval at which references of exited clients are dropped. Default 10
+    Attributes:
+        address, authkey, data_dir, evict_unused, reap_seconds: As in Args
+    """
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None, data_dir="./data", evict_unused=True,
+                 reap_seconds=10):
+        self.address = address
+        self.authkey = authkey or authkey_from_env() or os.urandom(32)
+        self.data_dir = data_dir
+        self.evict_unused = evict_unused
+        self.reap_seconds = reap_seconds
+        self._segments = {}
+        self._lock = threading.Lock()
+
+    def _load(self, key):
+        """
+        Private method
+        Loads key through MnistDataLoader into a new shared memory segment
+        """
+        from MnistDataLoader import MnistDataLoader
+        dset, version, split, dtype = key
+        loader = MnistDataLoader(dset=dset, version=version)
+        loader._data_dir = self.data_dir
+        loader.download_all()
+        data = loader._get_split(split, transform=split != "labels", dtype=np.dtype(dtype))
+        segment = shared_memory.SharedMemory(create=True, size=max(1, data.nbytes))
+        np.ndarray(data.shape, data.dtype, buffer=segment.buf)[...] = data
+        print(f"Loaded {key} into shared memory {segment.name} ({data.nbytes / 1024**2:.1f} MiB)")
+        return {"segment": segment, "shape": data.shape, "dtype": data.dtype.str, "clients": {}}
+
+    def _unlink(self, key):
+        """
+        Private method
+        Frees the segment of key
+        """
+        entry = self._segments.pop(key)
+        entry["segment"].close()
+        entry["segment"].unlink()
+        print(f"Unlinked {key}")
+
+    def _reap(self):
+        """
+        Private method
+        Drops the references of clients that exited without releasing
+        """
+        for key, entry in list(self._segments.items()):
+            for pid in [pid for pid in entry["clients"] if not _alive(pid)]:
+                del entry["clients"][pid]
+            if self.evict_unused and not entry["clients"]:
+                self._unlink(key)
+
+    def acquire(self, key, pid):
+        """
+        Public method
+        Adds a reference of process pid to key, loading it on first use
+        Args:
+            key: (dset, version, split, dtype name)
+            pid: Process id of the client
+        Returns:
+            (segment name, shape, dtype string) to attach to
+        """
+        key = tuple(key)
+        with self._lock:
+            self._reap()
+            if key not in self._segments:
+                self._segments[key] = self._load(key)
+            entry = self._segments[key]
+            entry["clients"][pid] = entry["clients"].get(pid, 0) + 1
+            return entry["segment"].name, entry["shape"], entry["dtype"]
+
+    def release(self, key, pid):
+        """
+        Public method
+        Removes a reference of process pid to key
+        """
+        key = tuple(key)
+        with self._lock:
+            entry = self._segments.get(key)
+            if entry is not None and pid in entry["clients"]:
+                entry["clients"][pid] -= 1
+                if not entry["clients"][pid]:
+                    del entry["clients"][pid]
+            self._reap()
+
+    def stats(self):
+        """
+        Public method
+        Dictionary of key to its segment name, size in bytes and reference count
+        """
+        with self._lock:
+            self._reap()
+            return {key: {"name": entry["segment"].name, "nbytes": entry["segment"].size,
+                          "refcount": sum(entry["clients"].values())}
+                    for key, entry in self._segments.items()}
+
+    def shutdown(self):
+        """
+        Public method
+        Unlinks every segment
+        """
+        with self._lock:
+            for key in list(self._segments):
+                self._unlink(key)
+
+    def _reap_forever(self):
+        """
+        Private method
+        Background loop reclaiming the segments of exited clients between requests
+        """
+        while True:
+            time.sleep(self.reap_seconds)
+            with self._lock:
+                self._reap()
+
+    def serve_forever(self):
+        """
+        Public method
+        Runs the service in this process until it is interrupted or terminated, then unlinks every segment
+        If the process is killed outright, its resource tracker still unlinks the segments it created
+        """
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        manager = _ServerManager(address=parse_address(self.address), authkey=self.authkey)
+        manager.register("SharedData", callable=lambda: self, exposed=_EXPOSED)
+        server = manager.get_server()
+        threading.Thread(target=self._reap_forever, daemon=True).start()
+        print(f"Serving shared data on {self.address}")
+        try:
+            server.serve_forever()
+        finally:
+            self.shutdown()
+
+
+def start_server(address=DEFAULT_ADDRESS, authkey=None, data_dir="./data", evict_unused=True, timeout=60):
+    """
+    start_server function
+    Starts a SharedDataServer in a background process and waits until it accepts clients
+    The server is a separate interpreter rather than a multiprocessing child, so it does not share the
+    resource tracker of this process, which the clients unregister the segments from
+    The authkey (a new random key by default) is passed to the server and set in SHARED_DATA_AUTHKEY of this
+    process, so SharedDataClients created here or in child processes started afterwards can connect
+    Returns:
+        The subprocess.Popen of the server, terminate() it to stop the server and free the segments
+    """
+    authkey = authkey or os.urandom(32)
+    os.environ[AUTHKEY_ENV] = authkey.hex()
+    argv = [sys.executable, os.path.abspath(__file__), "--address", address, "--data_dir", data_dir]
+    process = subprocess.Popen(argv + ([] if evict_unused else ["--keep_unused"]), env=dict(os.environ))
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            SharedDataClient(address, authkey).close()
+            return process
+        except (ConnectionError, FileNotFoundError):
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.terminate()
+                raise RuntimeError(f"Shared data server on {address} did not start")
+            time.sleep(0.2)
+
+
+class SharedDataClient:
+    """
+    Class SharedDataClient
+    Connects to a SharedDataServer and attaches its segments as read-only, zero-copy NumPy arrays
+    Args:
+        address: Address of the server. Default 127.0.0.1:50055
+        authkey: Key of the server. Defaults to SHARED_DATA_AUTHKEY
+    """
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None):
+        authkey = authkey or authkey_from_env()
+        if authkey is None:
+            raise ValueError(f"No authkey for the shared data server on {address}, set {AUTHKEY_ENV} "
+                             "to the key the server printed")
+        manager = _ClientManager(address=parse_address(address), authkey=authkey)
+        manager.connect()
+        self._service = manager.SharedData()
+        self._attached = {}
+
+    def attach(self, dset, version, split, dtype=np.float32):
+        """
+        Public method
+        Returns a read-only view of split (train, test or labels) of dset/version, loaded by the server on first use
+        Attaching the same split again returns the same view and takes no extra reference
+        """
+        key = (dset, version, split, np.dtype(dtype).name)
+        if key not in self._attached:
+            name, shape, dtype = self._service.acquire(key, os.getpid())
+            segment = shared_memory.SharedMemory(name=name)
+            # The server owns the segment, the resource tracker of this process must not unlink it at exit
+            resource_tracker.unregister(segment._name, "shared_memory")
+            view = np.ndarray(shape, np.dtype(dtype), buffer=segment.buf)
+            view.flags.writeable = False
+            self._attached[key] = (segment, view)
+        return self._attached[key][1]
+
+    def detach(self, dset, version, split, dtype=np.float32):
+        """
+        Public method
+        Releases the reference to a split. The mapping stays open while views of it are still in use
+        """
+        key = (dset, version, split, np.dtype(dtype).name)
+        segment, _ = self._attached.pop(key)
+        try:
+            segment.close()
+        except BufferError:
+            pass
+        self._service.release(key, os.getpid())
+
+    def stats(self):
+        """
+        Public method
+        Segments of the server with their size and reference count
+        """
+        return self._service.stats()
+
+    def close(self):
+        """
+        Public method
+        Releases every attached split
+        """
+        for key in list(self._attached):
+            self.detach(*key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves datasets from shared memory to the loaders on this node")
+    parser.add_argument("--address", type=str, default=DEFAULT_ADDRESS)
+    parser.add_argument("--data_dir", type=str, default="./data")
+    parser.add_argument("--keep_unused", action="store_true")
+    args = parser.parse_args()
+    authkey = authkey_from_env()
+    if authkey is None:
+        authkey = os.urandom(32)
+        print(f"Clients connect with {AUTHKEY_ENV}={authkey.hex()} in their environment")
+    try:
+        SharedDataServer(args.address, authkey, args.data_dir, evict_unused=not args.keep_unused).serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
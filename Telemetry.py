@@ -0,0 +1,214 @@
+import json
+import os
+import resource
+import tensorflow as tf
+
+SINKS = ("jsonl", "tensorboard", "prometheus")
+
+
+def peak_rss_mb():
+    """
+    peak_rss_mb function
+    Peak resident set size of this process in MiB (ru_maxrss is in KiB on Linux)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def parse_profile_steps(text):
+    """
+    parse_profile_steps function
+    Parses "a:b" into the step window (a, b), profiling steps a up to but not including b
+    """
+    try:
+        start, stop = (int(part) for part in text.split(":"))
+    except ValueError:
+        raise ValueError(f"Expected a step window a:b, got '{text}'")
+    if not 0 <= start < stop:
+        raise ValueError(f"Expected 0 <= a < b in the step window a:b, got '{text}'")
+    return start, stop
+
+
+class JsonlSink:
+    """
+    Class JsonlSink
+    Appends every record as one JSON line to path
+    """
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "a")
+
+    def write(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class TensorBoardSink:
+    """
+    Class TensorBoardSink
+    Writes the numeric fields of every record as TensorBoard scalars named <event>/<field>
+    """
+    def __init__(self, logdir):
+        self._writer = tf.summary.create_file_writer(logdir)
+
+    def write(self, record):
+        with self._writer.as_default(step=record["step"]):
+            for name, value in record.items():
+                if name != "step" and isinstance(value, (int, float)):
+                    tf.summary.scalar(f"{record['event']}/{name}", value)
+        if record["event"] == "epoch":
+            self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+
+
+class PrometheusSink:
+    """
+    Class PrometheusSink
+    Keeps the latest value of every numeric field as a gauge vae_<event>_<field> and rewrites path
+    in the Prometheus text format (for the node_exporter textfile collector) after every record.
+    The file is replaced atomically, so a scrape never reads a partial file
+    """
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._gauges = {}
+
+    def write(self, record):
+        for name, value in record.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self._gauges[f"vae_{record['event']}_{name}"] = value
+        lines = []
+        for name, value in sorted(self._gauges.items()):
+            lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        pass
+
+
+def make_sinks(directory, names=SINKS):
+    """
+    make_sinks function
+    Creates the sinks in names writing to directory: metrics.jsonl, tensorboard/ and metrics.prom
+    """
+    factories = {
+        "jsonl": lambda: JsonlSink(os.path.join(directory, "metrics.jsonl")),
+        "tensorboard": lambda: TensorBoardSink(os.path.join(directory, "tensorboard")),
+        "prometheus": lambda: PrometheusSink(os.path.join(directory, "metrics.prom")),
+    }
+    for name in names:
+        if name not in factories:
+            raise ValueError(f"Unknown sink '{name}', expected one of {SINKS}")
+    return [factories[name]() for name in names]
+
+
+class Telemetry:
+    """
+    Class Telemetry
+    Collects per-step training metrics from a TrainingEngine and forwards them to sinks.
+    Every step is split into input wait (time spent getting the batch from the dataset iterator) and
+    compute (train step up to the host sync on the loss). A step counts as input-stalled when the input wait
+    is more than stall_fraction of its wall time. Optionally captures a tf.profiler trace over a step window.
+    Args:
+        sinks: List of sinks with write(record) and close(), see make_sinks
+        log_every: Write a step record every log_every steps. Default 1
+        profile_steps: Optional (start, stop) window of global steps to be profiled, see parse_profile_steps
+        profile_dir: Log directory of the profiler trace, open it with TensorBoard's profile plugin
+        stall_fraction: Input wait fraction above which a step is counted as stalled. Default 0.5
+    Attributes:
+        step: Number of steps recorded so far
+    """
+    def __init__(self, sinks=(), log_every=1, profile_steps=None, profile_dir="profile", stall_fraction=0.5):
+        self.sinks = list(sinks)
+        self.log_every = log_every
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir
+        self.stall_fraction = stall_fraction
+        self.step = 0
+        self._profiling = False
+        self._reset_epoch()
+
+    def _reset_epoch(self):
+        """
+        Private method
+        Clears the totals of the current epoch
+        """
+        self._epoch = {"steps": 0, "samples": 0, "input_seconds": 0.0, "compute_seconds": 0.0, "stalled_steps": 0}
+
+    def _write(self, record):
+        for sink in self.sinks:
+            sink.write(record)
+
+    def before_step(self):
+        """
+        Public method
+        Starts the profiler at the first step of profile_steps
+        """
+        if self.profile_steps is not None and self.step == self.profile_steps[0] and not self._profiling:
+            tf.profiler.experimental.start(self.profile_dir)
+            self._profiling = True
+
+    def record_step(self, input_seconds, compute_seconds, samples, loss):
+        """
+        Public method
+        Records one train step and stops the profiler after the last step of profile_steps
+        """
+        step_seconds = input_seconds + compute_seconds
+        epoch = self._epoch
+        epoch["steps"] += 1
+        epoch["samples"] += samples
+        epoch["input_seconds"] += input_seconds
+        epoch["compute_seconds"] += compute_seconds
+        epoch["stalled_steps"] += input_seconds > self.stall_fraction * step_seconds
+        self.step += 1
+        if self._profiling and self.step >= self.profile_steps[1]:
+            tf.profiler.experimental.stop()
+            self._profiling = False
+            print(f"Saved profiler trace of steps {self.profile_steps[0]}:{self.profile_steps[1]} to {self.profile_dir}")
+        if self.step % self.log_every == 0:
+            self._write({
+                "event": "step", "step": self.step, "loss": loss, "step_seconds": step_seconds,
+                "input_seconds": input_seconds, "compute_seconds": compute_seconds,
+                "samples_per_sec": samples / step_seconds if step_seconds > 0 else 0.0,
+            })
+
+    def end_epoch(self, epoch, stats, trace_counts=None):
+        """
+        Public method
+        Writes the epoch record with the input/compute split, stalls, peak memory and trace counts
+        Returns the record
+        """
+        totals = self._epoch
+        busy = totals["input_seconds"] + totals["compute_seconds"]
+        record = {
+            "event": "epoch", "step": self.step, "epoch": epoch, "loss": stats["loss"],
+            "samples": stats["samples"], "seconds": stats["seconds"], "samples_per_sec": stats["samples_per_sec"],
+            "input_seconds": totals["input_seconds"], "compute_seconds": totals["compute_seconds"],
+            "input_fraction": totals["input_seconds"] / busy if busy > 0 else 0.0,
+            # Time outside input and compute: checkpoint hooks and Python overhead between steps
+            "host_seconds": max(stats["seconds"] - busy, 0.0),
+            "stalled_steps": totals["stalled_steps"], "peak_rss_mb": peak_rss_mb(),
+        }
+        for name, count in (trace_counts or {}).items():
+            record[f"traces_{name}"] = count
+        self._write(record)
+        self._reset_epoch()
+        return record
+
+    def close(self):
+        """
+        Public method
+        Stops a running profiler and closes the sinks
+        """
+        if self._profiling:
+            tf.profiler.experimental.stop()
+            self._profiling = False
+        for sink in self.sinks:
+            sink.close()
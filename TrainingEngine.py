@@ -0,0 +1,152 @@
+import time
+import tensorflow as tf
+
+
+class TrainingEngine:
+    """
+    Class TrainingEngine
+    Runs the training loop of a VAE with several train steps per Python dispatch.
+    Each execution is one tf.function that pulls up to steps_per_execution batches from a dataset
+    iterator in an on-device while loop, so the Python overhead is paid once per execution instead of once per batch.
+    The loss is accumulated in a Keras Mean metric on the device and only read at the end of an epoch.
+    Args:
+        model: VAE to be trained
+        optimizer: Optimizer applied in every step
+        steps_per_execution: Number of train steps per tf.function call. Default 1
+        train_step: Optional function taking a batch and returning the loss,
+            e.g. from VAE.make_train_step. Defaults to VAE._train_step with optimizer
+        strategy: tf.distribute strategy the model and optimizer were created under.
+            The train step runs once per replica and the dataset must come from distribute.distribute_dataset.
+            Defaults to the default (single replica) strategy
+        telemetry: Optional Telemetry. Timing single steps needs the batch fetched on the host and a sync
+            on the loss after every step, so with telemetry steps_per_execution is ignored and each step
+            is its own tf.function call
+    Attributes:
+        steps_per_execution: Number of train steps per tf.function call
+        loss_metric: Mean of the batch losses of the current epoch
+        samples: Number of samples seen in the current epoch
+    """
+    def __init__(self, model, optimizer, steps_per_execution=1, train_step=None, strategy=None, telemetry=None):
+        if steps_per_execution < 1:
+            raise ValueError(f"steps_per_execution must be at least 1, got {steps_per_execution}")
+        self.model = model
+        self.optimizer = optimizer
+        self.steps_per_execution = steps_per_execution
+        self.strategy = strategy if strategy is not None else tf.distribute.get_strategy()
+        self.telemetry = telemetry
+        self._train_step = train_step if train_step is not None else self._default_train_step
+        self.loss_metric = tf.keras.metrics.Mean(name="loss")
+        self.samples = tf.Variable(0, dtype=tf.int64, trainable=False)
+        # Creating the optimizer slots up front keeps variable creation out of the first trace
+        with self.strategy.scope():
+            optimizer.build(model.trainable_variables)
+        self._execution = tf.function(self._run_steps)
+        self._step = tf.function(self._run_batch, reduce_retracing=True)
+
+    def _default_train_step(self, x):
+        """
+        Private method
+        Plain train step, traced as part of the execution
+        """
+        return self.model._train_step(x, self.optimizer)
+
+    @staticmethod
+    def _batch_size(x):
+        """
+        Private method
+        Number of samples in the (per-replica) batch x
+        """
+        return tf.cast(tf.shape(x)[0], tf.int64)
+
+    def _run_batch(self, x):
+        """
+        Private method
+        Runs the train step on every replica and updates the epoch loss and sample count
+        Returns the global mean loss and the global batch size
+        """
+        # Each replica returns its share of the global mean loss, summing gives the global mean
+        loss = self.strategy.reduce(tf.distribute.ReduceOp.SUM, self.strategy.run(self._train_step, args=(x,)), axis=None)
+        batch_size = self.strategy.reduce(tf.distribute.ReduceOp.SUM, self.strategy.run(self._batch_size, args=(x,)), axis=None)
+        self.loss_metric.update_state(loss)
+        self.samples.assign_add(batch_size)
+        return loss, batch_size
+
+    def _run_steps(self, iterator):
+        """
+        Private method
+        Body of one execution. Runs up to steps_per_execution train steps and stops early when the iterator is exhausted
+        Returns the number of steps that were run
+        """
+        steps = tf.constant(0)
+        for _ in tf.range(self.steps_per_execution):
+            batch = iterator.get_next_as_optional()
+            if not batch.has_value():
+                break
+            self._run_batch(batch.get_value())
+            steps += 1
+        return steps
+
+    def _timed_steps(self, iterator, after_execution):
+        """
+        Private method
+        Runs the epoch one step per call, timing the wait for the next batch and the step up to the loss sync
+        """
+        telemetry = self.telemetry
+        while True:
+            telemetry.before_step()
+            start = time.perf_counter()
+            try:
+                x = next(iterator)
+            except StopIteration:
+                break
+            fetched = time.perf_counter()
+            loss, batch_size = self._step(x)
+            loss = float(loss.numpy())
+            telemetry.record_step(fetched - start, time.perf_counter() - fetched, int(batch_size.numpy()), loss)
+            if after_execution is not None:
+                after_execution(int(self.optimizer.iterations.numpy()))
+
+    def train_epoch(self, dataset, after_execution=None):
+        """
+        Public method
+        Trains for one pass over dataset
+        Args:
+            dataset: Dataset (or distributed dataset) of training batches
+            after_execution: Optional function called with the optimizer step count after every execution,
+                e.g. Checkpointer.maybe_save
+        Returns:
+            Dictionary with the mean batch loss, the number of samples, the wall time and the samples/sec of the epoch
+        """
+        self.loss_metric.reset_state()
+        self.samples.assign(0)
+        iterator = iter(dataset)
+        start = time.perf_counter()
+        if self.telemetry is not None:
+            self._timed_steps(iterator, after_execution)
+        else:
+            while True:
+                steps = int(self._execution(iterator))
+                if after_execution is not None and steps > 0:
+                    after_execution(int(self.optimizer.iterations.numpy()))
+                if steps < self.steps_per_execution:
+                    break
+        seconds = time.perf_counter() - start
+        samples = int(self.samples.numpy())
+        return {
+            "loss": float(self.loss_metric.result().numpy()),
+            "samples": samples,
+            "seconds": seconds,
+            "samples_per_sec": samples / seconds if seconds > 0 else 0.0,
+        }
+
+    def trace_counts(self):
+        """
+        Public method
+        Number of times the execution, the single step used with telemetry and, if it is a tf.function,
+        the train step were traced
+        """
+        counts = {"execution": self._execution.experimental_get_tracing_count(),
+                  "step": self._step.experimental_get_tracing_count()}
+        if hasattr(self._train_step, "experimental_get_tracing_count"):
+            counts["train_step"] = self._train_step.experimental_get_tracing_count()
+        return counts
@@ -1,7 +1,8 @@
+import numpy as np
 import tensorflow as tf
 from Encoder import Encoder
 from Decoder import Decoder
-from losses import kl_divergence,log_diag_mvn
+from losses import log_mean_exp, make_elbo, make_iwae_log_weights
 class VAE(tf.keras.Model):
     """
     Variational Autoencoder (VAE) CLASS
@@ -12,18 +13,30 @@ class VAE(tf.keras.Model):
 
     Args:
         Keras networks: encoder_network, decoder_network
+        objective: Training objective, "elbo" (default) or "iwae" for the importance-weighted bound
+        iwae_k: Number of importance samples per input for the iwae objective. Default 5
+        iwae_chunk: Number of importance samples decoded at once, None for all iwae_k
     Attributes: 
         vae_loss: Tensor, only set after first call()
         encoder: Encoder Object
         decoder: Decoder Object
+        objective, iwae_k, iwae_chunk: As in Args
     """
-    
-    def __init__(self, encoder_network, decoder_network):
+    OBJECTIVES = ("elbo", "iwae")
+
+    def __init__(self, encoder_network, decoder_network, objective="elbo", iwae_k=5, iwae_chunk=None):
         
         super().__init__()
+        if objective not in self.OBJECTIVES:
+            raise ValueError(f"Unknown objective '{objective}', expected one of {self.OBJECTIVES}")
 
         self.encoder = Encoder(encoder_network)
         self.decoder = Decoder(decoder_network)
+        self.objective = objective
+        self.iwae_k = iwae_k
+        self.iwae_chunk = iwae_chunk
+        self._elbo = None
+        self._iwae_log_weights = None
 
     @property
     def latent_dim(self):
@@ -33,35 +46,124 @@ class VAE(tf.keras.Model):
         """
         return self.encoder.latent_dim
 
+    def elbo_terms(self, x):
+        """
+        Computes the per-sample ELBO and its reconstruction (logp) and KL terms with the fused losses.make_elbo
+        The constants of the fused ELBO are built once, from the decoder's sigma_x and the input shape
+        Returns a tuple of (elbo, logp, kl), each of shape (batch,)
+        """
+        if self._elbo is None:
+            self._elbo = make_elbo(self.decoder.sigma_x, x.shape[1:])
+        z,z_mu, z_logvar = self.encoder(x)
+        mu_x = self.decoder.mean(z)
+        return self._elbo(x, mu_x, z_mu, z_logvar)
+
+    def iwae_terms(self, x, k=None, chunk_size=None):
+        """
+        Computes the importance-weighted bound log 1/K sum_k p(x, z_k)/q(z_k|x) with K samples per input
+        The encoder runs once, the K*batch latent samples are decoded in one call per chunk of chunk_size samples.
+        With chunks the bound is accumulated with a running log-sum-exp in a tf.while_loop, so only one chunk
+        of decoder activations is alive at a time during evaluation
+        Args:
+            x: Batch of inputs
+            k: Number of importance samples, defaults to iwae_k
+            chunk_size: Samples decoded at once, defaults to iwae_chunk or k
+        Returns:
+            Tuple of (iwae, elbo), both of shape (batch,). elbo is the K-sample average of the log weights
+        """
+        k = k or self.iwae_k
+        chunk_size = min(chunk_size or self.iwae_chunk or k, k)
+        if self._iwae_log_weights is None:
+            self._iwae_log_weights = make_iwae_log_weights(self.decoder.sigma_x, x.shape[1:])
+        mu_z, logvar_z = self.encoder.moments(x)
+        sigma_z = tf.math.exp(0.5*logvar_z)
+        batch, latent_dim = tf.shape(mu_z)[0], mu_z.shape[-1]
+        mu_x_shape = tf.concat([[-1, batch], tf.shape(x)[1:]], axis=0)
+
+        def log_weights(size):
+            eps = tf.random.normal(tf.stack([size, batch, latent_dim]))
+            z = mu_z[None] + sigma_z[None]*eps
+            mu_x = tf.reshape(self.decoder.mean(tf.reshape(z, [-1, latent_dim])), mu_x_shape)
+            return self._iwae_log_weights(x, mu_x, z, eps, logvar_z)
+
+        if chunk_size == k:
+            log_w = log_weights(k)
+            return log_mean_exp(log_w), tf.reduce_mean(log_w, axis=0)
+
+        def body(start, max_w, sum_w, total):
+            log_w = log_weights(tf.minimum(chunk_size, k - start))
+            new_max = tf.maximum(max_w, tf.reduce_max(log_w, axis=0))
+            sum_w = sum_w*tf.math.exp(max_w - new_max) + tf.reduce_sum(tf.math.exp(log_w - new_max), axis=0)
+            return start + chunk_size, new_max, sum_w, total + tf.reduce_sum(log_w, axis=0)
+
+        init = (tf.constant(0), tf.fill([batch], -np.inf), tf.zeros([batch]), tf.zeros([batch]))
+        _, max_w, sum_w, total = tf.while_loop(lambda start, *_: start < k, body, init)
+        return max_w + tf.math.log(sum_w) - np.log(k), total / k
+
     def call(self, x):
         """
         Overrides call() from tf.keras.Model 
-        Uses outputs from encoder and decoder objects to compute ELBO
-        Returns the negative ELBO
+        Uses outputs from encoder and decoder objects to compute ELBO, or the IWAE bound with objective "iwae"
+        Returns the negative bound, averaged over the global batch when called in a tf.distribute replica
         """
-        z,z_mu, z_logvar = self.encoder(x)
-        _,mu_x,x_logsigma = self.decoder(z)
-        kl_div = kl_divergence(z_mu,z_logvar)
-        logp = log_diag_mvn(x,mu_x,x_logsigma)
-        
-        elbo = logp -kl_div
-        self.vae_loss = -tf.reduce_mean(elbo)
+        if self.objective == "iwae":
+            bound, _ = self.iwae_terms(x)
+        else:
+            bound, _, _ = self.elbo_terms(x)
+        self.vae_loss = tf.nn.compute_average_loss(-bound)
         return self.vae_loss
     
     
+    def _train_step(self, x, optimizer):
+        """
+        Private method
+        One optimization step on the batch x, shared by train() and make_train_step()
+        With a LossScaleOptimizer (mixed_float16) the loss is scaled before and the gradients unscaled after differentiation
+        """
+        loss_scaled = isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+        with tf.GradientTape() as tape:
+            loss = self.call(x)
+            scaled_loss = optimizer.get_scaled_loss(loss) if loss_scaled else loss
+        gradients = tape.gradient(scaled_loss, self.trainable_variables)
+        if loss_scaled:
+            gradients = optimizer.get_unscaled_gradients(gradients)
+        optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+
+        return loss
+
     @tf.function
     def train(self, x, optimizer):
         """
         Training function
         Uses a decorator @tf.function to enhance training perfomance.
+        Retraced for every new batch shape, see make_train_step for a single trace
         Returns the loss for visualizations or logging progress
         """
-        with tf.GradientTape() as tape:
-            loss = self.call(x)
-        gradients = tape.gradient(self.vae_loss, self.trainable_variables)
-        optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+        return self._train_step(x, optimizer)
+
+    def make_train_step(self, optimizer, batch_shape, jit_compile=False):
+        """
+        Builds a train step bound to optimizer with a fixed input_signature
+        The step is traced (and with jit_compile XLA-compiled) once for batch_shape and never retraced,
+        so the dataset must yield batches of exactly that shape (drop_remainder=True).
+        The optimizer slots are created up front, XLA cannot create variables inside a compiled function
+        Args:
+            optimizer: Optimizer applied in every step
+            batch_shape: Static shape of a batch, including the batch size
+            jit_compile: If True compile the step with XLA
+        Returns:
+            tf.function taking a batch and returning the loss. experimental_get_tracing_count() reports its traces
+        """
+        if None in tuple(batch_shape):
+            raise ValueError(f"batch_shape must be fully static, got {batch_shape}. Batch with drop_remainder=True")
+        optimizer.build(self.trainable_variables)
+
+        @tf.function(input_signature=[tf.TensorSpec(batch_shape, tf.float32)], jit_compile=jit_compile)
+        def train_step(x):
+            return self._train_step(x, optimizer)
+
+        return train_step
 
-        return loss 
     def sample_z(self,x):
         """
         Helper method
@@ -83,8 +185,7 @@ class VAE(tf.keras.Model):
         Helper method
         Samples a reconstruction mu_x. Useful for visualizing sharper reconstructions 
         """
-        _,mu_x,_ = self.decoder(z)
-        return mu_x
+        return self.decoder.mean(z)
     def reconstruct_noisy(self,z):
         """
         Helper method
@@ -0,0 +1,124 @@
+"""
+Micro-benchmark of the ELBO: the separate log_diag_mvn + kl_divergence path against the fused losses.make_elbo
+Every (network, path) pair runs in a fresh process, so the traced functions and allocator state of one do not
+leak into the other.
+Memory is the total size of the intermediate tensors in the graph of the step, RSS is dominated by the
+TensorFlow runtime and hides the difference between the paths. On a GPU the allocator peak is reported as well.
+Usage: python benchmarks/bench_elbo.py [--batch_size 256] [--steps 200]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+NETWORKS = ("mlp", "conv")
+PATHS = ("separate", "fused")
+# Ops whose outputs are inputs, weights or aliases of other tensors rather than new allocations
+NO_ALLOCATION = {"Placeholder", "Const", "ReadVariableOp", "VarHandleOp", "Identity", "IdentityN", "Reshape",
+                 "Squeeze", "ExpandDims", "StopGradient", "NoOp", "Shape", "ShapeN", "Size", "Rank"}
+
+
+def intermediate_bytes(graph):
+    """
+    intermediate_bytes function
+    Total size in bytes of the tensors the ops of graph allocate, and their number
+    It is an upper bound of the live memory of one step: tensors freed early are counted as well
+    """
+    total, count = 0, 0
+    for op in graph.get_operations():
+        if op.type in NO_ALLOCATION:
+            continue
+        for tensor in op.outputs:
+            if tensor.dtype.is_numpy_compatible and tensor.shape.is_fully_defined():
+                total += tensor.shape.num_elements() * tensor.dtype.size
+                count += 1
+    return total, count
+
+
+def run_case(network, path, batch_size, steps, warmup):
+    """
+    run_case function
+    Times one gradient step of the VAE loss computed with path and returns step time and the memory it allocates
+    """
+    import numpy as np
+    import tensorflow as tf
+    from VAE import VAE
+    from losses import kl_divergence, log_diag_mvn
+    from nn import build_networks
+
+    model = VAE(*build_networks("mnist_bw" if network == "mlp" else "mnist_color"))
+    shape = (batch_size,) + tuple(model.encoder.neural_net.input_shape[1:])
+    x = tf.constant(np.random.rand(*shape).astype(np.float32))
+
+    def separate_loss(x):
+        z, mu_z, logvar_z = model.encoder(x)
+        _, mu_x, logsigma_x = model.decoder(z)
+        elbo = log_diag_mvn(x, mu_x, logsigma_x) - kl_divergence(mu_z, logvar_z)
+        return -tf.reduce_mean(elbo)
+
+    def fused_loss(x):
+        elbo, _, _ = model.elbo_terms(x)
+        return -tf.reduce_mean(elbo)
+
+    loss_fn = separate_loss if path == "separate" else fused_loss
+
+    @tf.function
+    def step(x):
+        with tf.GradientTape() as tape:
+            loss = loss_fn(x)
+        return tape.gradient(loss, model.trainable_variables)
+
+    total, count = intermediate_bytes(step.get_concrete_function(x).graph)
+    gpu = bool(tf.config.list_logical_devices("GPU"))
+    for _ in range(warmup):
+        step(x)
+    if gpu:
+        tf.config.experimental.reset_memory_stats("GPU:0")
+    start = time.perf_counter()
+    for _ in range(steps):
+        grads = step(x)
+    grads[0].numpy()
+    seconds = time.perf_counter() - start
+    result = {
+        "network": network,
+        "path": path,
+        "batch_size": batch_size,
+        "ms_per_step": 1e3 * seconds / steps,
+        "intermediate_mb": total / 1024**2,
+        "intermediate_tensors": count,
+    }
+    if gpu:
+        result["gpu_peak_mb"] = tf.config.experimental.get_memory_info("GPU:0")["peak"] / 1024**2
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the separate against the fused ELBO")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--case", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        network, path = args.case.split(":")
+        print(json.dumps(run_case(network, path, args.batch_size, args.steps, args.warmup)))
+        return
+
+    results = []
+    for network in NETWORKS:
+        for path in PATHS:
+            output = subprocess.run(
+                [sys.executable, __file__, "--case", f"{network}:{path}", "--batch_size", str(args.batch_size),
+                 "--steps", str(args.steps), "--warmup", str(args.warmup)],
+                check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
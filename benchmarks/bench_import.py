@@ -0,0 +1,52 @@
+"""
+Import-time benchmark. Every case runs in a fresh interpreter and the median wall time over --repeats runs is reported
+Cases cover importing nn.py, building only the selected networks against the four legacy globals,
+importing plot_utils and the startup of train_vae.py (--help parses the arguments after all imports)
+Usage: python benchmarks/bench_import.py [--repeats 5]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = {
+    "import tensorflow": ["-c", "import tensorflow"],
+    "import nn": ["-c", "import nn"],
+    "build mnist_bw networks": ["-c", "import nn; nn.build_networks('mnist_bw')"],
+    "legacy nn globals": ["-c", "from nn import encoder_mlp, decoder_mlp, encoder_conv, decoder_conv"],
+    "import plot_utils": ["-c", "import plot_utils"],
+    "train_vae.py --help": [os.path.join(REPO_DIR, "train_vae.py"), "--help"],
+}
+
+
+def time_case(argv, repeats):
+    """
+    time_case function
+    Median wall time of running the interpreter with argv in REPO_DIR
+    """
+    env = dict(os.environ, TF_CPP_MIN_LOG_LEVEL="3", MPLBACKEND="Agg")
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + argv, cwd=REPO_DIR, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the import and startup time of the project modules")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    results = [{"case": name, "seconds": time_case(argv, args.repeats)} for name, argv in CASES.items()]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
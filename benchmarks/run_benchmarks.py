@@ -0,0 +1,295 @@
+"""
+Benchmark suite for data loading, training and inference throughput on synthetic MNIST-shaped data
+Every benchmark is repeated and the median is reported. Results are written as JSON with environment metadata.
+Usage:
+    python benchmarks/run_benchmarks.py --out results.json [--quick] [--suites loader,train,inference,tsne,render]
+    python benchmarks/run_benchmarks.py --out results.json --baseline baseline.json [--threshold 0.1]
+    python benchmarks/run_benchmarks.py --compare baseline.json results.json [--threshold 0.1]
+With a baseline the exit code is 1 when any benchmark regressed by more than threshold (relative)
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import numpy as np
+import tensorflow as tf
+
+from synthetic import write_synthetic_data
+
+SUITES = ("loader", "train", "inference", "tsne", "render")
+
+
+def environment():
+    """
+    environment function
+    Metadata of the machine and library versions, stored with the results so runs can be compared fairly
+    """
+    try:
+        commit = subprocess.run(["git", "-C", REPO_DIR, "rev-parse", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    try:
+        import sklearn
+        sklearn_version = sklearn.__version__
+    except ImportError:
+        sklearn_version = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": commit,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "tensorflow": tf.__version__,
+        "sklearn": sklearn_version,
+        "intra_op_threads": tf.config.threading.get_intra_op_parallelism_threads(),
+        "inter_op_threads": tf.config.threading.get_inter_op_parallelism_threads(),
+    }
+
+
+def result(name, value, unit, higher_is_better=True, **extra):
+    return {"name": name, "value": value, "unit": unit, "higher_is_better": higher_is_better, **extra}
+
+
+def median_time(fn, repeats):
+    """
+    median_time function
+    Median wall time of repeats calls of fn
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def bench_loader(args, work_dir):
+    """
+    bench_loader function
+    Time to the first batch and one full epoch of MnistDataLoader, cold (preprocessed cache missing)
+    and warm (cache on disk, new loader instance), for the in-memory and the streaming pipeline
+    """
+    from MnistDataLoader import MnistDataLoader
+
+    raw_dir = write_synthetic_data(os.path.join(work_dir, "raw"), args.n_train, args.n_test, dsets=("mnist_bw",))
+    results = []
+    for streaming in (False, True):
+        pipeline = "streaming" if streaming else "in_memory"
+        for start in ("cold", "warm"):
+            first_batch, epoch = [], []
+            for _ in range(args.repeats):
+                data_dir = os.path.join(work_dir, "loader")
+                if start == "cold" or not os.path.exists(data_dir):
+                    shutil.rmtree(data_dir, ignore_errors=True)
+                    shutil.copytree(raw_dir, data_dir)
+                loader = MnistDataLoader("mnist_bw")
+                loader._data_dir = data_dir
+                begin = time.perf_counter()
+                iterator = iter(loader.get_training_data(batch_size=256, streaming=streaming))
+                next(iterator)
+                first_batch.append(time.perf_counter() - begin)
+                for _ in iterator:
+                    pass
+                epoch.append(time.perf_counter() - begin)
+            results.append(result(f"loader/{pipeline}/{start}_first_batch", float(np.median(first_batch)), "s",
+                                  higher_is_better=False))
+            results.append(result(f"loader/{pipeline}/{start}_epoch", args.n_train / float(np.median(epoch)),
+                                  "examples/sec"))
+    return results
+
+
+def networks(dset):
+    from network_selecter import network_selecter
+    return network_selecter(dset)
+
+
+def bench_train(args, work_dir):
+    """
+    bench_train function
+    Train steps/sec of the MLP (mnist_bw) and conv (mnist_color) VAEs at every batch size in --batch_sizes
+    """
+    from VAE import VAE
+
+    results = []
+    for name, dset in (("mlp", "mnist_bw"), ("conv", "mnist_color")):
+        model = VAE(*networks(dset))
+        optimizer = tf.keras.optimizers.Adam(learning_rate=1e-3)
+        input_shape = tuple(model.encoder.neural_net.input_shape[1:])
+        for batch_size in args.batch_sizes:
+            x = tf.constant(np.random.rand(batch_size, *input_shape).astype(np.float32))
+            for _ in range(args.warmup):
+                model.train(x, optimizer)
+
+            def steps():
+                for _ in range(args.steps):
+                    loss = model.train(x, optimizer)
+                loss.numpy()
+
+            seconds = median_time(steps, args.repeats)
+            results.append(result(f"train/{name}/bs{batch_size}", args.steps / seconds, "steps/sec",
+                                  samples_per_sec=args.steps * batch_size / seconds))
+    return results
+
+
+def bench_inference(args, work_dir):
+    """
+    bench_inference function
+    encode_mean and decode_mean throughput of the InferenceEngine for both VAEs
+    """
+    from VAE import VAE
+    from InferenceEngine import InferenceEngine
+
+    results = []
+    for name, dset in (("mlp", "mnist_bw"), ("conv", "mnist_color")):
+        model = VAE(*networks(dset))
+        engine = InferenceEngine(model, batch_size=1024)
+        x = np.random.rand(args.n_test, *model.encoder.neural_net.input_shape[1:]).astype(np.float32)
+        z = engine.predict("encode_mean", x[:1024])
+        z = np.random.randn(args.n_test, z.shape[1]).astype(np.float32)
+        for method, inputs in (("encode_mean", x), ("decode_mean", z)):
+            engine.predict(method, inputs[:1024])
+            seconds = median_time(lambda: engine.predict(method, inputs), args.repeats)
+            results.append(result(f"inference/{name}/{method}", len(inputs) / seconds, "examples/sec"))
+    return results
+
+
+def bench_tsne(args, work_dir):
+    """
+    bench_tsne function
+    Time of the t-SNE used by plot_utils.plot_latent on random 20-dimensional embeddings
+    """
+    from projection import tsne
+
+    z = np.random.randn(args.n_tsne, 20).astype(np.float32)
+    seconds = median_time(lambda: tsne(z, seed=0), max(1, args.repeats // 2))
+    return [result(f"tsne/n{args.n_tsne}", seconds, "s", higher_is_better=False)]
+
+
+def bench_render(args, work_dir):
+    """
+    bench_render function
+    Time of writing a 100 image grid as a PNG mosaic with plot_utils.save_mosaic
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    from plot_utils import save_mosaic
+
+    results = []
+    for dset, shape in (("mnist_bw", (100, 784)), ("mnist_color", (100, 28, 28, 3))):
+        x = np.random.rand(*shape).astype(np.float32)
+        path = os.path.join(work_dir, f"{dset}.png")
+        save_mosaic(x, path, dset)
+        seconds = median_time(lambda: save_mosaic(x, path, dset), args.repeats)
+        results.append(result(f"render/{dset}/grid100", seconds, "s", higher_is_better=False))
+    return results
+
+
+BENCHMARKS = {"loader": bench_loader, "train": bench_train, "inference": bench_inference, "tsne": bench_tsne,
+              "render": bench_render}
+
+
+def compare(baseline, current, threshold):
+    """
+    compare function
+    Compares two result files by benchmark name
+    Returns a list of rows with the relative change (positive is better) and whether it is a regression
+    """
+    base = {row["name"]: row for row in baseline["results"]}
+    rows = []
+    for row in current["results"]:
+        if row["name"] not in base or base[row["name"]]["value"] == 0:
+            continue
+        old, new = base[row["name"]]["value"], row["value"]
+        change = (new - old) / old if row["higher_is_better"] else (old - new) / old
+        rows.append({"name": row["name"], "baseline": old, "current": new, "unit": row["unit"],
+                     "change": change, "regression": change < -threshold})
+    return rows
+
+
+def print_comparison(rows, threshold):
+    print(f"{'Benchmark':40s} {'Baseline':>12s} {'Current':>12s} {'Change':>8s}")
+    for row in rows:
+        flag = "  REGRESSION" if row["regression"] else ""
+        print(f"{row['name']:40s} {row['baseline']:12.4g} {row['current']:12.4g} {100*row['change']:+7.1f}%{flag}")
+    regressions = sum(row["regression"] for row in rows)
+    print(f"{regressions} of {len(rows)} benchmarks regressed by more than {100*threshold:.0f}%")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the benchmark suite on synthetic data")
+    parser.add_argument("--suites", type=str, default=",".join(SUITES))
+    parser.add_argument("--out", type=str, default=None)
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument("--compare", type=str, nargs=2, default=None, metavar=("BASELINE", "CURRENT"))
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--batch_sizes", type=str, default="64,256,1024")
+    parser.add_argument("--n_train", type=int, default=60000)
+    parser.add_argument("--n_test", type=int, default=10000)
+    parser.add_argument("--n_tsne", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as file:
+            baseline = json.load(file)
+        with open(args.compare[1]) as file:
+            current = json.load(file)
+        sys.exit(1 if print_comparison(compare(baseline, current, args.threshold), args.threshold) else 0)
+
+    if args.quick:
+        args.repeats, args.steps, args.batch_sizes = 1, 10, "256"
+        args.n_train, args.n_test, args.n_tsne = 5000, 2000, 500
+    args.batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+    suites = args.suites.split(",")
+    for suite in suites:
+        if suite not in BENCHMARKS:
+            parser.error(f"Unknown suite '{suite}', expected one of {SUITES}")
+
+    np.random.seed(args.seed)
+    tf.random.set_seed(args.seed)
+    config = {name: value for name, value in vars(args).items() if name not in ("out", "baseline", "compare")}
+    report = {"environment": environment(), "config": config, "results": []}
+    work_dir = tempfile.mkdtemp(prefix="vae_bench_")
+    try:
+        for suite in suites:
+            print(f"Running {suite} benchmarks", file=sys.stderr)
+            # The loaders print their progress, which would interleave with the JSON on stdout
+            with contextlib.redirect_stdout(io.StringIO()):
+                report["results"] += BENCHMARKS[suite](args, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Wrote {len(report['results'])} results to {args.out}", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        sys.exit(1 if print_comparison(compare(baseline, report, args.threshold), args.threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+"""
+Synthetic MNIST-shaped data in the layout MnistDataLoader downloads to, so the loaders run without network access
+"""
+import os
+import pickle
+import numpy as np
+
+VERSIONS = ("m0", "m1", "m2", "m3", "m4")
+
+
+def write_synthetic_data(data_dir, n_train=60000, n_test=10000, seed=0, dsets=("mnist_bw", "mnist_color")):
+    """
+    write_synthetic_data function
+    Writes random images with the shapes and dtypes of the downloaded files into data_dir:
+    mnist_bw as uint8 (n, 28, 28) .npy, mnist_color as a .pkl of float32 (n, 28, 28, 3) in [0, 1] per version,
+    and int64 labels for the test sets
+    Returns data_dir
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    for dset in dsets:
+        for suffix, n in (("", n_train), ("_te", n_test)):
+            if dset == "mnist_bw":
+                np.save(os.path.join(data_dir, f"{dset}{suffix}.npy"),
+                        rng.integers(0, 256, size=(n, 28, 28), dtype=np.uint8))
+            else:
+                versions = {version: rng.random((n, 28, 28, 3), dtype=np.float32) for version in VERSIONS}
+                with open(os.path.join(data_dir, f"{dset}{suffix}.pkl"), "wb") as file:
+                    pickle.dump(versions, file, protocol=pickle.HIGHEST_PROTOCOL)
+        np.save(os.path.join(data_dir, f"{dset}_y_te.npy"), rng.integers(0, 10, size=n_test, dtype=np.int64))
+    return data_dir
@@ -0,0 +1,388 @@
+"""
+Compression of a trained Encoder/Decoder for faster generation
+Post-training quantization to TFLite (dynamic range or static int8 calibrated on MnistDataLoader training images)
+and magnitude or channel pruning followed by a short fine-tune. Pruned networks can be quantized as well.
+Every variant is compared against the float model on the test set: reconstruction error delta,
+measured CPU latency of the compressed part and its size.
+Usage:
+    python compression.py --checkpoint_dir ck --dset mnist_color --quantize dynamic,int8
+    python compression.py --checkpoint_dir ck --prune channel --sparsity 0.5 --quantize int8 --json compression.json
+"""
+import argparse
+import gzip
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from export_model import export_saved_model, export_tflite
+
+PRUNING = ("none", "magnitude", "channel")
+QUANTIZATION = ("none", "float32", "dynamic", "int8")
+TARGETS = ("decoder", "encoder", "both")
+# Signature of export_model that runs each network
+SIGNATURE = {"encoder": "encode_mean", "decoder": "decode_mean"}
+
+_PRUNABLE = (tf.keras.layers.Dense, tf.keras.layers.Conv2D)
+# Layers that may sit between two pruned layers, they only move the channels around
+_PASS_THROUGH = (tf.keras.layers.Flatten, tf.keras.layers.Reshape)
+
+
+def _kernel_axes(layer):
+    """
+    Private function
+    (output channel axis, input channel axis) of the kernel of a Dense, Conv2D or Conv2DTranspose layer
+    """
+    if isinstance(layer, tf.keras.layers.Conv2DTranspose):
+        return 2, 3
+    if isinstance(layer, tf.keras.layers.Conv2D):
+        return 3, 2
+    return 1, 0
+
+
+def _networks(target):
+    """
+    Private function
+    Names of the networks covered by target
+    """
+    return ("encoder", "decoder") if target == "both" else (target,)
+
+
+def magnitude_prune(network, sparsity):
+    """
+    magnitude_prune function
+    Copies network and zeros the sparsity fraction of smallest-magnitude weights in every kernel
+    Returns:
+        The pruned copy and a list of (kernel, mask) pairs, used to keep the zeros during fine-tuning
+    """
+    pruned = tf.keras.models.clone_model(network)
+    pruned.set_weights(network.get_weights())
+    masks = []
+    for layer in pruned.layers:
+        if isinstance(layer, _PRUNABLE):
+            magnitude = np.abs(layer.kernel.numpy())
+            mask = tf.constant(magnitude > np.quantile(magnitude, sparsity), layer.kernel.dtype)
+            layer.kernel.assign(layer.kernel * mask)
+            masks.append((layer.kernel, mask))
+    return pruned, masks
+
+
+def channel_prune(network, sparsity):
+    """
+    channel_prune function
+    Structured pruning of a Sequential network: removes the sparsity fraction of output channels with the
+    smallest L1 norm from every Dense/Conv2D/Conv2DTranspose layer that feeds another one, directly or through
+    Flatten/Reshape (e.g. the Conv2D stack, Dense -> Reshape -> Conv2DTranspose). The next layer loses the matching
+    inputs, so the result is a smaller dense network. The output layer is never pruned
+    Returns:
+        New Sequential network with the pruned weights
+    """
+    layers = network.layers
+    configs = [layer.get_config() for layer in layers]
+    weights = [[w.numpy() for w in layer.weights] for layer in layers]
+    weighted = [i for i, layer in enumerate(layers) if isinstance(layer, _PRUNABLE)]
+    for i, j in zip(weighted, weighted[1:]):
+        between = range(i + 1, j)
+        if not all(isinstance(layers[k], _PASS_THROUGH) for k in between):
+            continue
+        producer, consumer = layers[i], layers[j]
+        out_axis, _ = _kernel_axes(producer)
+        _, in_axis = _kernel_axes(consumer)
+        # Channels are the last axis of the consumer's input, Flatten and Reshape keep them innermost
+        if isinstance(consumer, tf.keras.layers.Conv2D):
+            channels = weights[j][0].shape[in_axis]
+        else:
+            channels = weights[i][0].shape[out_axis]
+        out_size = weights[i][0].shape[out_axis]
+        reshapes = [k for k in between if isinstance(layers[k], tf.keras.layers.Reshape)]
+        if out_size % channels or any(configs[k]["target_shape"][-1] != channels for k in reshapes):
+            continue
+
+        kernel = weights[i][0]
+        scores = np.abs(kernel).sum(axis=tuple(a for a in range(kernel.ndim) if a != out_axis))
+        scores = scores.reshape(-1, channels).sum(axis=0)
+        keep = np.zeros(channels, bool)
+        keep[np.argsort(-scores)[:max(1, int(round(channels * (1 - sparsity))))]] = True
+
+        out_index = np.flatnonzero(keep[np.arange(out_size) % channels])
+        weights[i] = [np.take(w, out_index, axis=out_axis if w.ndim > 1 else 0) for w in weights[i]]
+        in_index = np.flatnonzero(keep[np.arange(weights[j][0].shape[in_axis]) % channels])
+        weights[j][0] = np.take(weights[j][0], in_index, axis=in_axis)
+        configs[i]["units" if isinstance(producer, tf.keras.layers.Dense) else "filters"] = len(out_index)
+        for k in reshapes:
+            configs[k]["target_shape"] = tuple(configs[k]["target_shape"][:-1]) + (int(keep.sum()),)
+
+    pruned = tf.keras.Sequential(
+        [tf.keras.layers.InputLayer(input_shape=network.input_shape[1:])]
+        + [type(layer).from_config(config) for layer, config in zip(layers, configs)],
+        name=f"{network.name}_pruned")
+    for layer, layer_weights in zip(pruned.layers, weights):
+        if layer_weights:
+            layer.set_weights(layer_weights)
+    return pruned
+
+
+def finetune(model, dataset, steps, learning_rate=1e-4, masks=()):
+    """
+    finetune function
+    Trains the trainable networks of model for steps batches of dataset, re-applying the pruning masks
+    after every step so pruned weights stay zero
+    Returns:
+        The loss of the last step
+    """
+    optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
+    loss = None
+    for x in dataset.repeat().take(steps):
+        loss = model.train(x, optimizer)
+        for kernel, mask in masks:
+            kernel.assign(kernel * mask)
+    return None if loss is None else float(loss)
+
+
+def quantize(model, out_dir, mode, calibration_x):
+    """
+    quantize function
+    Exports model with export_model and converts the mean signatures to TFLite
+    Args:
+        model: VAE to be converted
+        out_dir: Directory of the SavedModel and the .tflite files
+        mode: "float32", "dynamic" (int8 weights) or "int8" (int8 weights and activations)
+        calibration_x: Calibration images, the decoder is calibrated on their mu_z
+    Returns:
+        Dictionary of signature name to .tflite path
+    """
+    export_dir = os.path.join(out_dir, "saved_model")
+    export_saved_model(model, export_dir)
+    representative_data = {"encode_mean": calibration_x, "decode_mean": model.sample_zmean(calibration_x).numpy()}
+    return export_tflite(export_dir, out_dir=out_dir, quantize=None if mode == "float32" else mode,
+                         representative_data=representative_data, num_calibration=len(calibration_x))
+
+
+def tflite_function(path, num_threads=None):
+    """
+    tflite_function function
+    Loads a single-signature .tflite file and returns a function from a float32 batch to the output array
+    """
+    interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+    runner = interpreter.get_signature_runner()
+    input_name = next(iter(runner.get_input_details()))
+    output_name = next(iter(runner.get_output_details()))
+    return lambda x: runner(**{input_name: np.asarray(x, np.float32)})[output_name]
+
+
+def keras_functions(model):
+    """
+    keras_functions function
+    Compiled encode_mean/decode_mean functions of a VAE, with a dynamic batch dimension
+    """
+    input_shape = [None] + list(model.encoder.neural_net.input_shape[1:])
+    encode = tf.function(model.sample_zmean, input_signature=[tf.TensorSpec(input_shape, tf.float32)])
+    decode = tf.function(model.reconstruct_mean, input_signature=[tf.TensorSpec([None, model.latent_dim], tf.float32)])
+    return {"encoder": lambda x: encode(x).numpy(), "decoder": lambda z: decode(z).numpy()}
+
+
+def _batched(fn, x, batch_size):
+    """
+    Private function
+    Applies fn to x in batches of batch_size and concatenates the results
+    """
+    return np.concatenate([fn(x[start:start + batch_size]) for start in range(0, len(x), batch_size)])
+
+
+def _median_ms(fn, x, repeats, warmup=3):
+    """
+    Private function
+    Median wall time of fn(x) in milliseconds
+    """
+    for _ in range(warmup):
+        fn(x)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(x)
+        times.append(time.perf_counter() - start)
+    return 1e3 * float(np.median(times))
+
+
+def _size(blobs):
+    """
+    Private function
+    (raw bytes, gzip bytes) of a list of byte strings. gzip shows what zeroed weights save in storage
+    """
+    return sum(len(blob) for blob in blobs), sum(len(gzip.compress(blob)) for blob in blobs)
+
+
+def evaluate(functions, x, target, batch_size=256, repeats=20):
+    """
+    evaluate function
+    Reconstruction error on x and median latency of the target networks on one batch of batch_size
+    Args:
+        functions: Dictionary with "encoder" and "decoder" functions from keras_functions/tflite_function
+        x: Evaluation images
+        target: decoder, encoder or both, the part that is timed
+    Returns:
+        Dictionary with the reconstructions, their MSE and the latency
+    """
+    mu_z = _batched(functions["encoder"], x, batch_size)
+    x_hat = _batched(functions["decoder"], mu_z, batch_size)
+    inputs = {"encoder": x[:batch_size], "decoder": mu_z[:batch_size]}
+    ms = sum(_median_ms(functions[name], inputs[name], repeats) for name in _networks(target))
+    return {"x_hat": x_hat, "recon_mse": float(np.mean((x - x_hat) ** 2)), "ms_per_batch": ms}
+
+
+def compress(model, loader, target="decoder", prune="none", sparsity=0.5, quantization=("dynamic", "int8"),
+             finetune_steps=200, learning_rate=1e-4, batch_size=256, num_calibration=256, eval_examples=2000,
+             repeats=20, num_threads=None, out_dir="compressed"):
+    """
+    compress function
+    Builds the compressed variants of a trained VAE and compares each with the float model
+    The pruned model (if any) is fine-tuned with the other network frozen, then quantized with every mode
+    in quantization. Variants are: float, the pruned float model, and one TFLite model per quantization mode
+    Args:
+        model: Trained VAE, left unchanged
+        loader: MnistDataLoader of the dset, provides the calibration, fine-tuning and test data
+        target: decoder (default), encoder or both. Only the target networks are compressed and timed
+        prune: none, magnitude or channel
+        sparsity: Fraction of weights (magnitude) or channels (channel) removed. Default 0.5
+        quantization: Quantization modes, "none" is skipped
+        finetune_steps: Fine-tuning steps after pruning. Default 200
+        learning_rate: Fine-tuning learning rate. Default 1e-4
+        batch_size: Batch size for fine-tuning, evaluation and timing. Default 256
+        num_calibration: Training images used for static int8 calibration. Default 256
+        eval_examples: Test images the reconstruction error is computed on. Default 2000
+        repeats: Timed runs per variant, the median is reported. Default 20
+        num_threads: TFLite interpreter threads, defaults to the cores available to this process
+        out_dir: Directory of the exported models
+    Returns:
+        List of one dictionary per variant
+    """
+    from VAE import VAE
+
+    if target not in TARGETS or prune not in PRUNING:
+        raise ValueError(f"Expected target in {TARGETS} and prune in {PRUNING}, got '{target}', '{prune}'")
+    num_threads = num_threads or len(os.sched_getaffinity(0))
+    x = loader.get_testing_data()[:eval_examples]
+    calibration_x = next(iter(loader.get_training_data(batch_size=num_calibration))).numpy()
+    targets = _networks(target)
+
+    def weight_blobs(vae):
+        return [w.numpy().tobytes() for name in targets for w in getattr(vae, name).neural_net.weights]
+
+    def row(name, vae, functions, blobs, **extra):
+        result = evaluate(functions, x, target, batch_size, repeats)
+        size, gzip_size = _size(blobs)
+        return {"variant": name, "recon_mse": result["recon_mse"], "x_hat": result["x_hat"],
+                "ms_per_batch": result["ms_per_batch"], "examples_per_sec": 1e3 * batch_size / result["ms_per_batch"],
+                "params": int(sum(getattr(vae, n).neural_net.count_params() for n in targets)),
+                "size_bytes": size, "gzip_bytes": gzip_size, **extra}
+
+    rows = [row("float", model, keras_functions(model), weight_blobs(model))]
+    base = model
+    if prune != "none":
+        networks, masks = {}, []
+        for name in ("encoder", "decoder"):
+            network = getattr(model, name).neural_net
+            if name not in targets:
+                networks[name] = tf.keras.models.clone_model(network)
+                networks[name].set_weights(network.get_weights())
+                networks[name].trainable = False
+            elif prune == "magnitude":
+                networks[name], layer_masks = magnitude_prune(network, sparsity)
+                masks += layer_masks
+            else:
+                networks[name] = channel_prune(network, sparsity)
+        base = VAE(networks["encoder"], networks["decoder"])
+        loss = finetune(base, loader.get_training_data(batch_size=batch_size, drop_remainder=True),
+                        finetune_steps, learning_rate, masks)
+        print(f" Fine-tuned {prune}-pruned {target} for {finetune_steps} steps, loss = {loss}")
+        rows.append(row(f"{prune} {sparsity:g}", base, keras_functions(base), weight_blobs(base), finetune_loss=loss))
+
+    for mode in quantization:
+        if mode == "none":
+            continue
+        name = mode if base is model else f"{prune} {sparsity:g} + {mode}"
+        paths = quantize(base, os.path.join(out_dir, name.replace(" + ", "_").replace(" ", "_")), mode, calibration_x)
+        functions = keras_functions(base)
+        blobs = []
+        for network in targets:
+            functions[network] = tflite_function(paths[SIGNATURE[network]], num_threads)
+            with open(paths[SIGNATURE[network]], "rb") as file:
+                blobs.append(file.read())
+        rows.append(row(name, base, functions, blobs))
+
+    reference, x_float = rows[0], rows[0]["x_hat"]
+    for result in rows:
+        result["mse_delta"] = result["recon_mse"] - reference["recon_mse"]
+        result["output_rmse_vs_float"] = float(np.sqrt(np.mean((result.pop("x_hat") - x_float) ** 2)))
+        result["speedup"] = reference["ms_per_batch"] / result["ms_per_batch"]
+        result["size_reduction"] = reference["size_bytes"] / result["size_bytes"]
+    return rows
+
+
+def print_rows(rows, target, batch_size):
+    """
+    print_rows function
+    Prints the variants from compress as a table
+    """
+    print(f"\nCompressed {target} | latency of one batch of {batch_size}")
+    header = (f"{'Variant':24s} {'Recon MSE':>10s} {'MSE delta':>10s} {'RMSE vs f32':>11s} {'ms/batch':>9s} "
+              f"{'Speedup':>8s} {'Params':>9s} {'Size KiB':>9s} {'gzip KiB':>9s} {'Size red.':>9s}")
+    print(header)
+    print("-" * len(header))
+    for r in rows:
+        print(f"{r['variant']:24s} {r['recon_mse']:10.5f} {r['mse_delta']:+10.5f} {r['output_rmse_vs_float']:11.5f} "
+              f"{r['ms_per_batch']:9.3f} {r['speedup']:7.2f}x {r['params']:9d} {r['size_bytes']/1024:9.1f} "
+              f"{r['gzip_bytes']/1024:9.1f} {r['size_reduction']:8.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantizes and prunes a trained VAE and reports error, speed and size")
+    parser.add_argument("--checkpoint_dir", type=str, required=True)
+    parser.add_argument("--dset", type=str, default="mnist_bw")
+    parser.add_argument("--version", type=str, default="m1")
+    parser.add_argument("--target", type=str, default="decoder", choices=TARGETS)
+    parser.add_argument("--prune", type=str, default="none", choices=PRUNING)
+    parser.add_argument("--sparsity", type=float, default=0.5)
+    parser.add_argument("--quantize", type=str, default="dynamic,int8")
+    parser.add_argument("--finetune_steps", type=int, default=200)
+    parser.add_argument("--learning_rate", type=float, default=1e-4)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--num_calibration", type=int, default=256)
+    parser.add_argument("--eval_examples", type=int, default=2000)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--out_dir", type=str, default="compressed")
+    parser.add_argument("--json", type=str, default=None)
+    args = parser.parse_args()
+    quantization = [mode for mode in args.quantize.split(",") if mode]
+    if any(mode not in QUANTIZATION for mode in quantization):
+        parser.error(f"--quantize takes a comma-separated list of {QUANTIZATION}")
+    if args.dset == "mnist_bw":
+        args.version = None
+
+    from Checkpointer import Checkpointer
+    from MnistDataLoader import MnistDataLoader
+    from VAE import VAE
+    from network_selecter import network_selecter
+
+    model = VAE(*network_selecter(args.dset))
+    Checkpointer(args.checkpoint_dir, model).restore(required=True)
+    loader = MnistDataLoader(dset=args.dset, version=args.version)
+    loader.download_all()
+    rows = compress(model, loader, target=args.target, prune=args.prune, sparsity=args.sparsity,
+                    quantization=quantization, finetune_steps=args.finetune_steps, learning_rate=args.learning_rate,
+                    batch_size=args.batch_size, num_calibration=args.num_calibration,
+                    eval_examples=args.eval_examples, repeats=args.repeats, num_threads=args.num_threads,
+                    out_dir=args.out_dir)
+    print_rows(rows, args.target, args.batch_size)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"dset": args.dset, "version": args.version, "target": args.target, "variants": rows},
+                      file, indent=2)
+        print(f"\nWrote {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+
+def save_npy_atomic(path, array):
+    """
+    save_npy_atomic function
+    Writes array to path as a .npy file without ever exposing a half written file.
+    The array is written to a temporary file next to path and renamed into place,
+    so concurrent readers either see the complete file or no file at all.
+    Args:
+        path: Destination of the .npy file
+        array: Array to be saved
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        np.save(file, array)
+    os.replace(tmp_path, path)
+
+
+def sha256_file(path, chunk_size=1 << 20):
+    """
+    sha256_file function
+    Returns the hex SHA-256 digest of the file at path, read in chunks of chunk_size bytes
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def check_data_file(path, name=None):
+    """
+    check_data_file function
+    Raises ValueError unless path is a whole .npy or .pkl file: a .npy file needs a valid header and exactly the
+    bytes its shape and dtype call for, a .pkl file has to start with a pickle protocol header and end with STOP.
+    This catches truncated files and HTML error pages served in place of the data. Other extensions are not checked
+    Args:
+        path: File to check
+        name: File name the extension is taken from, defaults to path (e.g. path is a .part file)
+    """
+    ext = os.path.splitext(name or path)[1]
+    size = os.path.getsize(path)
+    with open(path, "rb") as file:
+        if ext == ".npy":
+            try:
+                version = np.lib.format.read_magic(file)
+                read_header = {(1, 0): np.lib.format.read_array_header_1_0,
+                               (2, 0): np.lib.format.read_array_header_2_0}.get(version)
+                if read_header is None:
+                    raise ValueError(f"unsupported format version {version}")
+                shape, _, dtype = read_header(file)
+            except ValueError as error:
+                raise ValueError(f"{path} is not a .npy file: {error}")
+            expected = file.tell() + int(np.prod(shape)) * dtype.itemsize
+            if size != expected:
+                raise ValueError(f"{path} has {size} bytes, its header {shape} {dtype} needs {expected}")
+        elif ext == ".pkl":
+            head = file.read(2)
+            file.seek(-1, os.SEEK_END)
+            if len(head) < 2 or head[0] != 0x80 or file.read(1) != b".":
+                raise ValueError(f"{path} is not a complete pickle")
+
+
+def sha256_array(array, chunk_rows=4096):
+    """
+    sha256_array function
+    Returns the hex SHA-256 digest of the shape, dtype and contents of array
+    The rows are hashed in chunks, so memory-mapped arrays are never loaded whole
+    """
+    array = np.asarray(array)
+    digest = hashlib.sha256(f"{array.shape}{array.dtype.str}".encode())
+    for start in range(0, max(len(array), 1), chunk_rows):
+        digest.update(np.ascontiguousarray(array[start:start + chunk_rows]).tobytes())
+    return digest.hexdigest()
+
+
+def shard_dir(data_dir, dset, version, split):
+    """
+    shard_dir function
+    Directory of the sharded copy of a dset/version/split inside data_dir
+    """
+    name = f"{dset}_{version}" if version else dset
+    return os.path.join(data_dir, "shards", name, split)
+
+
+def write_shards(array, out_dir, shard_size):
+    """
+    write_shards function
+    Splits array along the first axis into fixed-size .npy chunks and writes a manifest.json
+    describing the element shape, dtype, size and SHA-256 of every shard.
+    The manifest is written last, so a directory with a manifest always holds a complete set of shards
+    Args:
+        array: Array (or memory-mapped array) to be sharded
+        out_dir: Directory for the shards and the manifest
+        shard_size: Number of examples per shard, the last shard may be smaller
+    Returns:
+        The manifest as a dict
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    shards = []
+    for index, start in enumerate(range(0, len(array), shard_size)):
+        file_name = f"shard_{index:05d}.npy"
+        path = os.path.join(out_dir, file_name)
+        chunk = np.ascontiguousarray(array[start:start + shard_size])
+        save_npy_atomic(path, chunk)
+        shards.append({"file": file_name, "num_examples": len(chunk), "sha256": sha256_file(path)})
+
+    return write_manifest(out_dir, shards, shard_size, array.shape[1:], array.dtype)
+
+
+def write_manifest(out_dir, shards, shard_size, element_shape, dtype):
+    """
+    write_manifest function
+    Atomically writes the manifest.json of shards already in out_dir, in the format of write_shards
+    Args:
+        shards: List of {"file", "num_examples", "sha256"} in shard order
+        shard_size: Number of examples per shard
+        element_shape, dtype: Shape and dtype of one example
+    Returns:
+        The manifest as a dict
+    """
+    manifest = {
+        "num_examples": sum(shard["num_examples"] for shard in shards),
+        "shard_size": shard_size,
+        "element_shape": list(element_shape),
+        "dtype": np.dtype(dtype).name,
+        "shards": shards,
+    }
+    tmp_path = os.path.join(out_dir, f"manifest.json.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(tmp_path, os.path.join(out_dir, "manifest.json"))
+    return manifest
+
+
+def read_manifest(path):
+    """
+    read_manifest function
+    Reads the manifest.json written by write_shards
+    """
+    with open(path) as file:
+        return json.load(file)
@@ -0,0 +1,83 @@
+import json
+import os
+import tensorflow as tf
+
+STRATEGIES = ("default", "mirrored", "multi_worker")
+
+
+def configure_cpu_devices(num_devices):
+    """
+    configure_cpu_devices function
+    Splits the physical CPU into num_devices logical devices, so MirroredStrategy has one replica per device.
+    Must be called before TensorFlow initializes its devices
+    """
+    cpu = tf.config.list_physical_devices("CPU")[0]
+    tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()] * num_devices)
+
+
+def local_tf_config(num_workers, worker_index, base_port=12345):
+    """
+    local_tf_config function
+    TF_CONFIG for a MultiWorkerMirroredStrategy cluster of num_workers processes on localhost,
+    listening on base_port, base_port+1, ...
+    """
+    return {
+        "cluster": {"worker": [f"localhost:{base_port + i}" for i in range(num_workers)]},
+        "task": {"type": "worker", "index": worker_index},
+    }
+
+
+def make_strategy(name, num_cpu_devices=1):
+    """
+    make_strategy function
+    Creates the tf.distribute strategy used for training
+    Args:
+        name: default (single replica), mirrored (one replica per logical CPU device)
+            or multi_worker (one replica per worker, cluster taken from the TF_CONFIG environment variable)
+        num_cpu_devices: Number of logical CPU devices for mirrored
+    """
+    if name == "default":
+        return tf.distribute.get_strategy()
+    if name == "mirrored":
+        if num_cpu_devices > 1:
+            configure_cpu_devices(num_cpu_devices)
+        devices = [device.name for device in tf.config.list_logical_devices("CPU")]
+        return tf.distribute.MirroredStrategy(devices=devices)
+    if name == "multi_worker":
+        if "TF_CONFIG" not in os.environ:
+            raise ValueError("multi_worker needs a TF_CONFIG environment variable, see local_tf_config")
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    raise ValueError(f"Unknown strategy '{name}', expected one of {STRATEGIES}")
+
+
+def worker_info(strategy):
+    """
+    worker_info function
+    Returns (num_workers, worker_index) of this process, (1, 0) unless strategy is multi-worker
+    """
+    if not isinstance(strategy, tf.distribute.MultiWorkerMirroredStrategy):
+        return 1, 0
+    tf_config = json.loads(os.environ["TF_CONFIG"])
+    return len(tf_config["cluster"]["worker"]), tf_config["task"]["index"]
+
+
+def is_chief(strategy):
+    """
+    is_chief function
+    True for the process that should write checkpoints and plots: worker 0, or the only process
+    """
+    return worker_info(strategy)[1] == 0
+
+
+def distribute_dataset(strategy, dataset, already_sharded=False):
+    """
+    distribute_dataset function
+    Splits the batches of dataset, batched with the global batch size, across the replicas of strategy.
+    Across workers the data is sharded by element, unless already_sharded says every worker
+    already reads its own part (e.g. a ShardedDataLoader with num_workers/worker_index)
+    """
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = (
+        tf.data.experimental.AutoShardPolicy.OFF if already_sharded else tf.data.experimental.AutoShardPolicy.DATA
+    )
+    return strategy.experimental_distribute_dataset(dataset.with_options(options))
@@ -0,0 +1,86 @@
+import os
+import numpy as np
+import tensorflow as tf
+
+SIGNATURES = ("encode_mean", "encode_sample", "decode_mean", "decode_noisy")
+# tf.random.normal in the sampling signatures has no TFLite builtin, only the mean paths are converted
+TFLITE_SIGNATURES = ("encode_mean", "decode_mean")
+
+
+class ServingModule(tf.Module):
+    """
+    Class ServingModule
+    tf.Module exposing the Encoder and Decoder of a trained VAE as SavedModel signatures
+    with a dynamic batch dimension
+    Args:
+        model: Trained VAE
+    Attributes:
+        model: The VAE, tracked so its variables are saved with the module
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        input_shape = [None] + list(model.encoder.neural_net.input_shape[1:])
+        latent_shape = [None, model.latent_dim]
+
+        self.encode_mean = tf.function(
+            lambda x: {"mu_z": model.sample_zmean(x)},
+            input_signature=[tf.TensorSpec(input_shape, tf.float32, name="x")])
+        self.encode_sample = tf.function(
+            lambda x: {"z": model.sample_z(x)},
+            input_signature=[tf.TensorSpec(input_shape, tf.float32, name="x")])
+        self.decode_mean = tf.function(
+            lambda z: {"mu_x": model.reconstruct_mean(z)},
+            input_signature=[tf.TensorSpec(latent_shape, tf.float32, name="z")])
+        self.decode_noisy = tf.function(
+            lambda z: {"x_hat": model.reconstruct_noisy(z)},
+            input_signature=[tf.TensorSpec(latent_shape, tf.float32, name="z")])
+
+
+def export_saved_model(model, export_dir):
+    """
+    export_saved_model function
+    Saves the encoder and decoder of model as a SavedModel with the signatures
+    encode_mean, encode_sample, decode_mean and decode_noisy
+    """
+    module = ServingModule(model)
+    tf.saved_model.save(module, export_dir, signatures={name: getattr(module, name) for name in SIGNATURES})
+    print(f"Exported SavedModel to {export_dir}")
+    return export_dir
+
+
+def export_tflite(export_dir, out_dir=None, quantize=None, representative_data=None, num_calibration=256):
+    """
+    export_tflite function
+    Converts the mean signatures of a SavedModel from export_saved_model to TFLite
+    Args:
+        export_dir: Directory of the SavedModel
+        out_dir: Directory for the .tflite files. Defaults to export_dir/tflite
+        quantize: None for float32, "dynamic" for int8 weights with float activations,
+            "int8" for int8 weights and activations calibrated on representative_data
+        representative_data: Dictionary of signature name to an array of calibration inputs, required for "int8"
+        num_calibration: Number of calibration inputs used per signature. Default 256
+    Returns:
+        Dictionary of signature name to .tflite path
+    """
+    if quantize not in (None, "dynamic", "int8"):
+        raise ValueError(f"Unknown quantization '{quantize}', expected None, 'dynamic' or 'int8'")
+    out_dir = out_dir or os.path.join(export_dir, "tflite")
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {}
+    for name in TFLITE_SIGNATURES:
+        converter = tf.lite.TFLiteConverter.from_saved_model(export_dir, signature_keys=[name])
+        if quantize is not None:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantize == "int8":
+            if representative_data is None or name not in representative_data:
+                raise ValueError(f"int8 quantization needs representative_data for {name}")
+            calibration = np.asarray(representative_data[name][:num_calibration], dtype=np.float32)
+            converter.representative_dataset = lambda: ([sample[None]] for sample in calibration)
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        suffix = f"_{quantize}" if quantize else ""
+        paths[name] = os.path.join(out_dir, f"{name}{suffix}.tflite")
+        with open(paths[name], "wb") as file:
+            file.write(converter.convert())
+        print(f"Wrote {paths[name]}")
+    return paths
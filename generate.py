@@ -0,0 +1,155 @@
+"""
+Bulk generation of synthetic images from the prior of a trained VAE
+Worker processes restore the checkpoint once, then decode z ~ N(0, I) drawn in-graph in fixed-size batches with a
+compiled decoder. The images are converted to uint8 like plot_grid does for colour (255*x clipped to [0, 255])
+and written as .npy shards with a manifest.json in the format of data_utils.write_shards.
+Each worker holds one shard at a time, so memory does not grow with the number of images.
+Shard i is always drawn from the same seeds, so the output does not depend on the number of workers.
+Usage:
+    python generate.py --checkpoint_dir ck --dset mnist_color --num_images 1000000 --out_dir generated
+"""
+import argparse
+import math
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from data_utils import save_npy_atomic, sha256_file, write_manifest
+
+# State of a pool worker, set by _init_worker
+_worker = {}
+
+
+def make_generator(model, batch_size, noisy=False):
+    """
+    make_generator function
+    Compiled function from a stateless seed of shape [2] to a uint8 batch of batch_size images from the prior
+    Args:
+        model: Trained VAE
+        batch_size: Images per call, the function is traced once for this size
+        noisy: If True decode with reconstruct_noisy, otherwise with reconstruct_mean
+    """
+    import tensorflow as tf
+
+    @tf.function(input_signature=[tf.TensorSpec([2], tf.int64)])
+    def generate(seed):
+        z = tf.random.stateless_normal([batch_size, model.latent_dim], seed=seed)
+        x = model.reconstruct_noisy(z) if noisy else model.reconstruct_mean(z)
+        return tf.cast(tf.clip_by_value(255*x, 0, 255), tf.uint8)
+
+    return generate
+
+
+def _init_worker(checkpoint_dir, dset, batch_size, noisy, threads):
+    """
+    Private function
+    Pool initializer: limits the TensorFlow threads, restores the checkpoint and compiles the generator
+    """
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    from Checkpointer import Checkpointer
+    from VAE import VAE
+    from network_selecter import network_selecter
+
+    model = VAE(*network_selecter(dset))
+    Checkpointer(checkpoint_dir, model).restore(required=True)
+    _worker["generate"] = make_generator(model, batch_size, noisy)
+    _worker["batch_size"] = batch_size
+    _worker["element_shape"] = tuple(model.decoder.neural_net.output_shape[1:])
+
+
+def _write_shard(job):
+    """
+    Private function
+    Generates and writes shard index of num_examples images. Runs in a pool worker
+    Returns (index, manifest entry of the shard, seconds spent)
+    """
+    import tensorflow as tf
+    index, num_examples, out_dir, seed = job
+    start = time.perf_counter()
+    batch_size = _worker["batch_size"]
+    shard = np.empty((num_examples,) + _worker["element_shape"], np.uint8)
+    for batch, offset in enumerate(range(0, num_examples, batch_size)):
+        images = _worker["generate"](tf.constant([seed, index * 1_000_000 + batch], tf.int64)).numpy()
+        shard[offset:offset + batch_size] = images[:num_examples - offset]
+    file_name = f"shard_{index:05d}.npy"
+    path = os.path.join(out_dir, file_name)
+    save_npy_atomic(path, shard)
+    entry = {"file": file_name, "num_examples": num_examples, "sha256": sha256_file(path)}
+    return index, entry, time.perf_counter() - start
+
+
+def generate_prior(checkpoint_dir, dset, num_images, out_dir="generated", shard_size=10000, batch_size=1024,
+                   num_workers=None, noisy=False, seed=0, silent=False):
+    """
+    generate_prior function
+    Generates num_images images from the prior of the VAE in checkpoint_dir with a pool of worker processes
+    Args:
+        checkpoint_dir: Checkpoint of the trained VAE
+        dset: mnist_bw or mnist_color, selects the networks
+        num_images: Number of images
+        out_dir: Directory of the shards and the manifest. Default generated
+        shard_size: Images per shard. Default 10000
+        batch_size: Images per decoder call. Default 1024
+        num_workers: Worker processes, defaults to one per core (at most one per shard)
+        noisy: If True decode with noise (reconstruct_noisy). Default False
+        seed: Base seed of the prior samples. Default 0
+        silent: If True only the summary is printed
+    Returns:
+        Dictionary with the number of images, the wall time, images/sec and the manifest path
+    """
+    num_shards = math.ceil(num_images / shard_size)
+    cores = len(os.sched_getaffinity(0))
+    num_workers = min(num_workers or cores, num_shards)
+    threads = max(1, cores // num_workers)
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = [(index, min(shard_size, num_images - index * shard_size), out_dir, seed) for index in range(num_shards)]
+
+    start = time.perf_counter()
+    shards, busy, done = [None] * num_shards, 0.0, 0
+    # spawn gives every worker a fresh TensorFlow runtime, forking an initialized runtime is unsafe
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(num_workers, initializer=_init_worker,
+                      initargs=(checkpoint_dir, dset, batch_size, noisy, threads)) as pool:
+        for index, entry, seconds in pool.imap_unordered(_write_shard, jobs):
+            shards[index] = entry
+            busy += seconds
+            done += entry["num_examples"]
+            if not silent:
+                print(f" Shard {index} written | {done}/{num_images} images "
+                      f"| {done / (time.perf_counter() - start):.0f} images/sec ")
+    seconds = time.perf_counter() - start
+
+    element_shape = np.load(os.path.join(out_dir, shards[0]["file"]), mmap_mode="r").shape[1:]
+    write_manifest(out_dir, shards, shard_size, element_shape, np.uint8)
+    result = {"num_images": num_images, "seconds": seconds, "images_per_sec": num_images / seconds,
+              # Rate of the workers once started, without process startup and checkpoint restore
+              "worker_images_per_sec": num_images / (busy / num_workers),
+              "num_workers": num_workers, "manifest": os.path.join(out_dir, "manifest.json")}
+    print(f"Generated {num_images} images in {num_shards} shards with {num_workers} workers in {seconds:.1f} s "
+          f"| {result['images_per_sec']:.0f} images/sec ({result['worker_images_per_sec']:.0f} after startup) "
+          f"| {result['manifest']}")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates images from the prior of a trained VAE in bulk")
+    parser.add_argument("--checkpoint_dir", type=str, required=True)
+    parser.add_argument("--dset", type=str, default="mnist_bw")
+    parser.add_argument("--num_images", type=int, default=100000)
+    parser.add_argument("--out_dir", type=str, default="generated")
+    parser.add_argument("--shard_size", type=int, default=10000)
+    parser.add_argument("--batch_size", type=int, default=1024)
+    parser.add_argument("--num_workers", type=int, default=None)
+    parser.add_argument("--noisy", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate_prior(args.checkpoint_dir, args.dset, args.num_images, args.out_dir, args.shard_size, args.batch_size,
+                   args.num_workers, args.noisy, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Per-layer profiler for the encoder and decoder networks of nn.py
+For every layer it reports forward and backward wall time, analytic FLOPs, parameter bytes and
+activation bytes at a given batch size, as a table and as JSON.
+Usage:
+    python layer_profiler.py --dset mnist_color --batch_size 256 [--json profile.json]
+    python layer_profiler.py --dset mnist_bw --units 800 --latent_dim 32
+"""
+import argparse
+import inspect
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+def layer_flops(layer, input_shape, output_shape, batch_size):
+    """
+    layer_flops function
+    Analytic forward FLOPs of one layer for a batch (a multiply-add counts as 2 FLOPs, bias adds as 1)
+    Dense: 2*B*in*out, Conv2D: 2*B*H_out*W_out*K_h*K_w*C_in*C_out,
+    Conv2DTranspose: 2*B*H_in*W_in*K_h*K_w*C_in*C_out (every input pixel is scattered over the kernel window).
+    Layers without arithmetic (Reshape, Flatten, linear Activation) count 0
+    """
+    bias = getattr(layer, "use_bias", False)
+    if isinstance(layer, tf.keras.layers.Dense):
+        flops = 2 * input_shape[-1] * layer.units
+        return batch_size * (flops + layer.units * bias)
+    if isinstance(layer, tf.keras.layers.Conv2DTranspose):
+        k_h, k_w = layer.kernel_size
+        flops = 2 * input_shape[1] * input_shape[2] * k_h * k_w * input_shape[3] * layer.filters
+        return batch_size * (flops + np.prod(output_shape[1:]) * bias)
+    if isinstance(layer, tf.keras.layers.Conv2D):
+        k_h, k_w = layer.kernel_size
+        flops = 2 * output_shape[1] * output_shape[2] * k_h * k_w * input_shape[3] * layer.filters
+        return batch_size * (flops + np.prod(output_shape[1:]) * bias)
+    return 0
+
+
+def _median_time(fn, x, repeats, warmup):
+    """
+    Private function
+    Median wall time of fn(x) after warmup calls, the scalar result is read back to sync
+    """
+    for _ in range(warmup):
+        fn(x).numpy()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(x).numpy()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def _timed_functions(layer):
+    """
+    Private function
+    Compiled forward and forward+backward functions of layer, both returning a scalar
+    The backward pass computes the gradients of the input and of every trainable weight
+    """
+    @tf.function
+    def forward(x):
+        return tf.reduce_sum(tf.cast(layer(x), tf.float32))
+
+    @tf.function
+    def forward_backward(x):
+        with tf.GradientTape() as tape:
+            tape.watch(x)
+            y = tf.reduce_sum(tf.cast(layer(x), tf.float32))
+        gradients = tape.gradient(y, [x] + layer.trainable_weights)
+        return tf.add_n([tf.reduce_sum(tf.cast(g, tf.float32)) for g in gradients if g is not None])
+
+    return forward, forward_backward
+
+
+def profile_network(network, batch_size=256, repeats=20, warmup=3, name=None):
+    """
+    profile_network function
+    Profiles every layer of a Keras network, e.g. one returned by network_selecter
+    Each layer is timed on its own with the activations of the previous layers as input
+    Args:
+        network: Built Keras Sequential or functional model
+        batch_size: Batch size of the inputs. Default 256
+        repeats: Timed runs per layer, the median is reported. Default 20
+        warmup: Untimed runs per layer before timing (includes tracing). Default 3
+        name: Name of the network in the report, defaults to network.name
+    Returns:
+        Dictionary with the network name, batch size, one row per layer and the totals
+    """
+    x = tf.random.normal([batch_size] + list(network.input_shape[1:]))
+    rows = []
+    for layer in network.layers:
+        x = tf.cast(x, layer.compute_dtype)
+        forward, forward_backward = _timed_functions(layer)
+        forward_seconds = _median_time(forward, x, repeats, warmup)
+        total_seconds = _median_time(forward_backward, x, repeats, warmup) if layer.trainable_weights else forward_seconds
+        y = layer(x)
+        flops = int(layer_flops(layer, x.shape, y.shape, batch_size))
+        rows.append({
+            "layer": layer.name,
+            "type": type(layer).__name__,
+            "output_shape": list(y.shape[1:]),
+            "forward_ms": 1e3 * forward_seconds,
+            "backward_ms": 1e3 * max(total_seconds - forward_seconds, 0.0),
+            "forward_flops": flops,
+            # Gradients with respect to the input and the weights each cost about one forward pass
+            "backward_flops": 2 * flops if layer.trainable_weights else 0,
+            "forward_gflops_per_sec": flops / forward_seconds / 1e9 if forward_seconds > 0 else 0.0,
+            "params": int(sum(w.shape.num_elements() for w in layer.weights)),
+            "param_bytes": int(sum(w.shape.num_elements() * w.dtype.size for w in layer.weights)),
+            "activation_bytes": int(y.shape.num_elements() * y.dtype.size),
+        })
+        x = y
+    totals = {key: sum(row[key] for row in rows)
+              for key in ("forward_ms", "backward_ms", "forward_flops", "backward_flops", "params", "param_bytes",
+                          "activation_bytes")}
+    return {"network": name or network.name, "batch_size": batch_size, "layers": rows, "totals": totals}
+
+
+def print_report(report):
+    """
+    print_report function
+    Prints a report from profile_network as a table, with each layer's share of the forward+backward time
+    """
+    total_ms = report["totals"]["forward_ms"] + report["totals"]["backward_ms"]
+    print(f"\n{report['network']} | batch size {report['batch_size']}")
+    header = (f"{'Layer':24s} {'Type':16s} {'Output':>14s} {'Fwd ms':>8s} {'Bwd ms':>8s} {'Share':>6s} "
+              f"{'Fwd MFLOP':>10s} {'GFLOP/s':>8s} {'Params':>9s} {'Param KiB':>10s} {'Act KiB':>9s}")
+    print(header)
+    print("-" * len(header))
+    for row in report["layers"] + [dict(report["totals"], layer="total", type="", output_shape="",
+                                        forward_gflops_per_sec=None)]:
+        share = (row["forward_ms"] + row["backward_ms"]) / total_ms if total_ms > 0 else 0.0
+        gflops = "" if row["forward_gflops_per_sec"] is None else f"{row['forward_gflops_per_sec']:.1f}"
+        shape = "x".join(map(str, row["output_shape"])) if row["output_shape"] else ""
+        print(f"{row['layer']:24s} {row['type']:16s} {shape:>14s} {row['forward_ms']:8.3f} {row['backward_ms']:8.3f} "
+              f"{100*share:5.1f}% {row['forward_flops']/1e6:10.1f} {gflops:>8s} {row['params']:9d} "
+              f"{row['param_bytes']/1024:10.1f} {row['activation_bytes']/1024:9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profiles the encoder and decoder of a dset layer by layer")
+    parser.add_argument("--dset", type=str, default="mnist_bw")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--units", type=int, default=None)
+    parser.add_argument("--latent_dim", type=int, default=None)
+    parser.add_argument("--filters", type=int, default=None)
+    parser.add_argument("--json", type=str, default=None)
+    args = parser.parse_args()
+
+    from nn import NETWORKS, build_networks
+    if args.dset not in NETWORKS:
+        parser.error(f"--dset must be one of {', '.join(NETWORKS)}")
+    # Only the arguments the builders of dset take, e.g. --filters does not apply to the mnist_bw MLP
+    accepted = set.intersection(*(set(inspect.signature(builder).parameters) for builder in NETWORKS[args.dset]))
+    overrides = {name: getattr(args, name) for name in ("units", "latent_dim", "filters")
+                 if getattr(args, name) is not None}
+    rejected = [f"--{name}" for name in overrides if name not in accepted]
+    if rejected:
+        parser.error(f"{', '.join(rejected)} does not apply to --dset {args.dset}, "
+                     f"which accepts {', '.join('--' + name for name in sorted(accepted))}")
+    encoder, decoder = build_networks(args.dset, **overrides)
+    reports = [profile_network(network, args.batch_size, args.repeats, args.warmup, name=f"{args.dset} {part}")
+               for part, network in (("encoder", encoder), ("decoder", decoder))]
+    for report in reports:
+        print_report(report)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"dset": args.dset, "overrides": overrides, "reports": reports}, file, indent=2)
+        print(f"\nWrote {args.json}")
+
+
+if __name__ == "__main__":
+    main()
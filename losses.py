@@ -2,9 +2,11 @@ import tensorflow as tf
 import numpy as np 
 
 def kl_divergence(mu, log_var):
+    mu, log_var = tf.cast(mu, tf.float32), tf.cast(log_var, tf.float32)
     return 0.5 * tf.reduce_sum(tf.square(mu) + tf.exp(log_var) - log_var - 1, axis=-1) 
 
 def log_diag_mvn(x, mu, log_sigma):
+    x, mu, log_sigma = tf.cast(x, tf.float32), tf.cast(mu, tf.float32), tf.cast(log_sigma, tf.float32)
     sum_axes = tf.range(1, tf.rank(mu))
     k = tf.cast(tf.reduce_prod(tf.shape(mu)[1:]), x.dtype)
     logp = - 0.5 * k * tf.math.log(2*np.pi) \
@@ -13,3 +15,48 @@ def log_diag_mvn(x, mu, log_sigma):
     return logp
 
 
+def make_elbo(sigma_x, event_shape):
+    """
+    Builds a fused per-sample ELBO for a decoder with fixed sigma_x and outputs of event_shape.
+    log(2*pi), log(sigma_x), 1/sigma_x^2 and the reduction axes are computed once here instead of every step.
+    Gives the same values as log_diag_mvn(x, mu_x, log(sigma_x)) - kl_divergence(mu_z, logvar_z).
+    Returns a function (x, mu_x, mu_z, logvar_z) -> (elbo, logp, kl), each of shape (batch,)
+    """
+    k = float(np.prod(event_shape))
+    logp_const = -0.5 * k * np.log(2 * np.pi) - np.log(sigma_x)
+    half_inv_var = 0.5 / sigma_x**2
+    sum_axes = list(range(1, len(event_shape) + 1))
+
+    def elbo(x, mu_x, mu_z, logvar_z):
+        x, mu_x = tf.cast(x, tf.float32), tf.cast(mu_x, tf.float32)
+        mu_z, logvar_z = tf.cast(mu_z, tf.float32), tf.cast(logvar_z, tf.float32)
+        logp = logp_const - half_inv_var * tf.reduce_sum(tf.math.squared_difference(x, mu_x), axis=sum_axes)
+        kl = 0.5 * tf.reduce_sum(tf.square(mu_z) + tf.exp(logvar_z) - logvar_z - 1, axis=-1)
+        return logp - kl, logp, kl
+
+    return elbo
+
+
+def make_iwae_log_weights(sigma_x, event_shape):
+    """
+    Builds the log importance weights log p(x|z) + log p(z) - log q(z|x) for K latent samples per input.
+    The log(2*pi) terms of p(z) and q(z|x) cancel, q(z|x) is evaluated through eps with z = mu_z + sigma_z*eps.
+    Returns a function (x, mu_x, z, eps, logvar_z) -> log_w, where x and logvar_z have a batch dimension,
+    mu_x, z and eps a leading sample dimension of size K, and log_w is of shape (K, batch)
+    """
+    k = float(np.prod(event_shape))
+    logp_const = -0.5 * k * np.log(2 * np.pi) - np.log(sigma_x)
+    half_inv_var = 0.5 / sigma_x**2
+    sum_axes = list(range(2, len(event_shape) + 2))
+
+    def log_weights(x, mu_x, z, eps, logvar_z):
+        x, mu_x = tf.cast(x, tf.float32), tf.cast(mu_x, tf.float32)
+        logp = logp_const - half_inv_var * tf.reduce_sum(tf.math.squared_difference(x[None], mu_x), axis=sum_axes)
+        log_prior_ratio = 0.5 * tf.reduce_sum(tf.square(eps) - tf.square(z), axis=-1)
+        return logp + log_prior_ratio + 0.5 * tf.reduce_sum(logvar_z, axis=-1)
+
+    return log_weights
+
+
+def log_mean_exp(log_w, axis=0):
+    return tf.reduce_logsumexp(log_w, axis=axis) - tf.math.log(tf.cast(tf.shape(log_w)[axis], log_w.dtype))
@@ -1,20 +1,19 @@
-from nn import encoder_mlp, decoder_mlp, encoder_conv, decoder_conv
+from nn import build_networks
 
 def network_selecter(dset):
     """
     network_selecter function
     Selects the appropriate encoder and decoder based on the dataset.
+    Only the selected pair is built, and every call returns new models with fresh weights
     Args:
         dset: mnist_bw, mnist_color
     Returns:
     encoder_conv, decoder_conv for dset = mnist_color
-    encoder_mlp, decoder_mlp for dset = mnist_bw    
-            
+    encoder_mlp, decoder_mlp for dset = mnist_bw
+
     """
 
     if dset == "mnist_color":
-        return encoder_conv,decoder_conv
+        return build_networks("mnist_color")
     else:
-        return encoder_mlp,decoder_mlp
-
-    
\ No newline at end of file
+        return build_networks("mnist_bw")
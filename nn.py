@@ -1,8 +1,5 @@
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-from tensorflow.keras import layers
-from tensorflow.keras import activations
-from tensorflow.keras.models import Sequential
 import numpy as np
 
 
@@ -13,23 +10,35 @@ layer. The output of the encoder are the parameters
 of the Gaussian distribution, while the output of the
 decoder is only the mu parameter the Gaussian distribution
 as we treat sigma=0.75 as known to make thigs easier
+
+The networks are built by the builder functions below, only when they are requested,
+and every call returns a new model with freshly initialized weights.
+Keras is imported inside the builders, so importing this module is instant.
+The old module globals encoder_mlp, decoder_mlp, encoder_conv and decoder_conv still work,
+they are built on first access and shared from then on
 """
-input_shape = (28*28,)
-units = 400
-activation  = 'relu'
-latent_dim = 20
-# Gaussian Encoder for vetorized images
-encoder_mlp = Sequential(
-                        [ 
+def build_encoder_mlp(units=400, latent_dim=20):
+    from tensorflow.keras import layers
+    from tensorflow.keras.models import Sequential
+    input_shape = (28*28,)
+    activation  = 'relu'
+    # Gaussian Encoder for vetorized images
+    return Sequential(
+                        [
                         layers.InputLayer(input_shape=input_shape),
                         layers.Dense(units,activation=activation),
                         layers.Dense(2*latent_dim),
                         ]
                         )
 
-output_dim  = 28*28
-# Gaussian Decoder for B&W images
-decoder_mlp = Sequential(
+
+def build_decoder_mlp(units=400, latent_dim=20):
+    from tensorflow.keras import layers
+    from tensorflow.keras.models import Sequential
+    activation  = 'relu'
+    output_dim  = 28*28
+    # Gaussian Decoder for B&W images
+    return Sequential(
                         [
                         layers.InputLayer(input_shape=latent_dim),
                         layers.Dense(units,activation=activation),
@@ -37,13 +46,15 @@ decoder_mlp = Sequential(
                         ]
                         )
 
-input_shape = (28,28,3)
-filters     = 32
-kernel_size = 3
-strides     = 2
-activation  = 'relu'
-latent_dim  = 50
-encoder_conv = Sequential(
+
+def build_encoder_conv(filters=32, latent_dim=50):
+    from tensorflow.keras import layers
+    from tensorflow.keras.models import Sequential
+    input_shape = (28,28,3)
+    kernel_size = 3
+    strides     = 2
+    activation  = 'relu'
+    return Sequential(
                         [
                         layers.InputLayer(input_shape=input_shape),
                         layers.Conv2D(
@@ -57,10 +68,16 @@ encoder_conv = Sequential(
                         ]
                         )
 
-target_shape=(4,4,128)
-channel_out=3
-units = np.prod(target_shape)
-decoder_conv = Sequential(
+
+def build_decoder_conv(filters=32, latent_dim=50):
+    from tensorflow.keras import layers
+    from tensorflow.keras.models import Sequential
+    kernel_size = 3
+    activation  = 'relu'
+    target_shape=(4,4,4*filters)
+    channel_out=3
+    units = np.prod(target_shape)
+    return Sequential(
                         [
                         layers.InputLayer(input_shape=(latent_dim,)),
                         layers.Dense(units=units, activation=activation),
@@ -75,4 +92,42 @@ decoder_conv = Sequential(
                             filters=channel_out, kernel_size=kernel_size, strides=2, padding='same', output_padding=1),
                         layers.Activation('linear', dtype='float32'),
                         ]
-                        )
\ No newline at end of file
+                        )
+
+
+# Registry of dset to its (encoder, decoder) builders
+NETWORKS = {
+    "mnist_bw": (build_encoder_mlp, build_decoder_mlp),
+    "mnist_color": (build_encoder_conv, build_decoder_conv),
+}
+
+_LEGACY = {
+    "encoder_mlp": build_encoder_mlp,
+    "decoder_mlp": build_decoder_mlp,
+    "encoder_conv": build_encoder_conv,
+    "decoder_conv": build_decoder_conv,
+}
+
+
+def build_networks(dset, **kwargs):
+    """
+    build_networks function
+    Builds a fresh (encoder, decoder) pair for dset from the NETWORKS registry
+    kwargs override the architecture, units and latent_dim for mnist_bw, filters and latent_dim for mnist_color
+    """
+    if dset not in NETWORKS:
+        raise ValueError(f"Unknown dset '{dset}', expected one of {tuple(NETWORKS)}")
+    build_encoder, build_decoder = NETWORKS[dset]
+    return build_encoder(**kwargs), build_decoder(**kwargs)
+
+
+def __getattr__(name):
+    """
+    Module __getattr__ (PEP 562)
+    Builds the old module globals on first access and keeps them, so `from nn import encoder_mlp` still works
+    """
+    if name in _LEGACY:
+        model = _LEGACY[name]()
+        globals()[name] = model
+        return model
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,50 +1,143 @@
 import os 
+import multiprocessing
 import matplotlib.pyplot as plt
-from mpl_toolkits.axes_grid1 import ImageGrid
-from sklearn.manifold import TSNE
-import tensorflow as tf
+from projection import project
 import numpy as np 
-def plot_grid(x_recon, dset,batch_size,epochs,name,save_plot,noisy,learning_rate,version =""):
-   
-    N = 10; C = 10; figsize = (24.,28)
+def set_headless():
+    """
+    set_headless function
+    Switches matplotlib to the Agg backend, so nothing is ever shown and plt.show() never blocks
+    """
+    plt.switch_backend("Agg")
+
+
+def to_images(x, dset):
+    """
+    to_images function
+    Reshapes a batch of decoder outputs to images
+    mnist_bw gives float images of shape (n, 28, 28), each scaled to [0, 1] by its own minimum and maximum
+    like imshow does per Axes. mnist_color gives uint8 images of shape (n, 28, 28, 3) clipped from [0, 1]
+    """
+    x = np.asarray(x)
+    if dset == "mnist_bw":
+        images = x.reshape(-1, 28, 28).astype(np.float32)
+        low = images.min(axis=(1, 2), keepdims=True)
+        high = images.max(axis=(1, 2), keepdims=True)
+        return (images - low) / np.maximum(high - low, 1e-12)
+    return np.clip(255*x, 0, 255).astype(np.uint8).reshape(-1, 28, 28, 3)
+
+
+def make_mosaic(images, ncols=None, pad=0, pad_value=0):
+    """
+    make_mosaic function
+    Tiles images of shape (n, h, w) or (n, h, w, c) into one array with a single reshape/transpose
+    Args:
+        images: Array of images
+        ncols: Images per row, defaults to ceil(sqrt(n)) for a square grid
+        pad: Pixels of pad_value between tiles. Default 0
+    Returns:
+        Array of shape (rows*(h+pad)-pad, ncols*(w+pad)-pad[, c])
+    """
+    images = np.asarray(images)
+    n = len(images)
+    ncols = ncols or int(np.ceil(np.sqrt(n)))
+    nrows = -(-n // ncols)
+    pad_width = [(0, nrows*ncols - n), (0, pad), (0, pad)] + [(0, 0)] * (images.ndim - 3)
+    tiles = np.pad(images, pad_width, constant_values=pad_value)
+    h, w = tiles.shape[1:3]
+    mosaic = tiles.reshape((nrows, ncols) + tiles.shape[1:]).swapaxes(1, 2)
+    mosaic = mosaic.reshape((nrows*h, ncols*w) + tiles.shape[3:])
+    return mosaic[:nrows*h - pad, :ncols*w - pad]
+
+
+def save_mosaic(x, path, dset, ncols=None, scale=4, pad=0):
+    """
+    save_mosaic function
+    Writes the decoder outputs x as one PNG mosaic with plt.imsave, no Figure or Axes are created
+    Args:
+        x: Batch of decoder outputs
+        path: Destination .png
+        dset: mnist_bw (drawn with the viridis colormap) or mnist_color
+        ncols: Images per row, defaults to a square grid
+        scale: Integer upscaling of every pixel (nearest neighbour). Default 4
+        pad: Pixels between tiles. Default 0
+    """
+    mosaic = make_mosaic(to_images(x, dset), ncols, pad)
+    if scale > 1:
+        mosaic = mosaic.repeat(scale, axis=0).repeat(scale, axis=1)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if dset == "mnist_bw":
+        plt.imsave(path, mosaic, cmap="viridis", vmin=0, vmax=1)
+    else:
+        plt.imsave(path, mosaic)
+    return path
+
+
+def _save_mosaic_job(job):
+    return save_mosaic(**job)
+
+
+def render_grids(jobs, processes=None):
+    """
+    render_grids function
+    Writes many mosaics in a process pool
+    Args:
+        jobs: List of dictionaries with the arguments of save_mosaic (x, path, dset, ...)
+        processes: Number of worker processes, defaults to the number of cores
+    Returns:
+        List of the written paths
+    """
+    if len(jobs) <= 1 or processes == 1:
+        return [save_mosaic(**job) for job in jobs]
+    # spawn keeps the workers free of the parent's TensorFlow threads
+    with multiprocessing.get_context("spawn").Pool(processes) as pool:
+        return pool.map(_save_mosaic_job, jobs)
+
+
+def plot_grid(x_recon, dset,batch_size,epochs,name,save_plot,noisy,learning_rate,version ="",show=True,ncols=None):
+    """
+    plot_grid function
+    Draws the decoder outputs x_recon as one mosaic image (square grid by default, any number of images)
+    With save_plot the PNG is written directly from the mosaic with save_mosaic.
+    With show the mosaic is displayed in a single Axes, the figure is closed afterwards
+    """
     if dset == "mnist_bw":
-        color_map = "viridis"
         plot_name = dset
-        x_recon_images = x_recon.numpy().reshape(-1, 28, 28)
     else:
-        color_map = None
         plot_name = f"{dset}_{version}" if version else dset
-        x_recon = tf.clip_by_value(255*x_recon, clip_value_min=0, clip_value_max=255).numpy().astype(np.uint8)
-        x_recon_images = x_recon.reshape(-1, 28, 28,3)
 
     if noisy:
         plot_name = f"{'noisy'}_{plot_name}"
-   
-    
- 
-    fig = plt.figure(figsize=figsize)
-    grid = ImageGrid(fig, 111, nrows_ncols=(N, C), axes_pad=0)
-    for ax, im in zip(grid, x_recon_images):
-        ax.imshow(im, cmap=color_map)
-        ax.set_xticks([])
-        ax.set_yticks([])
-
-    plt.subplots_adjust(wspace=0, hspace=0)
 
     if save_plot ==True:
         save_dir = "figs" 
-        os.makedirs(save_dir, exist_ok=True)
-        plt.savefig(f"{save_dir}/{plot_name}_{name}_learning_rate_{learning_rate}_batch_size_{batch_size}_epochs_{epochs}.png")
-        print(f"Saved grid as {plot_name}_{name}_learning_rate_{learning_rate}_batch_size_{batch_size}_epochs_{epochs}.png")
+        file_name = f"{plot_name}_{name}_learning_rate_{learning_rate}_batch_size_{batch_size}_epochs_{epochs}.png"
+        save_mosaic(x_recon, os.path.join(save_dir, file_name), dset, ncols)
+        print(f"Saved grid as {file_name}")
 
-   
-    plt.show()
+    if show and plt.get_backend().lower() != "agg":
+        fig, ax = plt.subplots(figsize=(12., 12.))
+        mosaic = make_mosaic(to_images(x_recon, dset), ncols)
+        ax.imshow(mosaic, cmap="viridis" if dset == "mnist_bw" else None, interpolation="nearest")
+        ax.set_axis_off()
+        plt.show()
+        plt.close(fig)
 
 
 
 
 
-def plot_latent(z,labels,dset,batch_size,epochs,name,save_plot,noisy,learning_rate,version =""):
+def plot_latent(z,labels,dset,batch_size,epochs,name,save_plot,noisy,learning_rate,version ="",
+                method="tsne",max_points=None,cache_dir=None,cache_key=None,seed=0,n_jobs=-1,show=True):
+    """
+    plot_latent function
+    Scatter plot of a 2D projection of the latent vectors z coloured by label
+    The projection (tsne, pca or randomized_pca) comes from projection.project, optionally on a stratified
+    subsample of max_points and cached in cache_dir under cache_key, so re-plotting the same model and data is instant
+    The figure is closed after saving/showing, show=False never calls plt.show()
+    """
     if dset == "mnist_bw":
         plot_name = dset
     else:
@@ -52,15 +145,18 @@ def plot_latent(z,labels,dset,batch_size,epochs,name,save_plot,noisy,learning_ra
     if noisy:
         plot_name = f"{'noisy'}_{plot_name}"
    
-    z_embedded = TSNE(n_components=2,learning_rate=100,init="random",perplexity=5,
-    ).fit_transform(z)
+    z_embedded, labels = project(z,labels,method=method,max_points=max_points,seed=seed,n_jobs=n_jobs,
+                                 cache_dir=cache_dir,cache_key=cache_key)
 
+    fig = plt.figure()
     plt.scatter(z_embedded[:, 0], z_embedded[:, 1],c = labels,cmap="tab10",s = 5)
+    plt.title(f"{method} of {len(z_embedded)} latent vectors")
     if save_plot ==True:
         save_dir = "figs" 
         os.makedirs(save_dir, exist_ok=True)
         plt.savefig(f"{save_dir}/{plot_name}_{name}_learning_rate_{learning_rate}_batch_size_{batch_size}_epochs_{epochs}.png")
         print(f"Saved plot {plot_name}_{name}_learning_rate_{learning_rate}_batch_size_{batch_size}_epochs_{epochs}.png")
     
-    plt.show()
- 
\ No newline at end of file
+    if show:
+        plt.show()
+    plt.close(fig)
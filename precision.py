@@ -0,0 +1,29 @@
+import tensorflow as tf
+
+PRECISIONS = ("float32", "mixed_bfloat16", "mixed_float16")
+
+
+def set_precision(precision):
+    """
+    set_precision function
+    Sets the global Keras dtype policy.
+    Must be called before the networks in nn.py are built, layers keep the policy they were created with.
+    With the mixed policies layers compute in bfloat16/float16 and keep float32 variables,
+    Encoder, Decoder and the losses cast back to float32 so the ELBO is reduced in float32.
+    Args:
+        precision: float32, mixed_bfloat16 or mixed_float16
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISIONS}")
+    tf.keras.mixed_precision.set_global_policy(precision)
+
+
+def wrap_optimizer(optimizer, precision):
+    """
+    wrap_optimizer function
+    Wraps optimizer in a dynamic LossScaleOptimizer for mixed_float16, whose small exponent range
+    would otherwise underflow the gradients. bfloat16 has the float32 exponent range and needs no loss scaling
+    """
+    if precision == "mixed_float16":
+        return tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+    return optimizer
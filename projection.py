@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+from data_utils import save_npy_atomic, sha256_array
+
+METHODS = ("tsne", "pca", "randomized_pca")
+
+
+def pca(z, n_components=2):
+    """
+    pca function
+    Exact PCA via a thin SVD of the centered data
+    The sign of every component is fixed (largest loading positive), so the result is deterministic
+    """
+    z = np.asarray(z, dtype=np.float64)
+    z = z - z.mean(axis=0)
+    u, s, vt = np.linalg.svd(z, full_matrices=False)
+    signs = np.sign(vt[np.arange(n_components), np.argmax(np.abs(vt[:n_components]), axis=1)])
+    return (u[:, :n_components] * s[:n_components] * signs).astype(np.float32)
+
+
+def randomized_pca(z, n_components=2, oversamples=10, n_iter=4, seed=0):
+    """
+    randomized_pca function
+    Randomized PCA (Halko et al.): a Gaussian sketch with n_iter power iterations finds the top
+    n_components + oversamples subspace, then a small SVD inside that subspace gives the components.
+    O(n d k) instead of the O(n d min(n, d)) of the full SVD
+    """
+    rng = np.random.default_rng(seed)
+    z = np.asarray(z, dtype=np.float64)
+    z = z - z.mean(axis=0)
+    rank = min(n_components + oversamples, *z.shape)
+    q, _ = np.linalg.qr(z @ rng.standard_normal((z.shape[1], rank)))
+    for _ in range(n_iter):
+        q, _ = np.linalg.qr(z.T @ q)
+        q, _ = np.linalg.qr(z @ q)
+    u_small, s, vt = np.linalg.svd(q.T @ z, full_matrices=False)
+    u = q @ u_small
+    signs = np.sign(vt[np.arange(n_components), np.argmax(np.abs(vt[:n_components]), axis=1)])
+    return (u[:, :n_components] * s[:n_components] * signs).astype(np.float32)
+
+
+def tsne(z, n_components=2, perplexity=5, learning_rate=100, n_jobs=-1, seed=0):
+    """
+    tsne function
+    t-SNE with FFT-accelerated gradients from openTSNE when it is installed,
+    otherwise sklearn's Barnes-Hut t-SNE. Both run on n_jobs threads, PCA-initialized and seeded
+    """
+    z = np.asarray(z, dtype=np.float32)
+    try:
+        from openTSNE import TSNE as OpenTSNE
+    except ImportError:
+        from sklearn.manifold import TSNE
+        return TSNE(n_components=n_components, perplexity=perplexity, learning_rate=learning_rate,
+                    init="pca", method="barnes_hut", n_jobs=n_jobs, random_state=seed).fit_transform(z)
+    embedding = OpenTSNE(n_components=n_components, perplexity=perplexity, learning_rate=learning_rate,
+                         initialization="pca", negative_gradient_method="fft", n_jobs=n_jobs,
+                         random_state=seed).fit(z)
+    return np.asarray(embedding, dtype=np.float32)
+
+
+def stratified_subsample(labels, max_points, seed=0):
+    """
+    stratified_subsample function
+    Indices of at most max_points rows, keeping the class proportions of labels
+    Every class gets its proportional share rounded down, the remaining points go to the classes
+    with the largest remainders. Returns the indices sorted
+    """
+    labels = np.asarray(labels).reshape(-1)
+    if max_points is None or max_points >= len(labels):
+        return np.arange(len(labels))
+    rng = np.random.default_rng(seed)
+    classes, counts = np.unique(labels, return_counts=True)
+    shares = counts * max_points / len(labels)
+    take = np.floor(shares).astype(np.int64)
+    take[np.argsort(take - shares)[:max_points - take.sum()]] += 1
+    indices = [rng.choice(np.flatnonzero(labels == label), n, replace=False) for label, n in zip(classes, take)]
+    return np.sort(np.concatenate(indices))
+
+
+def weights_fingerprint(model):
+    """
+    weights_fingerprint function
+    SHA-256 of the weights of model, identifying the checkpoint the model was trained to or restored from
+    """
+    digest = hashlib.sha256()
+    for weight in model.get_weights():
+        digest.update(np.ascontiguousarray(weight).tobytes())
+    return digest.hexdigest()
+
+
+def project(z, labels=None, method="tsne", n_components=2, max_points=None, seed=0, n_jobs=-1,
+            cache_dir=None, cache_key=None, **params):
+    """
+    project function
+    Projects latent vectors to n_components dimensions, optionally on a stratified subsample
+    and cached on disk
+    Args:
+        z: Array of shape (n, latent_dim)
+        labels: Optional labels of shape (n,), used for stratification and returned subsampled
+        method: tsne, pca or randomized_pca
+        max_points: Project at most max_points rows, stratified by labels when given. None for all
+        seed: Seed of the subsampling and the projection
+        n_jobs: Threads used by t-SNE. Default -1 (all cores)
+        cache_dir: Directory of cached projections, None disables the cache
+        cache_key: Identity of z in the cache, e.g. the model fingerprint plus a data hash.
+            Defaults to the SHA-256 of z
+        params: Extra arguments of the method, e.g. perplexity for tsne
+    Returns:
+        Tuple of the embedding of shape (m, n_components) and the labels of its rows (None without labels)
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown projection '{method}', expected one of {METHODS}")
+    if labels is not None:
+        indices = stratified_subsample(labels, max_points, seed)
+    elif max_points is not None and max_points < len(z):
+        indices = np.sort(np.random.default_rng(seed).choice(len(z), max_points, replace=False))
+    else:
+        indices = np.arange(len(z))
+
+    cache_path = None
+    if cache_dir:
+        key = {"data": cache_key or sha256_array(z), "method": method, "n_components": n_components,
+               "max_points": max_points, "seed": seed, "params": params}
+        name = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:32]
+        cache_path = os.path.join(cache_dir, f"{method}_{name}.npy")
+        if os.path.exists(cache_path):
+            print(f"Loaded cached {method} projection from {cache_path}")
+            return np.load(cache_path), None if labels is None else np.asarray(labels).reshape(-1)[indices]
+
+    z_subset = np.asarray(z)[indices]
+    if method == "pca":
+        embedding = pca(z_subset, n_components)
+    elif method == "randomized_pca":
+        embedding = randomized_pca(z_subset, n_components, seed=seed, **params)
+    else:
+        embedding = tsne(z_subset, n_components, n_jobs=n_jobs, seed=seed, **params)
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        save_npy_atomic(cache_path, embedding)
+    return embedding, None if labels is None else np.asarray(labels).reshape(-1)[indices]
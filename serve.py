@@ -0,0 +1,240 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import tensorflow as tf
+
+from export_model import SIGNATURES
+
+
+class DynamicBatcher:
+    """
+    Class DynamicBatcher
+    Coalesces concurrent requests into batches for one function.
+    A background thread takes the first waiting request and keeps adding requests until
+    max_batch_size inputs are collected or timeout_ms has passed, runs fn once on the
+    concatenated inputs and hands every request its slice of the outputs.
+    A request that would overflow the batch (or has other trailing dimensions) waits for the next batch,
+    and requests larger than max_batch_size are split, so fn never sees more than max_batch_size inputs.
+    Inputs of the wrong shape are rejected in submit() and never reach a batch.
+    Args:
+        fn: Function mapping a batch array to an output array with the same first dimension
+        max_batch_size: Maximum number of inputs per call of fn. Default 64
+        timeout_ms: Maximum time the first request of a batch waits for more requests. Default 5
+        input_shape: Shape of one input (None for any size along a dimension), None to accept any shape
+        window: Number of recent requests and batches the statistics are computed over. Default 10000
+    Attributes:
+        max_batch_size: Maximum number of inputs per call of fn
+        timeout_ms: Maximum wait for more requests in milliseconds
+        input_shape: Shape of one input
+    """
+    def __init__(self, fn, max_batch_size=64, timeout_ms=5.0, input_shape=None, window=10000):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.timeout_ms = timeout_ms
+        self.input_shape = None if input_shape is None else tuple(input_shape)
+        self._queue = queue.Queue()
+        self._carry = None
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._batch_sizes = deque(maxlen=window)
+        self._num_requests = 0
+        self._num_batches = 0
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, inputs):
+        """
+        Public method
+        Queues inputs (an array with a batch dimension) and returns a Future of the outputs
+        Raises ValueError right away if the inputs do not match input_shape
+        """
+        inputs = np.asarray(inputs, dtype=np.float32)
+        if inputs.ndim == 0 or (self.input_shape is not None and (
+                inputs.ndim != len(self.input_shape) + 1
+                or any(dim is not None and dim != size for dim, size in zip(self.input_shape, inputs.shape[1:])))):
+            raise ValueError(f"Expected inputs of shape (batch,) + {self.input_shape}, got {inputs.shape}")
+        submitted = time.perf_counter()
+        parts = [inputs[start:start + self.max_batch_size] for start in range(0, max(len(inputs), 1), self.max_batch_size)]
+        futures = [Future() for _ in parts]
+        for part, future in zip(parts, futures):
+            self._queue.put((part, future, submitted))
+        if len(futures) == 1:
+            return futures[0]
+
+        # A request larger than max_batch_size is served in several batches and joined again
+        combined = Future()
+
+        def done(_):
+            if combined.done():
+                return
+            for future in futures:
+                if future.done() and future.exception() is not None:
+                    combined.set_exception(future.exception())
+                    return
+            if all(future.done() for future in futures):
+                combined.set_result(np.concatenate([future.result() for future in futures]))
+
+        for future in futures:
+            future.add_done_callback(done)
+        return combined
+
+    def _collect(self):
+        """
+        Private method
+        Blocks for the first request, then gathers more until the batch is full or the timeout passed
+        The request that does not fit is carried over and starts the next batch
+        """
+        first, self._carry = self._carry or self._queue.get(), None
+        requests = [first]
+        size = len(first[0])
+        deadline = time.perf_counter() + self.timeout_ms / 1000
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if size + len(request[0]) > self.max_batch_size or request[0].shape[1:] != first[0].shape[1:]:
+                self._carry = request
+                break
+            requests.append(request)
+            size += len(request[0])
+        return requests
+
+    def _loop(self):
+        """
+        Private method
+        Worker thread running one call of fn per collected batch
+        """
+        while True:
+            requests = self._collect()
+            try:
+                outputs = self.fn(np.concatenate([inputs for inputs, _, _ in requests]))
+            except Exception as error:
+                for _, future, _ in requests:
+                    future.set_exception(error)
+                continue
+            start = 0
+            now = time.perf_counter()
+            with self._lock:
+                self._num_batches += 1
+                self._num_requests += len(requests)
+                self._batch_sizes.append(len(outputs))
+                for inputs, future, submitted in requests:
+                    future.set_result(outputs[start:start + len(inputs)])
+                    start += len(inputs)
+                    self._latencies.append(now - submitted)
+
+    def stats(self):
+        """
+        Public method
+        Number of requests and batches served, and the mean batch size and p50/p99 request latency
+        in milliseconds over the last window requests and batches
+        """
+        with self._lock:
+            latencies = 1e3 * np.asarray(self._latencies)
+            batch_sizes = np.asarray(self._batch_sizes)
+            num_requests, num_batches = self._num_requests, self._num_batches
+        if not len(latencies):
+            return {"requests": 0, "batches": 0}
+        return {
+            "requests": num_requests,
+            "batches": num_batches,
+            "mean_batch_size": float(batch_sizes.mean()),
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p99_ms": float(np.percentile(latencies, 99)),
+        }
+
+
+def make_batchers(export_dir, max_batch_size=64, timeout_ms=5.0):
+    """
+    make_batchers function
+    Loads a SavedModel from export_model.export_saved_model and creates one DynamicBatcher per signature
+    """
+    loaded = tf.saved_model.load(export_dir)
+    batchers = {}
+    for name in SIGNATURES:
+        signature = loaded.signatures[name]
+        input_name = list(signature.structured_input_signature[1])[0]
+        output_name = list(signature.structured_outputs)[0]
+        input_shape = signature.structured_input_signature[1][input_name].shape[1:]
+
+        def fn(batch, signature=signature, input_name=input_name, output_name=output_name):
+            return signature(**{input_name: tf.constant(batch)})[output_name].numpy()
+
+        batchers[name] = DynamicBatcher(fn, max_batch_size, timeout_ms, input_shape=input_shape.as_list())
+    return batchers
+
+
+def make_server(batchers, host="127.0.0.1", port=8500):
+    """
+    make_server function
+    HTTP server for the batchers.
+    POST /v1/<signature> with {"inputs": [...]} returns {"outputs": [...]},
+    GET /stats returns the latency statistics of every signature
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            payload = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._reply(200, {name: batcher.stats() for name, batcher in batchers.items()})
+            else:
+                self._reply(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            name = self.path.rsplit("/", 1)[-1]
+            if not self.path.startswith("/v1/") or name not in batchers:
+                self._reply(404, {"error": f"Unknown signature {name}, expected one of {SIGNATURES}"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                outputs = batchers[name].submit(body["inputs"]).result()
+            except Exception as error:
+                self._reply(400, {"error": str(error)})
+                return
+            self._reply(200, {"outputs": outputs.tolist()})
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves an exported VAE over HTTP with dynamic batching")
+    parser.add_argument("--export_dir", type=str, required=True)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8500)
+    parser.add_argument("--max_batch_size", type=int, default=64)
+    parser.add_argument("--batch_timeout_ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    server = make_server(make_batchers(args.export_dir, args.max_batch_size, args.batch_timeout_ms),
+                         args.host, args.port)
+    print(f"Serving {args.export_dir} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+Hyperparameter sweep over learning_rate, batch_size, epochs and version of train_vae.py
+Trials run concurrently in a process pool, each pinned to its own slice of cores with matching TensorFlow
+thread limits, so the wall time of a sweep shrinks with the number of cores. After every epoch a trial
+evaluates the test-set ELBO, and bad trials are stopped early by the median rule or by ASHA.
+Usage:
+    python sweep.py --param learning_rate=1e-3,3e-4 --param batch_size=128,256 --epochs 20 --out sweep.csv
+    python sweep.py --search random --num_trials 16 --param learning_rate=loguniform:1e-4:1e-2 --param version=m0,m1,m2
+"""
+import argparse
+import csv
+import itertools
+import math
+import multiprocessing
+import os
+import random
+import time
+
+import numpy as np
+
+PARAMS = {"learning_rate": float, "batch_size": int, "epochs": int, "version": str}
+STOPPERS = ("none", "median", "asha")
+
+
+def parse_param(text):
+    """
+    parse_param function
+    Parses name=v1,v2,... (choices) or name=uniform:low:high / name=loguniform:low:high (random search only)
+    Returns (name, values), where values is a list or a (distribution, low, high) tuple
+    """
+    name, _, values = text.partition("=")
+    if name not in PARAMS or not values:
+        raise ValueError(f"Expected name=values with name in {tuple(PARAMS)}, got '{text}'")
+    if values.startswith(("uniform:", "loguniform:")):
+        distribution, low, high = values.split(":")
+        return name, (distribution, PARAMS[name](low), PARAMS[name](high))
+    return name, [PARAMS[name](value) for value in values.split(",")]
+
+
+def grid_space(space):
+    """
+    grid_space function
+    Every combination of the choices in space
+    """
+    for name, values in space.items():
+        if not isinstance(values, list):
+            raise ValueError(f"Grid search needs a list of choices for {name}, got {values}")
+    names = list(space)
+    return [dict(zip(names, combination)) for combination in itertools.product(*space.values())]
+
+
+def random_space(space, num_trials, seed=0):
+    """
+    random_space function
+    num_trials configurations drawn from space: uniformly from choices, or from the (log-)uniform ranges
+    """
+    rng = random.Random(seed)
+    configs = []
+    for _ in range(num_trials):
+        config = {}
+        for name, values in space.items():
+            if isinstance(values, list):
+                config[name] = rng.choice(values)
+            else:
+                distribution, low, high = values
+                if distribution == "loguniform":
+                    value = math.exp(rng.uniform(math.log(low), math.log(high)))
+                else:
+                    value = rng.uniform(low, high)
+                config[name] = PARAMS[name](round(value) if PARAMS[name] is int else value)
+        configs.append(config)
+    return configs
+
+
+class MedianStopper:
+    """
+    Class MedianStopper
+    Stops a trial after grace_epochs when its best test ELBO so far is below the median of the
+    best-so-far ELBO of the other trials at the same epoch. Needs results of min_trials other trials
+    Args:
+        history: Shared dictionary (multiprocessing Manager) of trial id to the list of test ELBOs per epoch
+        lock: Shared lock guarding history
+        grace_epochs: Epochs every trial runs before it can be stopped. Default 2
+        min_trials: Other trials needed at an epoch before the rule applies. Default 3
+    """
+    def __init__(self, history, lock, grace_epochs=2, min_trials=3):
+        self.history = history
+        self.lock = lock
+        self.grace_epochs = grace_epochs
+        self.min_trials = min_trials
+
+    def report(self, trial_id, elbos):
+        """
+        Public method
+        Records the test ELBOs of trial_id so far and returns True if the trial should stop
+        """
+        with self.lock:
+            self.history[trial_id] = list(elbos)
+            others = [values for key, values in self.history.items() if key != trial_id]
+        return self._should_stop(elbos, others)
+
+    def _should_stop(self, elbos, others):
+        epoch = len(elbos)
+        if epoch < self.grace_epochs:
+            return False
+        others = [max(values[:epoch]) for values in others if len(values) >= epoch]
+        if len(others) < self.min_trials:
+            return False
+        return max(elbos) < np.median(others)
+
+
+class ASHAStopper(MedianStopper):
+    """
+    Class ASHAStopper
+    Asynchronous successive halving. Inherits from MedianStopper
+    Rungs are at grace_epochs * eta^r epochs. A trial reaching a rung continues only if its ELBO is in
+    the top 1/eta of all ELBOs recorded at that rung so far. Trials are never held back waiting for others,
+    early trials at a rung are promoted optimistically
+    Args:
+        eta: Reduction factor between rungs. Default 3
+    """
+    def __init__(self, history, lock, grace_epochs=1, min_trials=1, eta=3):
+        super().__init__(history, lock, grace_epochs, min_trials)
+        self.eta = eta
+
+    def _should_stop(self, elbos, others):
+        epoch = len(elbos)
+        rung = self.grace_epochs
+        while rung < epoch:
+            rung *= self.eta
+        if rung != epoch:
+            return False
+        rung_elbos = [values[epoch - 1] for values in others if len(values) >= epoch] + [elbos[-1]]
+        if len(rung_elbos) <= self.min_trials:
+            return False
+        keep = max(1, len(rung_elbos) // self.eta)
+        return elbos[-1] < sorted(rung_elbos, reverse=True)[keep - 1]
+
+
+def _init_worker(slots, inter_op_threads):
+    """
+    Private function
+    Pool initializer. Takes a core slice from slots, pins the process to it and limits the
+    TensorFlow thread pools to its size. Runs before TensorFlow is imported in the worker
+    """
+    cores = slots.get()
+    os.sched_setaffinity(0, cores)
+    os.environ["OMP_NUM_THREADS"] = str(len(cores))
+    os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(len(cores))
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+def run_trial(trial):
+    """
+    run_trial function
+    Trains one configuration with fresh weights, evaluating the test ELBO after every epoch
+    and stopping when the stopper says so. Runs in a pool worker
+    Returns a dictionary with the configuration and the results of the trial
+    """
+    import tensorflow as tf
+    from InferenceEngine import InferenceEngine
+    from MnistDataLoader import MnistDataLoader
+    from TrainingEngine import TrainingEngine
+    from VAE import VAE
+    from network_selecter import network_selecter
+
+    trial_id, config, settings, stopper = trial
+    tf.random.set_seed(settings["seed"] + trial_id)
+    np.random.seed(settings["seed"] + trial_id)
+    start = time.perf_counter()
+
+    version = None if settings["dset"] == "mnist_bw" else config.get("version", settings["version"])
+    loader = MnistDataLoader(dset=settings["dset"], version=version, shared_data=settings.get("shared_data"))
+    loader._data_dir = settings["data_dir"]
+    tr_data = loader.get_training_data(batch_size=config.get("batch_size", settings["batch_size"]))
+    x_te = loader.get_testing_data()
+
+    # network_selecter builds new networks, so every trial starts from fresh weights
+    encoder_network, decoder_network = network_selecter(settings["dset"])
+    model = VAE(encoder_network, decoder_network)
+    optimizer = tf.keras.optimizers.Adam(learning_rate=config.get("learning_rate", settings["learning_rate"]))
+    engine = TrainingEngine(model, optimizer)
+    inference = InferenceEngine(model, batch_size=1024)
+
+    elbos, samples, stopped = [], 0, False
+    for _ in range(config.get("epochs", settings["epochs"])):
+        samples += engine.train_epoch(tr_data)["samples"]
+        elbos.append(inference.log_likelihood(x_te, k=1)["elbo"])
+        if stopper is not None and stopper.report(trial_id, elbos):
+            stopped = True
+            break
+    seconds = time.perf_counter() - start
+    loader.close()
+    return {"trial": trial_id, **config, "epochs_run": len(elbos), "best_test_elbo": max(elbos),
+            "final_test_elbo": elbos[-1], "stopped_early": stopped, "seconds": seconds,
+            "samples_per_sec": samples / seconds, "cores": ",".join(map(str, sorted(os.sched_getaffinity(0))))}
+
+
+def core_slots(num_parallel, cores_per_trial=None):
+    """
+    core_slots function
+    Splits the cores available to this process into num_parallel slices of cores_per_trial cores
+    (default: all cores split evenly). With fewer cores than trials the slices wrap around and share cores
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    cores_per_trial = cores_per_trial or max(1, len(cores) // num_parallel)
+    return [[cores[(i * cores_per_trial + j) % len(cores)] for j in range(cores_per_trial)]
+            for i in range(num_parallel)]
+
+
+def run_sweep(configs, settings, num_parallel=None, cores_per_trial=None, stopper="median", inter_op_threads=1,
+              out_path=None):
+    """
+    run_sweep function
+    Runs every configuration in configs in a pool of num_parallel processes
+    Args:
+        configs: List of dictionaries with any of learning_rate, batch_size, epochs and version
+        settings: Dictionary with dset, version, batch_size, learning_rate, epochs, data_dir and seed,
+            used for parameters missing from a configuration, and optionally the shared_data server address
+        num_parallel: Number of concurrent trials. Defaults to the number of cores // cores_per_trial
+        cores_per_trial: Cores pinned to each trial. Defaults to an even split
+        stopper: none, median or asha
+        inter_op_threads: TensorFlow inter-op threads per trial. Default 1
+        out_path: Optional CSV path of the results table
+    Returns:
+        List of trial results sorted by best test ELBO
+    """
+    if stopper not in STOPPERS:
+        raise ValueError(f"Unknown stopper '{stopper}', expected one of {STOPPERS}")
+    num_cores = len(os.sched_getaffinity(0))
+    num_parallel = num_parallel or max(1, num_cores // (cores_per_trial or 1))
+    num_parallel = min(num_parallel, len(configs))
+    # spawn gives every trial process a fresh TensorFlow runtime, forking an initialized runtime is unsafe
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        slots = manager.Queue()
+        for slot in core_slots(num_parallel, cores_per_trial):
+            slots.put(slot)
+        history, lock = manager.dict(), manager.Lock()
+        trial_stopper = {"none": None, "median": MedianStopper, "asha": ASHAStopper}[stopper]
+        trial_stopper = trial_stopper(history, lock) if trial_stopper else None
+
+        start = time.perf_counter()
+        results = []
+        trials = [(i, config, settings, trial_stopper) for i, config in enumerate(configs)]
+        with context.Pool(num_parallel, initializer=_init_worker, initargs=(slots, inter_op_threads)) as pool:
+            for result in pool.imap_unordered(run_trial, trials):
+                results.append(result)
+                status = f"stopped after {result['epochs_run']} epochs" if result["stopped_early"] else "completed"
+                print(f" Trial {result['trial']} {status} | best test ELBO = {result['best_test_elbo']:.3f} "
+                      f"| {result['seconds']:.1f} s ({len(results)}/{len(configs)})")
+        seconds = time.perf_counter() - start
+
+    results.sort(key=lambda result: result["best_test_elbo"], reverse=True)
+    print(f"Sweep of {len(configs)} trials took {seconds:.1f} s with {num_parallel} parallel trials on {num_cores} cores")
+    if out_path:
+        fields = list(dict.fromkeys(key for result in results for key in result))
+        with open(out_path, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(results)
+        print(f"Wrote results table to {out_path}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a hyperparameter sweep of the VAE in a process pool")
+    parser.add_argument("--param", type=str, action="append", default=[],
+                        help="name=v1,v2,... or name=uniform:low:high / loguniform:low:high, repeatable")
+    parser.add_argument("--search", type=str, default="grid", choices=["grid", "random"])
+    parser.add_argument("--num_trials", type=int, default=10)
+    parser.add_argument("--dset", type=str, default="mnist_bw")
+    parser.add_argument("--version", type=str, default="m1")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--learning_rate", type=float, default=1e-3)
+    parser.add_argument("--num_parallel", type=int, default=None)
+    parser.add_argument("--cores_per_trial", type=int, default=None)
+    parser.add_argument("--inter_op_threads", type=int, default=1)
+    parser.add_argument("--stopper", type=str, default="median", choices=STOPPERS)
+    parser.add_argument("--data_dir", type=str, default="./data")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=str, default="sweep_results.csv")
+    parser.add_argument("--shared_data", type=str, default=None,
+                        help="Address for a SharedDataServer started by the sweep, trials then share one copy of the data")
+    args = parser.parse_args()
+
+    try:
+        space = dict(parse_param(text) for text in args.param)
+    except ValueError as error:
+        parser.error(str(error))
+    if not space:
+        parser.error("Give at least one --param")
+    configs = grid_space(space) if args.search == "grid" else random_space(space, args.num_trials, args.seed)
+    settings = {"dset": args.dset, "version": args.version, "epochs": args.epochs, "batch_size": args.batch_size,
+                "learning_rate": args.learning_rate, "data_dir": args.data_dir, "seed": args.seed}
+
+    # Download once up front instead of racing in every trial
+    from MnistDataLoader import MnistDataLoader
+    versions = {None} if args.dset == "mnist_bw" else {config.get("version", args.version) for config in configs}
+    for version in versions:
+        loader = MnistDataLoader(dset=args.dset, version=version)
+        loader._data_dir = args.data_dir
+        loader.download_all()
+
+    server = None
+    if args.shared_data:
+        from SharedDataServer import start_server
+        # Trials come and go, so the splits stay loaded until the sweep ends
+        server = start_server(args.shared_data, data_dir=args.data_dir, evict_unused=False)
+        settings["shared_data"] = args.shared_data
+    try:
+        results = run_sweep(configs, settings, args.num_parallel, args.cores_per_trial, args.stopper,
+                            args.inter_op_threads, args.out)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    names = list(space)
+    print(" ".join(f"{name:>14s}" for name in names + ["epochs_run", "best_elbo"]))
+    for result in results:
+        print(" ".join(f"{result[name]:>14.4g}" if isinstance(result[name], float) else f"{result[name]!s:>14s}"
+                       for name in names)
+              + f" {result['epochs_run']:>14d} {result['best_test_elbo']:>14.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+DataRegistry loads outside the lock and its size accounting
+"""
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from DataRegistry import DataRegistry
+
+
+def test_slow_load_does_not_block_other_keys():
+    registry = DataRegistry()
+    registry.put("resident", np.zeros(4))
+    started, release = threading.Event(), threading.Event()
+
+    def slow_load():
+        started.set()
+        release.wait(10)
+        return np.ones(4)
+
+    thread = threading.Thread(target=registry.get_or_load, args=("slow", slow_load))
+    thread.start()
+    started.wait(10)
+    start = time.perf_counter()
+    assert registry.get("resident") is not None
+    assert registry.get_or_load("other", lambda: np.full(4, 2.0))[0] == 2.0
+    assert time.perf_counter() - start < 1.0
+    release.set()
+    thread.join()
+    assert registry.get("slow")[0] == 1.0
+
+
+def test_concurrent_misses_load_once():
+    registry = DataRegistry()
+    calls, results = [], []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.1)
+        return np.arange(3)
+
+    threads = [threading.Thread(target=lambda: results.append(registry.get_or_load("key", load))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert len(results) == 8 and all(result is results[0] for result in results)
+
+
+def test_failed_load_is_retried():
+    registry = DataRegistry()
+
+    def fail():
+        raise OSError("disk")
+
+    with pytest.raises(OSError):
+        registry.get_or_load("key", fail)
+    assert registry.get_or_load("key", lambda: 5) == 5
+
+
+def test_memmap_is_not_counted(tmp_path):
+    path = str(tmp_path / "x.npy")
+    np.save(path, np.zeros((1000, 100), np.float32))
+    registry = DataRegistry(max_bytes=1024)
+
+    registry.put("mapped", np.load(path, mmap_mode="r"))
+    registry.put("resident", np.zeros(16, np.float32))
+
+    assert "mapped" in registry and "resident" in registry
+    assert registry.nbytes == 64
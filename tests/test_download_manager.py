@@ -0,0 +1,194 @@
+"""
+DownloadManager against a local HTTP stand-in server with Range support
+"""
+import hashlib
+import io
+import os
+import pickle
+import threading
+import time
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+from DownloadManager import SIDECAR, DownloadManager
+from data_utils import check_data_file
+
+BODY = os.urandom(256 * 1024)
+_npy = io.BytesIO()
+np.save(_npy, np.arange(1000, dtype=np.int64))
+FILES = {
+    "/data.bin": BODY,
+    "/data.npy": _npy.getvalue(),
+    # An error page served with status 200 in place of the file
+    "/page.npy": b"<!DOCTYPE html><html><body>Please sign in</body></html>",
+}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves FILES (404 elsewhere), honours Range headers and records every request
+    With server.truncate_next the next response announces the full length but stops halfway
+    """
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append({"path": self.path, "range": self.headers.get("Range")})
+            truncate, server.truncate_next = server.truncate_next, False
+        if self.path not in FILES:
+            self.send_error(404)
+            return
+        data = FILES[self.path]
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data)-1}/{len(data)}")
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if truncate:
+            body = body[:len(body) // 2]
+        for offset in range(0, len(body), 16 * 1024):
+            self.wfile.write(body[offset:offset + 16 * 1024])
+            time.sleep(server.delay)
+        if truncate:
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    httpd.lock, httpd.requests, httpd.truncate_next, httpd.delay = threading.Lock(), [], False, 0.0
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def url(server, name="data.bin"):
+    return f"http://127.0.0.1:{server.server_address[1]}/{name}"
+
+
+def test_concurrent_downloads_fetch_once(server, tmp_path):
+    server.delay = 0.01
+    path = str(tmp_path / "data.bin")
+    errors = []
+
+    def download():
+        try:
+            DownloadManager().download(url(server), path)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=download) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    with open(path, "rb") as file:
+        assert file.read() == BODY
+    assert len(server.requests) == 1
+    assert not os.path.exists(path + ".part")
+    assert not os.path.exists(path + ".lock")
+
+
+def test_resume_from_partial_file(server, tmp_path):
+    path = str(tmp_path / "data.bin")
+    with open(path + ".part", "wb") as file:
+        file.write(BODY[:100000])
+
+    DownloadManager().download(url(server), path)
+
+    with open(path, "rb") as file:
+        assert file.read() == BODY
+    assert server.requests[-1]["range"] == "bytes=100000-"
+    with open(path + SIDECAR) as file:
+        assert file.read().split()[0] == hashlib.sha256(BODY).hexdigest()
+
+
+def test_truncated_response_is_resumed(server, tmp_path):
+    server.truncate_next = True
+    path = str(tmp_path / "data.bin")
+
+    DownloadManager().download(url(server), path)
+
+    with open(path, "rb") as file:
+        assert file.read() == BODY
+    assert len(server.requests) == 2
+    assert server.requests[1]["range"] is not None
+
+
+def test_checksum_mismatch_leaves_no_file(server, tmp_path):
+    path = str(tmp_path / "data.bin")
+
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        DownloadManager().download(url(server), path, sha256="0" * 64)
+
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + ".part")
+    assert not os.path.exists(path + ".lock")
+
+
+def test_corrupt_file_is_downloaded_again(server, tmp_path):
+    path = str(tmp_path / "data.bin")
+    manager = DownloadManager()
+    manager.download(url(server), path)
+    with open(path, "r+b") as file:
+        file.write(b"corrupt")
+
+    assert not manager.verify(path)
+    manager.download(url(server), path)
+
+    with open(path, "rb") as file:
+        assert file.read() == BODY
+    assert len(server.requests) == 2
+
+
+def test_client_errors_are_not_retried(server, tmp_path):
+    with pytest.raises(urllib.error.HTTPError):
+        DownloadManager(retries=3).download(url(server, "missing.bin"), str(tmp_path / "missing.bin"))
+
+    assert len(server.requests) == 1
+
+
+def test_malformed_first_download_is_not_recorded(server, tmp_path):
+    path = str(tmp_path / "page.npy")
+
+    with pytest.raises(ValueError, match="not a valid file"):
+        DownloadManager(validate=check_data_file).download(url(server, "page.npy"), path)
+
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + ".part")
+    assert not os.path.exists(path + SIDECAR)
+    assert not os.path.exists(path + ".lock")
+
+
+def test_valid_npy_download_is_accepted(server, tmp_path):
+    path = str(tmp_path / "data.npy")
+
+    DownloadManager(validate=check_data_file).download(url(server, "data.npy"), path)
+
+    assert np.array_equal(np.load(path), np.arange(1000))
+    assert os.path.exists(path + SIDECAR)
+
+
+def test_check_data_file_rejects_truncated_files(tmp_path):
+    npy, pkl = tmp_path / "x.npy", tmp_path / "x.pkl"
+    npy.write_bytes(FILES["/data.npy"][:-8])
+    pkl.write_bytes(pickle.dumps({"m0": np.zeros(3)}, protocol=pickle.HIGHEST_PROTOCOL)[:-1])
+
+    for path in (npy, pkl):
+        with pytest.raises(ValueError):
+            check_data_file(str(path))
+    check_data_file(str(npy), name="x.bin")
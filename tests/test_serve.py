@@ -0,0 +1,106 @@
+"""
+serve.make_server on a free localhost port with a stub DynamicBatcher
+"""
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+
+from serve import DynamicBatcher, make_server
+
+
+class StubModel:
+    """
+    Doubles its inputs and records the size of every batch it was called with
+    """
+    def __init__(self):
+        self.batch_sizes = []
+        self.lock = threading.Lock()
+
+    def __call__(self, batch):
+        with self.lock:
+            self.batch_sizes.append(len(batch))
+        return 2 * batch
+
+
+@pytest.fixture
+def served():
+    model = StubModel()
+    batcher = DynamicBatcher(model, max_batch_size=8, timeout_ms=50, input_shape=(3,))
+    httpd = make_server({"decode_mean": batcher}, port=0)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}", model
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def post(base, inputs):
+    request = urllib.request.Request(f"{base}/v1/decode_mean", data=json.dumps({"inputs": inputs}).encode(),
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def post_concurrently(base, bodies):
+    results = [None] * len(bodies)
+
+    def send(index):
+        results[index] = post(base, bodies[index])
+
+    threads = [threading.Thread(target=send, args=(index,)) for index in range(len(bodies))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_requests_are_coalesced(served):
+    base, model = served
+    bodies = [[[index, index + 0.5, -index]] for index in range(16)]
+
+    results = post_concurrently(base, bodies)
+
+    for body, (status, reply) in zip(bodies, results):
+        assert status == 200
+        np.testing.assert_allclose(reply["outputs"], 2 * np.asarray(body))
+    assert len(model.batch_sizes) < len(bodies)
+    assert max(model.batch_sizes) <= 8
+    with urllib.request.urlopen(f"{base}/stats") as response:
+        stats = json.loads(response.read())["decode_mean"]
+    assert stats["requests"] == 16
+    assert stats["batches"] == len(model.batch_sizes)
+    assert stats["p99_ms"] >= stats["p50_ms"] > 0
+
+
+def test_malformed_request_is_rejected_alone(served):
+    base, model = served
+    bodies = [[[1, 2, 3]], [[1, 2]], [[4, 5, 6], [7, 8, 9]]]
+
+    results = post_concurrently(base, bodies)
+
+    assert results[1][0] == 400
+    for index in (0, 2):
+        assert results[index][0] == 200
+        np.testing.assert_allclose(results[index][1]["outputs"], 2 * np.asarray(bodies[index]))
+    assert sum(model.batch_sizes) == 3
+
+
+def test_batches_never_exceed_max_batch_size(served):
+    base, model = served
+    bodies = [np.arange(6 * 3).reshape(6, 3).tolist() for _ in range(3)] + [np.arange(20 * 3).reshape(20, 3).tolist()]
+
+    results = post_concurrently(base, bodies)
+
+    for body, (status, reply) in zip(bodies, results):
+        assert status == 200
+        np.testing.assert_allclose(reply["outputs"], 2 * np.asarray(body))
+    assert max(model.batch_sizes) <= 8
+    assert sum(model.batch_sizes) == 3 * 6 + 20
@@ -0,0 +1,67 @@
+"""
+MnistDataLoader with and without a SharedDataServer on synthetic data
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from MnistDataLoader import MnistDataLoader
+from SharedDataServer import start_server
+from synthetic import write_synthetic_data
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    return write_synthetic_data(str(tmp_path / "data"), n_train=10000, n_test=300, dsets=("mnist_bw",))
+
+
+@pytest.fixture
+def server(data_dir, tmp_path):
+    address = str(tmp_path / "shared.sock")
+    process = start_server(address, data_dir=data_dir, evict_unused=False)
+    yield address
+    process.terminate()
+    process.wait()
+
+
+def loader_for(data_dir, shared_data=None):
+    loader = MnistDataLoader("mnist_bw", shared_data=shared_data)
+    loader._data_dir = data_dir
+    return loader
+
+
+def rows(dataset):
+    return np.concatenate([batch.numpy() for batch in dataset])
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_unshuffled_training_data_keeps_row_order(data_dir, streaming):
+    loader = loader_for(data_dir)
+
+    x = rows(loader.get_training_data(batch_size=512, streaming=streaming, shuffle_buffer=1))
+
+    np.testing.assert_allclose(x, loader._get_split("train"), atol=1e-6)
+
+
+def test_shared_training_data_keeps_row_order(data_dir, server):
+    loader = loader_for(data_dir, shared_data=server)
+
+    x = rows(loader.get_training_data(batch_size=512, shuffle_buffer=1))
+
+    assert np.array_equal(x, loader._get_split("train"))
+    assert np.array_equal(x, loader_for(data_dir)._get_split("train"))
+    loader.close()
+
+
+def test_shared_testing_data_matches_local(data_dir, server):
+    loader = loader_for(data_dir, shared_data=server)
+
+    x = loader.get_testing_data()
+
+    assert isinstance(x, np.ndarray) and x.dtype == np.float32 and not x.flags.writeable
+    assert np.array_equal(x, loader_for(data_dir).get_testing_data())
+    loader.close()
@@ -1,14 +1,105 @@
 
 import argparse
+import json
+import os
 
 from VAE import VAE
+from TrainingEngine import TrainingEngine
+from Checkpointer import Checkpointer
+from Telemetry import SINKS, Telemetry, make_sinks, parse_profile_steps
+from InferenceEngine import InferenceEngine
+from EmbeddingIndex import IVFIndex, recall_benchmark
+from export_model import export_saved_model, export_tflite
 
 import tensorflow as tf
 import numpy as np
 from MnistDataLoader import MnistDataLoader
+from ShardedDataLoader import ShardedDataLoader
+from precision import PRECISIONS, set_precision, wrap_optimizer
+from distribute import STRATEGIES, distribute_dataset, is_chief, local_tf_config, make_strategy, worker_info
+from projection import METHODS as PROJECTIONS, weights_fingerprint
+from data_utils import sha256_array
+
+def make_telemetry(args, strategy):
+    """
+    make_telemetry function
+    Telemetry writing to --telemetry_dir (non-chief workers to a worker_<i> subdirectory), None without the flag
+    """
+    if args.telemetry_dir is None:
+        return None
+    directory = args.telemetry_dir
+    if not is_chief(strategy):
+        directory = os.path.join(directory, f"worker_{worker_info(strategy)[1]}")
+    profile_steps = parse_profile_steps(args.profile_steps) if args.profile_steps else None
+    return Telemetry(make_sinks(directory, args.telemetry_sinks.split(",")), log_every=args.log_every_steps,
+                     profile_steps=profile_steps, profile_dir=os.path.join(directory, "profile"))
+
+
+def train(args, strategy, model, optimizer, my_data_loader, checkpointer):
+    """
+    train function
+    Trains model for args.epochs epochs, resuming from checkpointer with --resume
+    Checkpoints are saved every --checkpoint_every_steps steps / --checkpoint_every_minutes minutes,
+    or after every epoch when neither is given. A resumed run restarts the epoch it was interrupted in
+    With --telemetry_dir every step is timed and written to the telemetry sinks
+    """
+    if args.sharded:
+        num_workers, worker_index = worker_info(strategy)
+        sharded_loader = ShardedDataLoader(dset = args.dset,version = args.version,
+                                           num_workers = num_workers,worker_index = worker_index)
+        if not sharded_loader.has_manifest("train"):
+            my_data_loader.export_shards("train", shard_size=args.shard_size)
+        tr_data = sharded_loader.get_training_data(batch_size=args.batch_size,
+                                                   shuffle_buffer=args.shuffle_buffer or 8192,
+                                                   drop_remainder=args.jit_compile)
+    else:
+        tr_data = my_data_loader.get_training_data(batch_size=args.batch_size,streaming=args.streaming,
+                                                   shuffle_buffer=args.shuffle_buffer,cache=args.cache_data,
+                                                   drop_remainder=args.jit_compile)
+    # With --jit_compile the ragged last batch is dropped so the XLA step is compiled for a single shape
+    train_step = None
+    if args.jit_compile:
+        train_step = model.make_train_step(optimizer, tr_data.element_spec.shape, jit_compile=True)
+    if args.strategy != "default":
+        tr_data = distribute_dataset(strategy, tr_data, already_sharded=args.sharded)
+    telemetry = make_telemetry(args, strategy)
+    engine = TrainingEngine(model, optimizer, steps_per_execution=args.steps_per_execution, train_step=train_step,
+                            strategy=strategy, telemetry=telemetry)
+
+    start_epoch = 0
+    after_execution = None
+    save_every_epoch = False
+    if checkpointer is not None:
+        if args.resume and checkpointer.restore() is not None:
+            start_epoch = int(checkpointer.epoch.numpy())
+        after_execution = checkpointer.maybe_save
+        save_every_epoch = args.checkpoint_every_steps is None and args.checkpoint_every_minutes is None
+    if telemetry is not None:
+        # Steps (and the --profile_steps window) count optimizer steps, also across resumed runs
+        telemetry.step = int(optimizer.iterations.numpy())
+
+    for e in range(start_epoch, args.epochs):
+        stats = engine.train_epoch(tr_data, after_execution)
+    
+        if not args.silent_mode:
+            print(f" Epoch: {e+1} | Loss = {stats['loss']} | {stats['samples_per_sec']:.0f} samples/sec ")
+        if telemetry is not None:
+            record = telemetry.end_epoch(e+1, stats, engine.trace_counts())
+            if not args.silent_mode:
+                print(f" Input wait: {100*record['input_fraction']:.1f}% | {record['stalled_steps']} stalled steps "
+                      f"| peak RSS {record['peak_rss_mb']:.0f} MiB ")
+        if checkpointer is not None:
+            checkpointer.epoch.assign(e+1)
+            if save_every_epoch:
+                checkpointer.save(int(optimizer.iterations.numpy()))
+
+    if checkpointer is not None and not save_every_epoch:
+        checkpointer.save(int(optimizer.iterations.numpy()))
+    if telemetry is not None:
+        telemetry.close()
+    if not args.silent_mode:
+        print(f" Trace counts: {engine.trace_counts()}")
 
-from network_selecter import network_selecter
-from plot_utils import plot_grid,plot_latent
 
 def main():
     #__________________Dataset choice and visualization________________________________________
@@ -19,12 +110,65 @@ def main():
     parser.add_argument("--generate_from_prior",action="store_true")
     parser.add_argument("--generate_from_posterior",action="store_true")
     parser.add_argument("--noisy", action ="store_true")
+    parser.add_argument("--projection",type = str, default = "tsne", choices = PROJECTIONS)
+    parser.add_argument("--projection_max_points",type = int, default = None)
+    parser.add_argument("--projection_cache_dir",type = str, default = "projections")
+    parser.add_argument("--n_jobs",type = int, default = -1)
+    parser.add_argument("--grid_images",type = int, default = 100)
+    parser.add_argument("--no_show",action = "store_true")
+    parser.add_argument("--generate_bulk",type = int, default = None)
+    parser.add_argument("--generate_dir",type = str, default = "generated")
+    parser.add_argument("--generate_shard_size",type = int, default = 10000)
+    parser.add_argument("--generate_batch_size",type = int, default = 1024)
+    parser.add_argument("--generate_workers",type = int, default = None)
    
 
     #________________Trainning_Hyperparameters___________________________________
     parser.add_argument("--epochs",type = int,default = 50)
     parser.add_argument("--batch_size",type = int, default = 256)
     parser.add_argument("--learning_rate",type = float, default = 1e-3)
+    parser.add_argument("--precision",type = str, default = "float32", choices = PRECISIONS)
+    parser.add_argument("--jit_compile",action = "store_true")
+    parser.add_argument("--steps_per_execution",type = int, default = 1)
+    parser.add_argument("--objective",type = str, default = "elbo", choices = VAE.OBJECTIVES)
+    parser.add_argument("--iwae_k",type = int, default = 5)
+    parser.add_argument("--iwae_chunk",type = int, default = None)
+
+    #________________Distributed_training___________________________________
+    parser.add_argument("--strategy",type = str, default = "default", choices = STRATEGIES)
+    parser.add_argument("--num_cpu_devices",type = int, default = 1)
+    parser.add_argument("--num_workers",type = int, default = 1)
+    parser.add_argument("--worker_index",type = int, default = 0)
+    parser.add_argument("--worker_base_port",type = int, default = 12345)
+
+    #________________Input_pipeline___________________________________
+    parser.add_argument("--streaming",action = "store_true")
+    parser.add_argument("--shuffle_buffer",type = int, default = None)
+    parser.add_argument("--cache_data",action = "store_true")
+    parser.add_argument("--sharded",action = "store_true")
+    parser.add_argument("--shard_size",type = int, default = 10000)
+    parser.add_argument("--shared_data",type = str, default = None)
+
+    #________________Checkpointing___________________________________
+    parser.add_argument("--checkpoint_dir",type = str, default = None)
+    parser.add_argument("--checkpoint_every_steps",type = int, default = None)
+    parser.add_argument("--checkpoint_every_minutes",type = float, default = None)
+    parser.add_argument("--max_checkpoints",type = int, default = 3)
+    parser.add_argument("--resume",action = "store_true")
+    parser.add_argument("--load_only",action = "store_true")
+
+    #________________Inference___________________________________
+    parser.add_argument("--inference_batch_size",type = int, default = 1024)
+    parser.add_argument("--eval_iwae_k",type = int, default = None)
+    parser.add_argument("--build_index",type = str, default = None)
+    parser.add_argument("--export_dir",type = str, default = None)
+    parser.add_argument("--export_tflite",type = str, default = None, choices = ["float32", "dynamic", "int8"])
+
+    #________________Telemetry___________________________________
+    parser.add_argument("--telemetry_dir",type = str, default = None)
+    parser.add_argument("--telemetry_sinks",type = str, default = ",".join(SINKS))
+    parser.add_argument("--log_every_steps",type = int, default = 1)
+    parser.add_argument("--profile_steps",type = str, default = None)
 
     #_________________Quality of life___________________________
     parser.add_argument("--save_plot",action = "store_true")
@@ -38,66 +182,147 @@ def main():
    
     if args.dset =="mnist_bw":
         args.version = None
+    if args.jit_compile and args.strategy != "default":
+        parser.error("--jit_compile needs static per-replica batch shapes and is only supported with --strategy default")
+    if (args.resume or args.load_only) and args.checkpoint_dir is None:
+        parser.error("--resume and --load_only need --checkpoint_dir")
+    if args.profile_steps and args.telemetry_dir is None:
+        parser.error("--profile_steps needs --telemetry_dir")
+    if args.generate_bulk and args.checkpoint_dir is None:
+        parser.error("--generate_bulk needs --checkpoint_dir, the generation workers restore the model from it")
 
     #______________Training______________________________________________
-    encoder_network, decoder_network = network_selecter(args.dset)
-    model = VAE(encoder_network,decoder_network)
-    optimizer = tf.keras.optimizers.Adam(learning_rate =args.learning_rate)
-    my_data_loader = MnistDataLoader(dset = args.dset,version = args.version)
-    tr_data = my_data_loader.get_training_data(batch_size=args.batch_size)
-    for e in range(args.epochs):
-        batch_loss = []
-        for tr_batch in tr_data:
-            loss = model.train(tr_batch,optimizer)
-            batch_loss.append(loss)
-    
-        if not args.silent_mode:
-            epoch_loss = tf.reduce_mean(batch_loss).numpy()
-            print(f" Epoch: {e+1} | Loss = {epoch_loss} ")
+    # The strategy has to be created before TensorFlow initializes its devices
+    if args.strategy == "multi_worker" and "TF_CONFIG" not in os.environ:
+        os.environ["TF_CONFIG"] = json.dumps(local_tf_config(args.num_workers, args.worker_index, args.worker_base_port))
+    strategy = make_strategy(args.strategy, args.num_cpu_devices)
+    # The dtype policy has to be set before nn.py builds the networks
+    set_precision(args.precision)
+    with strategy.scope():
+        from network_selecter import network_selecter
+        encoder_network, decoder_network = network_selecter(args.dset)
+        model = VAE(encoder_network,decoder_network,objective=args.objective,iwae_k=args.iwae_k,iwae_chunk=args.iwae_chunk)
+        optimizer = wrap_optimizer(tf.keras.optimizers.Adam(learning_rate =args.learning_rate), args.precision)
+    my_data_loader = MnistDataLoader(dset = args.dset,version = args.version,shared_data = args.shared_data)
+    if args.shared_data is None:
+        if not args.load_only:
+            my_data_loader.download_all()
+        else:
+            # Without training only the test images (and their labels for the latent plot) are used
+            splits = ["test"] if (args.eval_iwae_k or args.visualize_latent or (args.export_dir and args.export_tflite)
+                                  or args.build_index or args.generate_from_posterior) else []
+            if args.visualize_latent:
+                splits.append("labels")
+            my_data_loader.download_all(splits)
 
+    checkpointer = None
+    if args.checkpoint_dir is not None:
+        checkpointer = Checkpointer(args.checkpoint_dir, model, None if args.load_only else optimizer,
+                                    every_steps=args.checkpoint_every_steps,every_minutes=args.checkpoint_every_minutes,
+                                    max_to_keep=args.max_checkpoints,chief=is_chief(strategy))
+    if args.load_only:
+        # Inference and plotting only, the trained model comes from the latest checkpoint
+        checkpointer.restore(required=True)
+    else:
+        train(args, strategy, model, optimizer, my_data_loader, checkpointer)
+    if checkpointer is not None:
+        checkpointer.close()
 
-   
+    # Only one process of a multi-worker run produces the plots
+    if not is_chief(strategy):
+        return
 
+    inference = InferenceEngine(model, batch_size=args.inference_batch_size)
+    # matplotlib (and sklearn through t-SNE) are only imported when something is plotted
+    if args.visualize_latent or args.generate_from_prior or args.generate_from_posterior:
+        from plot_utils import plot_grid,plot_latent,set_headless
+        if args.no_show:
+            set_headless()
 
+    #___________Test log-likelihood________________________________
+    if args.eval_iwae_k:
+        result = inference.log_likelihood(my_data_loader.get_testing_data(), k=args.eval_iwae_k,
+                                          chunk_size=args.iwae_chunk)
+        print(f" Test IWAE (k={result['k']}) = {result['iwae']:.3f} | ELBO = {result['elbo']:.3f} "
+              f"| {result['examples_per_sec']:.0f} examples/sec ")
 
     #___________Visualizing the latent space_______________________
     if args.visualize_latent:
         x_te = my_data_loader.get_testing_data()
         labels = my_data_loader.get_labels()
         if args.noisy:
-            z = model.sample_z(x_te)
+            z = inference.predict("encode_sample", x_te)
         else:
-            z = model.sample_zmean(x_te)
+            z = inference.predict("encode_mean", x_te)
+
+        # The cached projection is keyed by the trained weights and the test data, noisy z get their own entry
+        cache_key = f"{weights_fingerprint(model)}_{sha256_array(x_te)}_{'noisy' if args.noisy else 'mean'}"
+        plot_latent(z,labels,args.dset,args.batch_size,args.epochs,"Latent",args.save_plot,args.noisy,args.learning_rate,args.version,
+                    method=args.projection,max_points=args.projection_max_points,cache_dir=args.projection_cache_dir or None,
+                    cache_key=cache_key,n_jobs=args.n_jobs,show=not args.no_show)
 
-        plot_latent(z,labels,args.dset,args.batch_size,args.epochs,"Latent",args.save_plot,args.noisy,args.learning_rate,args.version,)
 
 
+    #___________Serving artifacts__________________________________
+    if args.export_dir:
+        export_saved_model(model, args.export_dir)
+        if args.export_tflite:
+            x_calibration = my_data_loader.get_testing_data()[:256]
+            representative_data = {"encode_mean": x_calibration,
+                                   "decode_mean": inference.predict("encode_mean", x_calibration)}
+            export_tflite(args.export_dir, quantize=None if args.export_tflite == "float32" else args.export_tflite,
+                          representative_data=representative_data)
+
+    #___________Nearest-neighbour index over mu_z__________________
+    if args.build_index:
+        z_te = inference.predict("encode_mean", my_data_loader.get_testing_data())
+        index = IVFIndex(z_te)
+        index.save(args.build_index)
+        print(f"Saved IVF index of {len(index)} test embeddings to {args.build_index}")
+        if not args.silent_mode:
+            # Recall is measured with held-out test embeddings, drawn uniformly, against an index of the rest.
+            # A query that is in the index finds itself and inflates the recall
+            order = np.random.default_rng(0).permutation(len(z_te))
+            held_out = min(1000, len(z_te) // 10)
+            for row in recall_benchmark(IVFIndex(z_te[order[held_out:]]), z_te[order[:held_out]]):
+                print(f" n_probe: {row['n_probe']} | recall@10 = {row['recall']:.3f} | {row['ms_per_query']:.3f} ms/query ")
 
     #____________Generating new image from prior dist.____________
     if args.generate_from_prior:
         latent_dim = model.latent_dim
-        samples = 100
+        samples = args.grid_images
         z_prior = np.random.randn(samples, latent_dim).astype(np.float32)
-        z_prior = tf.convert_to_tensor(z_prior)
         if args.noisy:    
-            x_recon = model.reconstruct_noisy(z_prior)
+            x_recon = inference.predict("decode_noisy", z_prior)
         else:
-            x_recon = model.reconstruct_mean(z_prior)
+            x_recon = inference.predict("decode_mean", z_prior)
             
-        plot_grid(x_recon,args.dset,args.batch_size,args.epochs,"Prior",args.save_plot,args.noisy,args.learning_rate,args.version)
+        plot_grid(x_recon,args.dset,args.batch_size,args.epochs,"Prior",args.save_plot,args.noisy,args.learning_rate,args.version,
+                  show=not args.no_show)
+
+    #____________Bulk generation from the prior___________________
+    if args.generate_bulk:
+        from generate import generate_prior
+        generate_prior(args.checkpoint_dir, args.dset, args.generate_bulk, args.generate_dir,
+                       shard_size=args.generate_shard_size, batch_size=args.generate_batch_size,
+                       num_workers=args.generate_workers, noisy=args.noisy, silent=args.silent_mode)
 
     #__________Generating new image from posterior dist.____________
     if args.generate_from_posterior:
-        te_data = my_data_loader.get_testing_data()
-        z = model.sample_z(te_data)
+        # Only the test images shown in the grid are encoded and decoded
+        te_data = my_data_loader.get_testing_data()[:args.grid_images]
+        # Encoding and decoding are chained per micro-batch, z is never held for the whole test set
+        z = inference.run("encode_sample", te_data)
         if args.noisy:   
-            x_recon = model.reconstruct_noisy(z)
+            x_recon = inference.predict("decode_noisy", z)
         else:
-            x_recon = model.reconstruct_mean(z)
-        plot_grid(x_recon,args.dset,args.batch_size,args.epochs,"Posterior",args.save_plot,args.noisy,args.learning_rate,args.version)
+            x_recon = inference.predict("decode_mean", z)
+        plot_grid(x_recon,args.dset,args.batch_size,args.epochs,"Posterior",args.save_plot,args.noisy,args.learning_rate,args.version,
+                  show=not args.no_show)
 
 
-main()
+if __name__ == "__main__":
+    main()
 
 
 